@@ -30,8 +30,61 @@ MONITORING_LAMBDA = f"lm-{APP_NAME}-{STAGE}-collector"
 # Lambda関数名
 PREVALIDATE_LAMBDA = f"{APP_NAME}-{STAGE}-prevalidate"
 REDSHIFT_LAMBDA = f"{APP_NAME}-{STAGE}-redshift-load"
+CSV2PARQUET_LAMBDA = f"{APP_NAME}-{STAGE}-csv2parquet"
+
+# pyarrow同梱レイヤー（AWS SDK for pandas）
+PYARROW_LAYER_ARN = f"arn:aws:lambda:{REGION}:336392948345:layer:AWSSDKPandas-Python39:YOUR_LAYER_VERSION"
 FINALIZE_LAMBDA = f"{APP_NAME}-{STAGE}-finalize"
 
+# Step Functions 2/3 のLambda（関数・ロールは作成済みのためコードのみ更新）
+# ハンドラと同じディレクトリの補助モジュール、step-functions/common の共通モジュールをZIP直下に同梱
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SF2_DIR = 'step-functions/sf2-json-dynamodb'
+SF3_DIR = 'step-functions/sf3-log-athena'
+COMMON_DIR = 'step-functions/common'
+STEP_FUNCTION_LAMBDA_BUNDLES = [
+    {
+        'name': 'json-processor-dev-preprocessor',
+        'file': f'{SF2_DIR}/lambda_json_preprocessor.py',
+        'extra_files': [f'{SF2_DIR}/batch_transform.py', f'{SF2_DIR}/item_schema.py',
+                        f'{COMMON_DIR}/json_stream.py', f'{COMMON_DIR}/structured_logger.py']
+    },
+    {
+        'name': 'json-processor-dev-dynamodb-writer',
+        'file': f'{SF2_DIR}/lambda_dynamodb_writer.py',
+        'extra_files': [f'{SF2_DIR}/dynamodb_item_encoder.py', f'{SF2_DIR}/dynamodb_rate_limiter.py',
+                        f'{SF2_DIR}/dynamodb_write_engine.py', f'{SF2_DIR}/failed_items_spool.py',
+                        f'{COMMON_DIR}/structured_logger.py']
+    },
+    {
+        'name': 'json-processor-dev-finalizer',
+        'file': f'{SF2_DIR}/lambda_json_finalizer.py',
+        'extra_files': [f'{SF2_DIR}/dynamodb_load_verifier.py', f'{SF2_DIR}/dynamodb_rate_limiter.py',
+                        f'{COMMON_DIR}/structured_logger.py']
+    },
+    {
+        'name': 'log-processor-dev-collector',
+        'file': f'{SF3_DIR}/lambda_log_collector.py',
+        'extra_files': [f'{SF3_DIR}/log_checkpoint_store.py', f'{SF3_DIR}/log_level_classifier.py',
+                        f'{SF3_DIR}/log_stream_reader.py', f'{COMMON_DIR}/structured_logger.py']
+    },
+    {
+        'name': 'log-processor-dev-crawler-runner',
+        'file': f'{SF3_DIR}/lambda_glue_crawler_runner.py',
+        'extra_files': [f'{COMMON_DIR}/etl_poller.py', f'{COMMON_DIR}/structured_logger.py']
+    },
+    {
+        'name': 'log-processor-dev-athena-executor',
+        'file': f'{SF3_DIR}/lambda_athena_executor.py',
+        'extra_files': [f'{COMMON_DIR}/etl_poller.py', f'{COMMON_DIR}/structured_logger.py']
+    },
+    {
+        'name': 'log-processor-dev-finalizer',
+        'file': f'{SF3_DIR}/lambda_log_finalizer.py',
+        'extra_files': [f'{COMMON_DIR}/structured_logger.py']
+    }
+]
+
 # AWS クライアント
 s3 = boto3.client('s3', region_name=REGION)
 iam = boto3.client('iam', region_name=REGION)
@@ -94,8 +147,10 @@ def create_iam_roles():
                     "logs:PutLogEvents",
                     "s3:GetObject",
                     "s3:PutObject",
+                    "s3:DeleteObject",
                     "s3:ListBucket",
                     "redshift-data:ExecuteStatement",
+                    "redshift-data:BatchExecuteStatement",
                     "redshift-data:DescribeStatement", 
                     "redshift-data:GetStatementResult"
                 ],
@@ -146,6 +201,15 @@ def create_iam_roles():
                     "glue:StartJobRun",
                     "glue:GetJobRun",
                     "glue:BatchStopJobRun",
+                    "redshift-data:DescribeStatement",
+                    "redshift-data:CancelStatement",
+                    "states:StartExecution",
+                    "states:DescribeExecution",
+                    "states:StopExecution",
+                    "s3:PutObject",
+                    "s3:GetObject",
+                    "s3:ListMultipartUploadParts",
+                    "s3:AbortMultipartUpload",
                     "logs:CreateLogDelivery",
                     "logs:GetLogDelivery",
                     "logs:UpdateLogDelivery",
@@ -180,10 +244,12 @@ def create_iam_roles():
         else:
             print(f"Error creating Step Functions role: {e}")
 
-def create_zip_file(file_path, zip_name):
-    """Lambda用ZIPファイル作成"""
+def create_zip_file(file_path, zip_name, extra_files=None):
+    """Lambda用ZIPファイル作成（共通モジュールはZIP直下に同梱）"""
     with zipfile.ZipFile(zip_name, 'w') as zip_file:
         zip_file.write(file_path, os.path.basename(file_path))
+        for extra_file in extra_files or []:
+            zip_file.write(extra_file, os.path.basename(extra_file))
     return zip_name
 
 def deploy_lambda_functions():
@@ -203,26 +269,42 @@ def deploy_lambda_functions():
             'name': PREVALIDATE_LAMBDA,
             'file': 'lambda_prevalidate.py',
             'handler': 'lambda_prevalidate.lambda_handler',
-            'env_vars': {}
+            'env_vars': {
+                'STAGING_BUCKET': STAGING_BUCKET
+            }
+        },
+        {
+            'name': CSV2PARQUET_LAMBDA,
+            'file': 'lambda_csv_to_parquet.py',
+            'handler': 'lambda_csv_to_parquet.lambda_handler',
+            'env_vars': {},
+            'layers': [PYARROW_LAYER_ARN],
+            'memory': 1024
         },
         {
             'name': REDSHIFT_LAMBDA,
             'file': 'lambda_redshift_load.py', 
             'handler': 'lambda_redshift_load.lambda_handler',
-            'env_vars': {}
+            'extra_files': ['etl_poller.py', 'map_results_reader.py', 'json_stream.py'],
+            'env_vars': {
+                'STAGING_BUCKET': STAGING_BUCKET
+            }
         },
         {
             'name': FINALIZE_LAMBDA,
             'file': 'lambda_finalize.py',
             'handler': 'lambda_finalize.lambda_handler',
-            'env_vars': {}
+            'extra_files': ['map_results_reader.py', 'json_stream.py'],
+            'env_vars': {
+                'STAGING_BUCKET': STAGING_BUCKET
+            }
         }
     ]
     
     lambda_role_arn = f"arn:aws:iam::{ACCOUNT_ID}:role/{APP_NAME}-{STAGE}-lambda-role"
     
     for config in lambda_configs:
-        zip_file = create_zip_file(config['file'], f"{config['name']}.zip")
+        zip_file = create_zip_file(config['file'], f"{config['name']}.zip", config.get('extra_files'))
         
         try:
             # Lambda関数作成
@@ -235,10 +317,11 @@ def deploy_lambda_functions():
                     Code={'ZipFile': zip_content.read()},
                     Environment={'Variables': config['env_vars']},
                     Timeout=300,
-                    MemorySize=256
+                    MemorySize=config.get('memory', 256),
+                    Layers=config.get('layers', [])
                 )
             print(f"Created Lambda function: {config['name']}")
-            
+        
         except Exception as e:
             if "Function already exist" in str(e):
                 # 既存の場合は更新
@@ -254,6 +337,28 @@ def deploy_lambda_functions():
         # ZIPファイル削除
         os.remove(zip_file)
 
+def update_step_function_lambdas():
+    """Step Functions 2/3 のLambdaコード更新（補助・共通モジュールを同梱したZIP）"""
+    for bundle in STEP_FUNCTION_LAMBDA_BUNDLES:
+        zip_file = create_zip_file(
+            os.path.join(REPO_ROOT, bundle['file']),
+            f"{bundle['name']}.zip",
+            [os.path.join(REPO_ROOT, path) for path in bundle['extra_files']]
+        )
+        
+        try:
+            with open(zip_file, 'rb') as zip_content:
+                lambda_client.update_function_code(
+                    FunctionName=bundle['name'],
+                    ZipFile=zip_content.read()
+                )
+            print(f"Updated Lambda function: {bundle['name']}")
+        except Exception as e:
+            print(f"Error updating Lambda {bundle['name']}: {e}")
+        
+        # ZIPファイル削除
+        os.remove(zip_file)
+
 def create_log_group():
     """CloudWatch Log Group作成"""
     try:
@@ -288,7 +393,7 @@ def setup_log_subscription():
         )
         
         print(f"Created log subscription from {LOG_GROUP} to {MONITORING_LAMBDA}")
-        
+    
     except Exception as e:
         print(f"Error setting up log subscription: {e}")
 
@@ -303,6 +408,7 @@ def deploy_step_functions():
     # ARNを実際の値に置換
     definition = definition.replace('etl-observer-dev-prevalidate', PREVALIDATE_LAMBDA)
     definition = definition.replace('etl-observer-dev-redshift-load', REDSHIFT_LAMBDA)
+    definition = definition.replace('etl-observer-dev-csv2parquet', CSV2PARQUET_LAMBDA)
     definition = definition.replace('etl-observer-dev-finalize', FINALIZE_LAMBDA)
     definition = definition.replace('glue-etl-observer-dev-csv2parquet', GLUE_JOB_NAME)
     
@@ -325,7 +431,7 @@ def deploy_step_functions():
             }
         )
         print(f"Created Step Functions: {STEP_FUNCTION_NAME}")
-        
+    
     except Exception as e:
         if "already exists" in str(e):
             print(f"Step Functions already exists: {STEP_FUNCTION_NAME}")
@@ -348,6 +454,7 @@ def main():
     time.sleep(10)
     
     deploy_lambda_functions()
+    update_step_function_lambdas()
     create_log_group()
     setup_log_subscription()
     deploy_step_functions()
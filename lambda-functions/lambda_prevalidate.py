@@ -8,12 +8,23 @@ from datetime import datetime
 
 s3 = boto3.client('s3')
 
+STAGING_BUCKET = os.environ.get('STAGING_BUCKET', 'etl-observer-dev-staging')
+# この値未満のファイルはGlueではなくLambda(pyarrow)で変換（既定0: 無効、redshift.column_types の指定も必要）
+SMALL_FILE_THRESHOLD_BYTES = int(os.environ.get('SMALL_FILE_THRESHOLD_BYTES', '0'))
+
 def lambda_handler(event, context):
     """
     CSVファイルの存在確認とバリデーション
     """
     batch_id = event.get('batch_id')
     files = event.get('files', [])
+    dataset = event.get('dataset', 'unknown')
+    # per_file: ファイルごとにGlueジョブ起動 / manifest: 1ジョブで全ファイル変換
+    convert_mode = event.get('convert_mode', 'per_file')
+    small_file_threshold = int(event.get('small_file_threshold_bytes', SMALL_FILE_THRESHOLD_BYTES))
+    # Lambda変換は型推論を行わないため、明示的な列型がない場合はGlueで変換
+    if not (event.get('redshift') or {}).get('column_types'):
+        small_file_threshold = 0
     
     validated_files = []
     errors = []
@@ -43,7 +54,8 @@ def lambda_handler(event, context):
                 validated_files.append({
                     **file_input,
                     'file_size': file_size,
-                    'last_modified': response['LastModified'].isoformat()
+                    'last_modified': response['LastModified'].isoformat(),
+                    'converter': select_converter(file_size, convert_mode, small_file_threshold)
                 })
                 
             except Exception as e:
@@ -51,6 +63,15 @@ def lambda_handler(event, context):
         
         success = len(errors) == 0 and len(validated_files) > 0
         
+        # マニフェストモードではGlue変換対象をまとめて1ファイルに書き出す
+        glue_manifest = None
+        manifest_files = [f for f in validated_files if f['converter'] == 'manifest']
+        if manifest_files:
+            glue_manifest = write_glue_manifest(batch_id, dataset, manifest_files)
+        
+        # Mapの入力はS3から読み込ませる（ファイル一覧をステートに載せない）
+        validated_files_manifest = write_validated_files(batch_id, validated_files)
+        
         # 証跡情報
         evidence = {
             "batch_id": batch_id,
@@ -63,7 +84,9 @@ def lambda_handler(event, context):
             },
             "output": {
                 "validated_files": len(validated_files),
-                "errors": errors
+                "errors": errors,
+                "convert_mode": convert_mode,
+                "lambda_converted_files": len([f for f in validated_files if f['converter'] == 'lambda'])
             },
             "load": {},
             "ok": success,
@@ -71,14 +94,19 @@ def lambda_handler(event, context):
             "note": f"Validated {len(validated_files)} files, {len(errors)} errors"
         }
         
-        return {
+        result = {
             'statusCode': 200,
             'batch_id': batch_id,
-            'validated_files': validated_files,
+            'input_file_count': len(files),
+            'validated_files_manifest': validated_files_manifest,
             'validation_errors': errors,
             'success': success,
             'evidence': evidence
         }
+        if glue_manifest:
+            result['glue_manifest'] = glue_manifest
+        
+        return result
         
     except Exception as e:
         error_evidence = {
@@ -92,5 +120,58 @@ def lambda_handler(event, context):
         return {
             'statusCode': 500,
             'error': str(e),
+            'validated_files': [],
             'evidence': error_evidence
-        }
\ No newline at end of file
+        }
+
+def select_converter(file_size, convert_mode, small_file_threshold):
+    """ファイルサイズから変換経路を決定"""
+    if small_file_threshold > 0 and file_size < small_file_threshold:
+        return 'lambda'
+    return 'manifest' if convert_mode == 'manifest' else 'glue'
+
+def write_validated_files(batch_id, validated_files):
+    """検証済みファイル一覧（Distributed MapのItemReader用JSON配列）をS3に保存"""
+    key = f"manifests/{batch_id}/validated_files.json"
+    s3.put_object(
+        Bucket=STAGING_BUCKET,
+        Key=key,
+        Body=json.dumps(validated_files, ensure_ascii=False).encode('utf-8'),
+        ContentType='application/json'
+    )
+    
+    return {
+        'bucket': STAGING_BUCKET,
+        'key': key,
+        'file_count': len(validated_files)
+    }
+
+def write_glue_manifest(batch_id, dataset, files):
+    """Glueマニフェストモード用の変換対象一覧をS3に保存"""
+    manifest_key = f"manifests/{batch_id}/glue_manifest.json"
+    manifest = {
+        'batch_id': batch_id,
+        'dataset': dataset,
+        'files': [
+            {
+                'key': f['key'],
+                'src_s3_uri': f"s3://{f['bucket']}/{f['key']}",
+                'dst_s3_uri': f"s3://{STAGING_BUCKET}/parquet/{dataset}/{f['key']}",
+                # ファイル別の変換結果（Mapの各ファイルが参照、単一ファイルモードと同じパス）
+                'results_s3_uri': f"s3://{STAGING_BUCKET}/glue-results/{batch_id}/{f['key']}.json"
+            }
+            for f in files
+        ]
+    }
+    
+    s3.put_object(
+        Bucket=STAGING_BUCKET,
+        Key=manifest_key,
+        Body=json.dumps(manifest, ensure_ascii=False).encode('utf-8'),
+        ContentType='application/json'
+    )
+    
+    return {
+        'manifest_s3_uri': f"s3://{STAGING_BUCKET}/{manifest_key}",
+        'file_count': len(files)
+    }
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""
+ステータスポーリング共通ライブラリ
+Redshift Data API / Athena / Glue Crawler 等の完了待ちで共用
+
+- 指数バックオフ＋ジッター（短い処理は早く検知し、長い処理はAPI呼び出しを抑える）
+- Lambdaの残り実行時間（context.get_remaining_time_in_millis）を考慮した待機上限
+- 複数IDをまとめて問い合わせできるAPI向けの一括ポーリング
+- 待機ごとのレイテンシ・ポーリング回数を記録（チューニング用）
+"""
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# 残り時間から差し引く後処理用の余裕（秒）
+DEFAULT_SAFETY_MARGIN_SECONDS = 10
+
+# Lambdaは1コンテナで同時に1リクエストのみ処理するため、呼び出し単位の状態をモジュールで保持
+_lambda_context = None
+_wait_stats: List[Dict[str, Any]] = []
+
+class PollTimeout(Exception):
+    """待機上限（指定時間またはLambda残り時間）に到達"""
+
+def bind_context(context) -> None:
+    """ハンドラ先頭で呼び出し、Lambda残り時間と待機統計を呼び出し単位でリセット"""
+    global _lambda_context
+    _lambda_context = context
+    _wait_stats.clear()
+
+def get_wait_stats() -> List[Dict[str, Any]]:
+    """この呼び出しで行った待機の統計一覧"""
+    return list(_wait_stats)
+
+def _deadline(max_wait_seconds: Optional[float], safety_margin_seconds: float) -> float:
+    """指定待機時間とLambda残り時間の早い方を期限とする"""
+    now = time.monotonic()
+    deadlines = []
+    if max_wait_seconds is not None:
+        deadlines.append(now + max_wait_seconds)
+    if _lambda_context is not None:
+        remaining = _lambda_context.get_remaining_time_in_millis() / 1000
+        deadlines.append(now + max(0.0, remaining - safety_margin_seconds))
+    return min(deadlines) if deadlines else float('inf')
+
+def _next_interval(interval: float, max_interval: float, backoff_rate: float) -> float:
+    return min(max_interval, interval * backoff_rate)
+
+def _jittered(interval: float) -> float:
+    """同時実行時に問い合わせが揃わないよう待機時間を揺らす（equal jitter）"""
+    return interval / 2 + random.uniform(0, interval / 2)
+
+def _record(label: str, polls: int, started: float, state: Any, timed_out: bool) -> Dict[str, Any]:
+    stats = {
+        'label': label,
+        'polls': polls,
+        'latency_ms': int((time.monotonic() - started) * 1000),
+        'final_state': state,
+        'timed_out': timed_out
+    }
+    _wait_stats.append(stats)
+    print(f"待機完了 [{label}]: {stats['latency_ms']}ms, {polls}回ポーリング, 状態={state}")
+    return stats
+
+def poll_until(fetch_status: Callable[[], Any],
+               is_done: Callable[[Any], bool],
+               label: str = 'poll',
+               initial_interval: float = 1.0,
+               max_interval: float = 30.0,
+               backoff_rate: float = 1.6,
+               max_wait_seconds: Optional[float] = 300,
+               safety_margin_seconds: float = DEFAULT_SAFETY_MARGIN_SECONDS,
+               get_state: Callable[[Any], Any] = lambda status: status) -> Dict[str, Any]:
+    """
+    fetch_status() の結果が is_done を満たすまで待機
+    戻り値: {'status': 最後の応答, 'stats': 待機統計}
+    期限到達時は PollTimeout
+    """
+    started = time.monotonic()
+    deadline = _deadline(max_wait_seconds, safety_margin_seconds)
+    interval = initial_interval
+    polls = 0
+    
+    while True:
+        status = fetch_status()
+        polls += 1
+        
+        if is_done(status):
+            return {'status': status, 'stats': _record(label, polls, started, get_state(status), False)}
+        
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            stats = _record(label, polls, started, get_state(status), True)
+            raise PollTimeout(f"{label}: timeout after {stats['latency_ms'] / 1000:.1f} seconds")
+        
+        time.sleep(min(_jittered(interval), remaining))
+        interval = _next_interval(interval, max_interval, backoff_rate)
+
+def poll_many(ids: List[str],
+              fetch_statuses: Callable[[List[str]], Dict[str, Any]],
+              is_done: Callable[[Any], bool],
+              label: str = 'poll_many',
+              batch_size: int = 50,
+              initial_interval: float = 1.0,
+              max_interval: float = 30.0,
+              backoff_rate: float = 1.6,
+              max_wait_seconds: Optional[float] = 300,
+              safety_margin_seconds: float = DEFAULT_SAFETY_MARGIN_SECONDS,
+              get_state: Callable[[Any], Any] = lambda status: status) -> Dict[str, Any]:
+    """
+    複数IDを一括APIでまとめてポーリング（例: Athena batch_get_query_execution）
+    fetch_statuses(ids) は {id: status} を返すこと（1回あたり最大batch_size件）
+    戻り値: {'statuses': {id: 最後の応答}, 'pending': 未完了ID一覧, 'stats': 待機統計}
+    期限到達時は未完了IDをpendingに残して返却（例外にしない）
+    """
+    started = time.monotonic()
+    deadline = _deadline(max_wait_seconds, safety_margin_seconds)
+    interval = initial_interval
+    polls = 0
+    statuses: Dict[str, Any] = {}
+    pending = list(ids)
+    
+    while pending:
+        for i in range(0, len(pending), batch_size):
+            statuses.update(fetch_statuses(pending[i:i + batch_size]))
+            polls += 1
+        pending = [i for i in pending if not is_done(statuses.get(i))]
+        
+        if not pending:
+            break
+        
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        
+        time.sleep(min(_jittered(interval), remaining))
+        interval = _next_interval(interval, max_interval, backoff_rate)
+    
+    states = [get_state(statuses[i]) for i in ids if i in statuses]
+    stats = _record(label, polls, started, states, bool(pending))
+    stats['items'] = len(ids)
+    return {'statuses': statuses, 'pending': pending, 'stats': stats}
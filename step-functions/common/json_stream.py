@@ -0,0 +1,115 @@
+"""
+JSONストリーム読み込み共通ライブラリ
+大きなJSON配列を全体読み込みせず、要素単位で逐次デコード
+
+- トップレベル配列: [ {...}, {...} ]
+- オブジェクト内の配列: { "items": [ {...}, ... ], ... }  （array_keyで指定）
+メモリ使用量は「最大要素サイズ＋チャンクサイズ」程度に収まる
+"""
+import json
+from typing import Any, Iterator, Optional
+
+# ストリームから一度に読み込むバイト数
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+
+# 値の直後に現れうる区切り文字
+_VALUE_TERMINATORS = ' \t\r\n,]}:'
+
+class _StreamReader:
+    """バイトストリームをUTF-8テキストとして必要な分だけバッファリング"""
+    
+    def __init__(self, stream, chunk_size: int):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.pending_bytes = b''
+    
+    def fill(self, size: Optional[int] = None) -> None:
+        chunk = self.stream.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            chunk = b''
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        # マルチバイト文字がチャンク境界で分断されないよう未完成バイトを持ち越す
+        data = self.pending_bytes + chunk
+        try:
+            text = data.decode('utf-8')
+            self.pending_bytes = b''
+        except UnicodeDecodeError as e:
+            if self.eof:
+                raise
+            text = data[:e.start].decode('utf-8')
+            self.pending_bytes = data[e.start:]
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+    
+    def peek(self, skip: str = ' \t\r\n') -> Optional[str]:
+        """区切り文字を読み飛ばして次の文字を返す（終端ならNone）"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in skip:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return None
+            self.fill()
+    
+    def expect(self, char: str, skip: str = ' \t\r\n') -> None:
+        found = self.peek(skip)
+        if found != char:
+            raise ValueError(f"Expected '{char}' in JSON stream, found {found!r}")
+        self.pos += 1
+    
+    def decode_value(self) -> Any:
+        """現在位置の値を1つデコード（境界をまたぐ場合は追加読み込み）"""
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                # 大きな要素で再デコードが繰り返されないよう、読み込み量を倍々に増やす
+                self.fill(max(self.chunk_size, len(self.buffer) - self.pos))
+                continue
+            
+            # 数値が境界で途切れている可能性があるため、直後の区切り文字が読めるまで待つ
+            if (end >= len(self.buffer) or self.buffer[end] not in _VALUE_TERMINATORS) and not self.eof:
+                self.fill()
+                continue
+            
+            self.pos = end
+            return value
+
+def iter_json_array(stream, chunk_size: int = DEFAULT_CHUNK_SIZE, array_key: Optional[str] = None) -> Iterator[Any]:
+    """
+    JSON配列をストリームから1要素ずつ取得
+    array_key指定時はトップレベルオブジェクトの該当キーの配列を対象とする
+    （配列より前にある他のキーの値は都度デコードして読み捨て。トップレベルが配列ならそのまま対象）
+    """
+    reader = _StreamReader(stream, chunk_size)
+    
+    if array_key is not None and reader.peek() == '{':
+        reader.expect('{')
+        while True:
+            if reader.peek(' \t\r\n,') in ['}', None]:
+                return
+            key = reader.decode_value()
+            reader.expect(':')
+            reader.peek()
+            if key == array_key:
+                break
+            reader.decode_value()
+    
+    reader.expect('[')
+    while True:
+        next_char = reader.peek(' \t\r\n,')
+        if next_char is None:
+            raise ValueError('Unexpected end of JSON array')
+        if next_char == ']':
+            return
+        yield reader.decode_value()
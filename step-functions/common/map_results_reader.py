@@ -0,0 +1,44 @@
+"""
+Map結果読み込み共通ライブラリ
+Distributed MapのResultWriterがS3へ書き出した結果を一定メモリで逐次読み込み
+
+- 従来のインラインMap結果（リスト）とResultWriterDetailsの両方に対応
+- 結果ファイル（JSON配列）を全体読み込みせず、要素単位でデコード（json_stream）
+"""
+import json
+from typing import Any, Dict, Iterator
+from json_stream import iter_json_array
+
+def iter_map_results(map_results: Any, s3_client) -> Iterator[Dict[str, Any]]:
+    """
+    Map結果を1件ずつ取得
+    - リスト: 従来のインライン結果をそのまま返却
+    - ResultWriterDetails: manifest.json に列挙された結果ファイルを順に読み込み
+      成功した子実行は出力を、失敗した子実行は入力にmap_errorを付けて返却
+    """
+    if isinstance(map_results, list):
+        yield from map_results
+        return
+    
+    details = (map_results or {}).get('ResultWriterDetails')
+    if not details:
+        return
+    
+    bucket = details['Bucket']
+    manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=details['Key'])['Body'].read())
+    result_files = manifest.get('ResultFiles', {})
+    
+    for status in ['SUCCEEDED', 'FAILED']:
+        for result_file in result_files.get(status, []):
+            body = s3_client.get_object(Bucket=bucket, Key=result_file['Key'])['Body']
+            for execution in iter_json_array(body):
+                if status == 'SUCCEEDED':
+                    yield json.loads(execution.get('Output') or '{}')
+                else:
+                    yield {
+                        **json.loads(execution.get('Input') or '{}'),
+                        'map_error': {
+                            'error': execution.get('Error', ''),
+                            'cause': execution.get('Cause', '')
+                        }
+                    }
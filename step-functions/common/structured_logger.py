@@ -0,0 +1,138 @@
+"""
+構造化ログ共通ライブラリ
+ハンドラの入力イベント等を、ペイロードサイズに依存しない要約（キー名・リスト件数・先頭数件のサンプル）として
+1行JSONで出力（イベント全体をjson.dumpsしない）
+
+環境変数:
+- LOG_LEVEL: DEBUG / INFO / WARNING / ERROR（既定: INFO）
+- LOG_MAX_BYTES: 1行あたりの最大バイト数（既定: 4096、超過分は切り詰め）
+- LOG_SAMPLE_ITEMS: 要約に含めるリスト要素のサンプル件数（既定: 3）
+- LOG_DEBUG_SAMPLE_RATE: 呼び出しのうちDEBUGレベルで出力する割合（0〜1、既定: 0）
+"""
+import json
+import os
+import random
+from datetime import datetime
+from typing import Any, Dict
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', '4096'))
+LOG_SAMPLE_ITEMS = int(os.environ.get('LOG_SAMPLE_ITEMS', '3'))
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', '0'))
+
+# 要約の上限（ネストの深さ・dictのキー数・文字列長）
+SUMMARY_MAX_DEPTH = 4
+SUMMARY_MAX_KEYS = 30
+SUMMARY_MAX_STRING = 200
+
+def summarize(value: Any, depth: int = 0, sample_items: int = LOG_SAMPLE_ITEMS) -> Any:
+    """
+    値の要約（処理量は要約の上限のみで決まり、リスト件数や文字列長には比例しない）
+    - list/tuple: {"__len__": 件数, "sample": 先頭sample_items件の要約}
+    - dict: 先頭SUMMARY_MAX_KEYS個のキーの要約（超過時は "__keys__" に総キー数）
+    - str/bytes: SUMMARY_MAX_STRING文字まで
+    """
+    if isinstance(value, (list, tuple)):
+        if depth >= SUMMARY_MAX_DEPTH:
+            return {'__len__': len(value)}
+        return {
+            '__len__': len(value),
+            'sample': [summarize(item, depth + 1, sample_items) for item in value[:sample_items]]
+        }
+    if isinstance(value, dict):
+        if depth >= SUMMARY_MAX_DEPTH:
+            return {'__keys__': len(value)}
+        summary = {}
+        for index, (key, item) in enumerate(value.items()):
+            if index >= SUMMARY_MAX_KEYS:
+                summary['__keys__'] = len(value)
+                break
+            summary[str(key)] = summarize(item, depth + 1, sample_items)
+        return summary
+    if isinstance(value, (bytes, bytearray)):
+        return f"<{len(value)} bytes>"
+    if isinstance(value, str):
+        if len(value) > SUMMARY_MAX_STRING:
+            return f"{value[:SUMMARY_MAX_STRING]}...<{len(value)} chars>"
+        return value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return summarize(str(value), depth, sample_items)
+
+class StructuredLogger:
+    """1行JSONのロガー（レベル判定後にのみ要約・シリアライズを行う）"""
+    
+    def __init__(self, name: str, level: str = LOG_LEVEL, max_bytes: int = LOG_MAX_BYTES,
+                 debug_sample_rate: float = LOG_DEBUG_SAMPLE_RATE):
+        self.name = name
+        self.base_level = LEVELS.get(level, LEVELS['INFO'])
+        self.level = self.base_level
+        self.max_bytes = max_bytes
+        self.debug_sample_rate = debug_sample_rate
+    
+    def bind_invocation(self) -> None:
+        """ハンドラ先頭で呼び出し、呼び出し単位でDEBUG出力をサンプリング"""
+        self.level = self.base_level
+        if self.debug_sample_rate > 0 and random.random() < self.debug_sample_rate:
+            self.level = LEVELS['DEBUG']
+    
+    def enabled(self, level: str) -> bool:
+        return LEVELS[level] >= self.level
+    
+    def log(self, level: str, message: str, **fields: Any) -> None:
+        if not self.enabled(level):
+            return
+        record = {
+            'level': level,
+            'logger': self.name,
+            'message': message,
+            'ts': datetime.now().isoformat(),
+            **{key: summarize(value) for key, value in fields.items()}
+        }
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        encoded = line.encode('utf-8')
+        if len(encoded) > self.max_bytes:
+            # 切り詰め時もJSONとして読めるよう、要約部分を文字列として格納
+            truncated = encoded[:self.max_bytes].decode('utf-8', errors='ignore')
+            line = json.dumps({
+                'level': level,
+                'logger': self.name,
+                'message': message,
+                'ts': record['ts'],
+                'truncated': truncated,
+                'original_bytes': len(encoded)
+            }, ensure_ascii=False)
+        print(line)
+    
+    def debug(self, message: str, **fields: Any) -> None:
+        self.log('DEBUG', message, **fields)
+    
+    def info(self, message: str, **fields: Any) -> None:
+        self.log('INFO', message, **fields)
+    
+    def warning(self, message: str, **fields: Any) -> None:
+        self.log('WARNING', message, **fields)
+    
+    def error(self, message: str, **fields: Any) -> None:
+        self.log('ERROR', message, **fields)
+    
+    def log_event(self, message: str, event: Any, context=None) -> None:
+        """ハンドラの入力イベントを要約して出力（呼び出し単位のサンプリングもここで確定）"""
+        self.bind_invocation()
+        fields: Dict[str, Any] = {'event': event}
+        request_id = getattr(context, 'aws_request_id', None)
+        if request_id:
+            fields['request_id'] = request_id
+        self.info(message, **fields)
+
+# ロガー名 → ロガー（ウォームスタート時は再利用）
+_loggers: Dict[str, StructuredLogger] = {}
+
+def get_logger(name: str) -> StructuredLogger:
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = StructuredLogger(name)
+        _loggers[name] = logger
+    return logger
@@ -1,11 +1,23 @@
 """
 AWS Glue Job: CSV to Parquet 変換
 証跡ログ出力機能付き
+
+2つの起動モードに対応:
+- 単一ファイル: --src_s3_uri / --dst_s3_uri で1ファイルを変換
+- マニフェスト: --manifest_s3_uri で指定した複数ファイルを1つのSparkセッションで変換
+  （Glue起動コストをバッチ全体で1回に抑える）
+  各ファイルの変換結果はマニフェストの results_s3_uri に1ファイルずつ保存
+  （Step FunctionsのMapはファイルごとにこの結果を読み、失敗したファイルをロードしない）
 """
 import sys
 import json
+import time
 import logging
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import boto3
 from pyspark.context import SparkContext
 from pyspark.sql import SparkSession
 from awsglue.context import GlueContext
@@ -16,92 +28,169 @@ from awsglue.job import Job
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def main():
-    # 引数取得
-    args = getResolvedOptions(sys.argv, [
-        'JOB_NAME',
-        'batch_id',
-        'src_s3_uri',
-        'dst_s3_uri',
-        'dataset_name'
-    ])
-    
-    # Spark/Glue 初期化
-    sc = SparkContext()
-    glue_context = GlueContext(sc)
-    spark = glue_context.spark_session
-    job = Job(glue_context)
-    job.init(args['JOB_NAME'], args)
-    
-    batch_id = args['batch_id']
-    src_s3_uri = args['src_s3_uri']
-    dst_s3_uri = args['dst_s3_uri']
-    dataset_name = args.get('dataset_name', 'unknown')
-    
+s3 = boto3.client('s3')
+
+# マニフェストモードで同時に投入するSparkジョブ数（小さいファイルでexecutorを遊ばせない）
+DEFAULT_MAX_PARALLEL_FILES = 4
+
+def get_optional_args(names):
+    """sys.argvに存在する任意引数のみ取得"""
+    present = [name for name in names if f'--{name}' in sys.argv]
+    return getResolvedOptions(sys.argv, present) if present else {}
+
+def split_s3_uri(s3_uri):
+    """s3://bucket/key をバケットとキーに分解"""
+    parsed = urlparse(s3_uri)
+    return parsed.netloc, parsed.path.lstrip('/')
+
+def load_manifest(manifest_s3_uri):
+    """S3上の変換マニフェスト読み込み"""
+    bucket, key = split_s3_uri(manifest_s3_uri)
+    response = s3.get_object(Bucket=bucket, Key=key)
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+def convert_file(spark, batch_id, dataset_name, src_s3_uri, dst_s3_uri):
+    """1ファイル分のCSV→Parquet変換と証跡作成"""
     input_rows = 0
     output_rows = 0
     error_message = None
     success = True
-    
+    started = time.time()
+
     try:
         logger.info(f"Starting CSV to Parquet conversion: {src_s3_uri} -> {dst_s3_uri}")
-        
+
         # CSV読み込み
         df = spark.read.option("header", "true").option("inferSchema", "true").csv(src_s3_uri)
         input_rows = df.count()
         logger.info(f"Input rows: {input_rows}")
-        
+
         # データ変換処理（必要に応じてここで変換ロジックを追加）
         # 例: 日付フォーマット変更、カラム名正規化、データ型変換など
         processed_df = df
-        
+
         # Parquet出力
         processed_df.write.mode("overwrite").parquet(dst_s3_uri)
-        
+
         # 出力件数確認
         output_df = spark.read.parquet(dst_s3_uri)
         output_rows = output_df.count()
         logger.info(f"Output rows: {output_rows}")
-        
+
         logger.info(f"Successfully converted CSV to Parquet: {output_rows} rows")
-        
+
     except Exception as e:
         success = False
         error_message = str(e)
-        logger.error(f"Error during conversion: {e}", exc_info=True)
-    
-    finally:
-        # 証跡ログ出力（必須）
-        evidence = {
-            "evidence": {
-                "batch_id": batch_id,
-                "test_id": "",
-                "flow": "csv-to-parquet-pipeline",
-                "step": "glue_convert",
-                "input": {
-                    "s3": src_s3_uri,
-                    "rows": input_rows,
-                    "dataset": dataset_name
-                },
-                "output": {
-                    "s3": dst_s3_uri,
-                    "rows": output_rows,
-                    "format": "parquet"
-                },
-                "load": {},
-                "ok": success,
-                "ts": datetime.now().isoformat(),
-                "note": error_message if error_message else f"Converted {input_rows} rows to {output_rows} rows"
-            }
+        logger.error(f"Error during conversion of {src_s3_uri}: {e}", exc_info=True)
+
+    # 証跡ログ出力（必須）
+    evidence = {
+        "evidence": {
+            "batch_id": batch_id,
+            "test_id": "",
+            "flow": "csv-to-parquet-pipeline",
+            "step": "glue_convert",
+            "input": {
+                "s3": src_s3_uri,
+                "rows": input_rows,
+                "dataset": dataset_name
+            },
+            "output": {
+                "s3": dst_s3_uri,
+                "rows": output_rows,
+                "format": "parquet"
+            },
+            "load": {},
+            "ok": success,
+            "ts": datetime.now().isoformat(),
+            "note": error_message if error_message else f"Converted {input_rows} rows to {output_rows} rows"
         }
-        
-        # この行が監視Lambdaに拾われる
-        logger.info("EVIDENCE " + json.dumps(evidence, ensure_ascii=False))
-        
-        job.commit()
-        
-        if not success:
-            raise Exception(f"Glue job failed: {error_message}")
+    }
+
+    # この行が監視Lambdaに拾われる
+    logger.info("EVIDENCE " + json.dumps(evidence, ensure_ascii=False))
+
+    return {
+        **evidence,
+        "duration_ms": int((time.time() - started) * 1000)
+    }
+
+def save_results(results_s3_uri, batch_id, records):
+    """ファイル単位の変換結果をS3へ保存（finalize等の後段が参照）"""
+    bucket, key = split_s3_uri(results_s3_uri)
+    body = {
+        "batch_id": batch_id,
+        "step": "glue_convert",
+        "files": records
+    }
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(body, ensure_ascii=False).encode('utf-8'),
+        ContentType='application/json'
+    )
+    logger.info(f"Saved conversion results to {results_s3_uri}")
+
+def main():
+    # 引数取得
+    args = getResolvedOptions(sys.argv, [
+        'JOB_NAME',
+        'batch_id',
+        'dataset_name'
+    ])
+    args.update(get_optional_args([
+        'src_s3_uri',
+        'dst_s3_uri',
+        'manifest_s3_uri',
+        'results_s3_uri',
+        'max_parallel_files'
+    ]))
+
+    # Spark/Glue 初期化
+    sc = SparkContext()
+    glue_context = GlueContext(sc)
+    spark = glue_context.spark_session
+    job = Job(glue_context)
+    job.init(args['JOB_NAME'], args)
+
+    batch_id = args['batch_id']
+    dataset_name = args.get('dataset_name', 'unknown')
+    manifest_s3_uri = args.get('manifest_s3_uri')
+    results_s3_uri = args.get('results_s3_uri')
+
+    if manifest_s3_uri:
+        manifest = load_manifest(manifest_s3_uri)
+        entries = manifest.get('files', [])
+        max_parallel = int(args.get('max_parallel_files', DEFAULT_MAX_PARALLEL_FILES))
+        logger.info(f"Manifest mode: {len(entries)} files from {manifest_s3_uri} (parallel={max_parallel})")
+
+        def convert_entry(entry):
+            record = convert_file(spark, batch_id, dataset_name, entry['src_s3_uri'], entry['dst_s3_uri'])
+            if entry.get('results_s3_uri'):
+                save_results(entry['results_s3_uri'], batch_id, [record])
+            return record
+
+        # 同一Sparkセッション内で複数ジョブを並行投入
+        with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as executor:
+            records = list(executor.map(convert_entry, entries))
+    else:
+        records = [convert_file(spark, batch_id, dataset_name,
+                                args['src_s3_uri'], args['dst_s3_uri'])]
+
+    failed = [r for r in records if not r['evidence']['ok']]
+
+    if results_s3_uri:
+        save_results(results_s3_uri, batch_id, records)
+
+    if manifest_s3_uri:
+        logger.info(f"Manifest conversion finished: {len(records) - len(failed)}/{len(records)} files succeeded")
+
+    job.commit()
+
+    # マニフェストモードでは一部失敗はファイル単位の証跡で扱い、全滅時のみジョブ失敗
+    if failed and len(failed) == len(records):
+        raise Exception(f"Glue job failed: {failed[0]['evidence']['note']}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
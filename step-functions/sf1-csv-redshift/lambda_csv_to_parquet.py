@@ -0,0 +1,230 @@
+"""
+小容量CSV用 CSV→Parquet 変換Lambda
+Glue起動コストが処理コストを上回る小さなファイルをpyarrowで直接変換
+glue_csv_to_parquet と同じ glue_convert 証跡を出力
+
+型推論は行わず、redshift_config.column_types の明示的な列型で読み込む
+（pyarrowの推論は先頭ブロックのみで、Sparkの inferSchema と型が異なる場合があるため）
+"""
+import os
+import re
+import json
+import time
+import tempfile
+import boto3
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from datetime import datetime
+from urllib.parse import urlparse
+
+s3 = boto3.client('s3')
+
+# 1行グループあたりの行数上限（メモリ使用量の上限にもなる）
+ROW_GROUP_ROWS = int(os.environ.get('ROW_GROUP_ROWS', '100000'))
+# S3ストリームから一度に読み込むCSVブロックサイズ
+READ_BLOCK_SIZE_BYTES = int(os.environ.get('READ_BLOCK_SIZE_BYTES', str(4 * 1024 * 1024)))
+
+# 列型名（Spark / Redshift の表記） → Arrow型
+ARROW_TYPES = {
+    'int': pa.int32(),
+    'integer': pa.int32(),
+    'int4': pa.int32(),
+    'int32': pa.int32(),
+    'smallint': pa.int16(),
+    'int2': pa.int16(),
+    'bigint': pa.int64(),
+    'long': pa.int64(),
+    'int8': pa.int64(),
+    'int64': pa.int64(),
+    'double': pa.float64(),
+    'float8': pa.float64(),
+    'float': pa.float64(),
+    'real': pa.float32(),
+    'float4': pa.float32(),
+    'string': pa.string(),
+    'varchar': pa.string(),
+    'char': pa.string(),
+    'text': pa.string(),
+    'boolean': pa.bool_(),
+    'bool': pa.bool_(),
+    'date': pa.date32(),
+    'timestamp': pa.timestamp('us')
+}
+
+def lambda_handler(event, context):
+    """
+    S3上のCSVをストリーム読み込みしParquetで出力
+    """
+    batch_id = event.get('batch_id')
+    src_s3_uri = event.get('src_s3_uri')
+    dst_s3_uri = event.get('dst_s3_uri')
+    results_s3_uri = event.get('results_s3_uri')
+    dataset_name = event.get('dataset', 'unknown')
+    column_types = (event.get('redshift_config') or {}).get('column_types') or event.get('column_types')
+
+    input_rows = 0
+    output_rows = 0
+    error_message = None
+    success = True
+    started = time.time()
+
+    try:
+        print(f"Starting CSV to Parquet conversion: {src_s3_uri} -> {dst_s3_uri}")
+
+        src_bucket, src_key = split_s3_uri(src_s3_uri)
+        dst_bucket, dst_prefix = split_s3_uri(dst_s3_uri)
+
+        if not column_types:
+            raise ValueError("column_types is required for Lambda conversion (no type inference)")
+
+        # Glue(Spark)出力と同じくプレフィックス配下にパートファイルとして配置
+        dst_key = f"{dst_prefix.rstrip('/')}/part-00000.snappy.parquet"
+
+        with tempfile.NamedTemporaryFile(suffix='.parquet', dir='/tmp') as tmp:
+            input_rows = convert_stream(src_bucket, src_key, tmp.name, column_types)
+
+            # 出力件数確認（フッターのメタデータのみ参照）
+            output_rows = pq.ParquetFile(tmp.name).metadata.num_rows
+
+            # Sparkの mode("overwrite") と同じく、前回実行のパートファイルを削除してから配置
+            clear_prefix(dst_bucket, f"{dst_prefix.rstrip('/')}/")
+            s3.upload_file(tmp.name, dst_bucket, dst_key)
+
+        print(f"Successfully converted CSV to Parquet: {output_rows} rows")
+
+    except Exception as e:
+        success = False
+        error_message = str(e)
+        print(f"Error during conversion: {e}")
+
+    duration_ms = int((time.time() - started) * 1000)
+
+    # 証跡ログ出力（Glueジョブと同一スキーマ）
+    evidence = {
+        "evidence": {
+            "batch_id": batch_id,
+            "test_id": "",
+            "flow": "csv-to-parquet-pipeline",
+            "step": "glue_convert",
+            "input": {
+                "s3": src_s3_uri,
+                "rows": input_rows,
+                "dataset": dataset_name
+            },
+            "output": {
+                "s3": dst_s3_uri,
+                "rows": output_rows,
+                "format": "parquet"
+            },
+            "load": {},
+            "ok": success,
+            "ts": datetime.now().isoformat(),
+            "note": error_message if error_message else f"Converted {input_rows} rows to {output_rows} rows"
+        }
+    }
+
+    print("EVIDENCE " + json.dumps(evidence, ensure_ascii=False))
+
+    if results_s3_uri:
+        save_results(results_s3_uri, batch_id, [{**evidence, "duration_ms": duration_ms}])
+
+    if not success:
+        raise Exception(f"Lambda conversion failed: {error_message}")
+
+    return {
+        'statusCode': 200,
+        'batch_id': batch_id,
+        'JobRunState': 'SUCCEEDED',
+        'converter': 'lambda',
+        'input_rows': input_rows,
+        'output_rows': output_rows,
+        'duration_ms': duration_ms,
+        'evidence': evidence['evidence']
+    }
+
+def arrow_type(type_name):
+    """列型名からArrow型を取得（decimal(p,s) に対応）"""
+    normalized = type_name.strip().lower()
+    match = re.fullmatch(r'(?:decimal|numeric)\s*\(\s*(\d+)\s*,\s*(\d+)\s*\)', normalized)
+    if match:
+        return pa.decimal128(int(match.group(1)), int(match.group(2)))
+    # varchar(256) 等の長さ指定は無視
+    base = normalized.split('(')[0].strip()
+    if base not in ARROW_TYPES:
+        raise ValueError(f"Unsupported column type: {type_name}")
+    return ARROW_TYPES[base]
+
+def build_schema(column_names, column_types):
+    """CSVヘッダーの列順で明示的なスキーマを作成（型指定のない列はエラー）"""
+    missing = [name for name in column_names if name not in column_types]
+    if missing:
+        raise ValueError(f"column_types has no type for columns: {missing}")
+    return pa.schema([(name, arrow_type(column_types[name])) for name in column_names])
+
+def convert_stream(bucket, key, output_path, column_types):
+    """
+    CSVをブロック単位で読み込み、行グループ上限ごとにParquetへ書き出す
+    戻り値: 入力行数
+    """
+    response = s3.get_object(Bucket=bucket, Key=key)
+    reader = pacsv.open_csv(
+        pa.PythonFile(response['Body'], mode='r'),
+        read_options=pacsv.ReadOptions(block_size=READ_BLOCK_SIZE_BYTES),
+        convert_options=pacsv.ConvertOptions(
+            column_types={name: arrow_type(type_name) for name, type_name in column_types.items()}
+        )
+    )
+
+    # 全列が column_types で変換されるため、各バッチのスキーマはこのスキーマと一致
+    schema = build_schema(reader.schema.names, column_types)
+    writer = pq.ParquetWriter(output_path, schema, compression='snappy')
+    pending = []
+    pending_rows = 0
+    total_rows = 0
+
+    try:
+        for batch in reader:
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            total_rows += batch.num_rows
+
+            if pending_rows >= ROW_GROUP_ROWS:
+                writer.write_table(pa.Table.from_batches(pending), row_group_size=ROW_GROUP_ROWS)
+                pending = []
+                pending_rows = 0
+
+        if pending:
+            writer.write_table(pa.Table.from_batches(pending), row_group_size=ROW_GROUP_ROWS)
+    finally:
+        writer.close()
+
+    return total_rows
+
+def clear_prefix(bucket, prefix):
+    """出力プレフィックス配下の既存オブジェクトを削除"""
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if objects:
+            s3.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+
+def split_s3_uri(s3_uri):
+    """s3://bucket/key をバケットとキーに分解"""
+    parsed = urlparse(s3_uri)
+    return parsed.netloc, parsed.path.lstrip('/')
+
+def save_results(results_s3_uri, batch_id, records):
+    """ファイル単位の変換結果をS3へ保存（Glueジョブと同一形式）"""
+    bucket, key = split_s3_uri(results_s3_uri)
+    body = {
+        "batch_id": batch_id,
+        "step": "glue_convert",
+        "files": records
+    }
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(body, ensure_ascii=False).encode('utf-8'),
+        ContentType='application/json'
+    )
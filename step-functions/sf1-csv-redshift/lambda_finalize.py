@@ -1,72 +1,121 @@
 """
 ETL最終処理Lambda - バッチ全体のサマリ作成
+Map結果（インライン／ResultWriterによるS3出力）を1件ずつ読み込み、一定メモリで集計
 """
 import json
+import os
+import heapq
+import tempfile
 import boto3
 from datetime import datetime
+from map_results_reader import iter_map_results
+
+s3 = boto3.client('s3')
+
+STAGING_BUCKET = os.environ.get('STAGING_BUCKET', 'etl-observer-dev-staging')
+# サマリに列挙する低速ファイル数
+SLOWEST_FILES_LIMIT = int(os.environ.get('SLOWEST_FILES_LIMIT', '5'))
+# サマリに直接載せるファイル別統計・失敗の上限（全件はS3のファイル別統計を参照）
+INLINE_FILE_STATS_LIMIT = int(os.environ.get('INLINE_FILE_STATS_LIMIT', '100'))
+INLINE_FAILURES_LIMIT = int(os.environ.get('INLINE_FAILURES_LIMIT', '100'))
 
 def lambda_handler(event, context):
     """
     バッチ処理の最終まとめ
     """
     batch_id = event.get('batch_id')
-    files = event.get('files', [])
     map_results = event.get('map_results', [])
     prevalidate_result = event.get('prevalidate_result', {})
+    batch_load_result = event.get('batch_load_result', {})
     
     # 集計処理
-    total_input_files = len(files)
+    total_input_files = 0
+    processed_files = 0
     successful_conversions = 0
     successful_loads = 0
     total_input_rows = 0
     total_output_rows = 0
     total_loaded_rows = 0
     failures = []
+    failure_count = 0
     
     try:
-        for result in map_results:
-            # Glue結果チェック
-            if 'glue_result' in result and result['glue_result'].get('JobRunState') == 'SUCCEEDED':
-                successful_conversions += 1
-            else:
-                failures.append({
-                    'step': 'glue_convert',
-                    'file': result.get('key', 'unknown'),
-                    'error': result.get('glue_result', {}).get('ErrorMessage', 'Glue job failed')
-                })
-            
-            # Redshift結果チェック
-            if 'redshift_result' in result:
-                redshift_payload = result['redshift_result'].get('Payload', {})
-                if isinstance(redshift_payload, str):
-                    redshift_payload = json.loads(redshift_payload)
+        batch_payload = parse_payload(batch_load_result)
+        batch_files = load_batch_files(batch_payload)
+        throughput = new_throughput()
+        inline_file_stats = []
+        
+        with tempfile.NamedTemporaryFile('w+', suffix='.jsonl', dir='/tmp', encoding='utf-8') as stats_file:
+            for result in iter_map_results(map_results, s3):
+                processed_files += 1
+                file_key = get_file_key(result)
+                result_evidence = result.get('evidence', {})
                 
-                if redshift_payload.get('success'):
-                    successful_loads += 1
-                    total_loaded_rows += redshift_payload.get('inserted_rows', 0)
+                # 変換結果チェック
+                if result.get('glue_result', {}).get('JobRunState') == 'SUCCEEDED':
+                    successful_conversions += 1
+                elif result_evidence.get('step') == 'redshift_load':
+                    # ロード失敗時はイテレーション状態が証跡で置き換わるが、変換は成功済み
+                    successful_conversions += 1
+                    failure_count += add_failure(failures, 'redshift_load', file_key,
+                                                 result_evidence.get('error') or 'Redshift load failed')
                 else:
-                    failures.append({
-                        'step': 'redshift_load',
-                        'file': result.get('key', 'unknown'),
-                        'error': redshift_payload.get('error', 'Redshift load failed')
-                    })
+                    error = (result.get('glue_result', {}).get('ErrorMessage') or
+                             result_evidence.get('error') or
+                             result.get('map_error', {}).get('cause') or
+                             'Glue job failed')
+                    failure_count += add_failure(failures, 'glue_convert', file_key, error)
+                
+                # Redshift結果チェック
+                if 'redshift_result' in result:
+                    redshift_payload = parse_payload(result['redshift_result'])
+                    
+                    if redshift_payload.get('success'):
+                        successful_loads += 1
+                        total_loaded_rows += redshift_payload.get('inserted_rows', 0)
+                    else:
+                        failure_count += add_failure(failures, 'redshift_load', file_key,
+                                                     redshift_payload.get('error', 'Redshift load failed'))
+                
+                # ファイル別スループット統計
+                file_stat = build_file_stat(result, batch_files)
+                total_input_rows += file_stat['input_rows'] or 0
+                total_output_rows += file_stat['output_rows'] or 0
+                add_throughput(throughput, file_stat)
+                stats_file.write(json.dumps(file_stat, ensure_ascii=False) + '\n')
+                if len(inline_file_stats) < INLINE_FILE_STATS_LIMIT:
+                    inline_file_stats.append(file_stat)
+            
+            stats_file.flush()
+            file_stats_s3_uri = save_file_stats(batch_id, stats_file.name) if processed_files else None
         
         # プリバリデーション結果から統計取得
-        prevalidate_payload = prevalidate_result.get('Payload', {})
-        if isinstance(prevalidate_payload, str):
-            prevalidate_payload = json.loads(prevalidate_payload)
+        prevalidate_payload = parse_payload(prevalidate_result)
+        
+        # 入力ファイル数はプリバリデーションの件数（無い場合はMap結果件数）を母数とする
+        total_input_files = prevalidate_payload.get('input_file_count') or processed_files
+        
+        # バッチ単位ロード（load_scope=batch）の結果チェック
+        if batch_load_result:
+            if batch_payload.get('success'):
+                # パートファイルがあり、明細で0行と判明していないファイルのみロード済みとする
+                # （内訳を読み込めなかった場合のみCOPY対象のファイル数を使用）
+                if batch_files:
+                    successful_loads += sum(1 for file_load in batch_files.values() if is_file_loaded(file_load))
+                else:
+                    successful_loads += batch_payload.get('file_count', len(batch_payload.get('files', [])))
+                total_loaded_rows += batch_payload.get('inserted_rows', 0)
+            else:
+                failure_count += add_failure(failures, 'redshift_load', 'batch',
+                                             batch_payload.get('error') or batch_load_result.get('Cause', 'Redshift batch load failed'))
         
         validation_errors = prevalidate_payload.get('validation_errors', [])
         if validation_errors:
             for error in validation_errors:
-                failures.append({
-                    'step': 'prevalidate',
-                    'file': 'validation',
-                    'error': error
-                })
+                failure_count += add_failure(failures, 'prevalidate', 'validation', error)
         
         # 全体成功判定
-        overall_success = (len(failures) == 0 and 
+        overall_success = (failure_count == 0 and
                           successful_conversions == total_input_files and
                           successful_loads == total_input_files)
         
@@ -83,7 +132,8 @@ def lambda_handler(event, context):
             "output": {
                 "successful_conversions": successful_conversions,
                 "successful_loads": successful_loads,
-                "total_failures": len(failures)
+                "total_failures": failure_count,
+                "rows": total_output_rows
             },
             "load": {
                 "table": "consolidated_summary",
@@ -93,7 +143,7 @@ def lambda_handler(event, context):
             },
             "ok": overall_success,
             "ts": datetime.now().isoformat(),
-            "note": f"Finalized batch {batch_id}: {successful_conversions} conversions, {successful_loads} loads, {len(failures)} failures"
+            "note": f"Finalized batch {batch_id}: {successful_conversions} conversions, {successful_loads} loads, {failure_count} failures"
         }
         
         # 詳細サマリ
@@ -107,9 +157,14 @@ def lambda_handler(event, context):
                 "total_input_rows": total_input_rows,
                 "total_output_rows": total_output_rows,
                 "total_loaded_rows": total_loaded_rows,
-                "failure_count": len(failures)
+                "failure_count": failure_count,
+                **summarize_throughput(throughput),
+                "files": inline_file_stats,
+                "files_truncated": processed_files > len(inline_file_stats),
+                "file_stats_s3_uri": file_stats_s3_uri
             },
             "failures": failures,
+            "failures_truncated": failure_count > len(failures),
             "completed_at": datetime.now().isoformat()
         }
         
@@ -122,7 +177,7 @@ def lambda_handler(event, context):
             'summary': summary,
             'evidence': evidence
         }
-        
+    
     except Exception as e:
         error_evidence = {
             "batch_id": batch_id,
@@ -137,4 +192,156 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'error': str(e),
             'evidence': error_evidence
-        }
\ No newline at end of file
+        }
+
+def parse_payload(result):
+    """Lambda呼び出し結果のPayload取得（文字列の場合はJSONとして解釈）"""
+    payload = (result or {}).get('Payload', {})
+    if isinstance(payload, str):
+        payload = json.loads(payload)
+    return payload or {}
+
+def get_file_key(result):
+    """Map結果から対象ファイルを特定（失敗時は証跡の入力S3 URI）"""
+    if result.get('file_input', {}).get('key'):
+        return result['file_input']['key']
+    return result.get('evidence', {}).get('input', {}).get('s3', 'unknown')
+
+def add_failure(failures, step, file_key, error):
+    """失敗を記録（サマリに載せるのは上限まで）。戻り値: 失敗件数の増分"""
+    if len(failures) < INLINE_FAILURES_LIMIT:
+        failures.append({
+            'step': step,
+            'file': file_key,
+            'error': error
+        })
+    return 1
+
+def load_batch_files(batch_payload):
+    """バッチ単位ロードのファイル別内訳（件数が多い場合はS3保存分を読み込み）"""
+    file_loads = batch_payload.get('files', [])
+    files_s3_uri = batch_payload.get('files_s3_uri')
+    
+    if files_s3_uri:
+        try:
+            bucket, key = files_s3_uri[len('s3://'):].split('/', 1)
+            file_loads = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+        except Exception as e:
+            print(f"Batch load file breakdown not available: {e}")
+    
+    return {
+        file_load['file']: {
+            'rows': file_load.get('rows'),
+            'bytes': file_load.get('bytes'),
+            'parts': file_load.get('parts')
+        }
+        for file_load in file_loads
+    }
+
+def is_file_loaded(file_load):
+    """バッチ単位ロードで行が割り当てられたファイルか（rows未集計の場合はパートファイルの有無で判定）"""
+    if file_load.get('rows') is not None:
+        return file_load['rows'] > 0
+    return bool(file_load.get('parts'))
+
+def save_file_stats(batch_id, path):
+    """ファイル別統計（JSON Lines）をS3へ保存"""
+    key = f"stats/{batch_id}/file_stats.jsonl"
+    try:
+        s3.upload_file(path, STAGING_BUCKET, key)
+    except Exception as e:
+        print(f"Failed to save file stats for batch {batch_id}: {e}")
+        return None
+    return f"s3://{STAGING_BUCKET}/{key}"
+
+def rows_per_sec(rows, duration_ms):
+    if not rows or not duration_ms:
+        return None
+    return round(rows / (duration_ms / 1000), 1)
+
+def build_file_stat(result, batch_files):
+    """
+    Map結果・ロード証跡から1ファイル分の件数・サイズ・所要時間を作成
+    （変換件数・所要時間はMap内で変換結果から glue_result に取り込み済みのため、S3は読まない）
+    """
+    file_input = result.get('file_input', {})
+    key = get_file_key(result)
+    glue_result = result.get('glue_result', {})
+    
+    # 変換時間: 変換結果の所要時間 > Glueジョブの実行時間（秒）
+    conversion_ms = glue_result.get('duration_ms')
+    if conversion_ms is None and glue_result.get('ExecutionTime') is not None:
+        conversion_ms = glue_result['ExecutionTime'] * 1000
+    
+    input_rows = glue_result.get('input_rows')
+    output_rows = glue_result.get('output_rows')
+    
+    redshift_payload = parse_payload(result.get('redshift_result'))
+    if redshift_payload:
+        loaded_rows = redshift_payload.get('inserted_rows')
+        parquet_bytes = redshift_payload.get('bytes_scanned')
+        load_ms = redshift_payload.get('duration_ms')
+    else:
+        # バッチ単位ロードはファイル単位の所要時間が取れないため件数・サイズのみ
+        batch_file = batch_files.get(key, {})
+        loaded_rows = batch_file.get('rows')
+        parquet_bytes = batch_file.get('bytes')
+        load_ms = None
+    
+    return {
+        'file': key,
+        'converter': file_input.get('converter', 'glue'),
+        'input_bytes': file_input.get('file_size'),
+        'parquet_bytes': parquet_bytes,
+        'input_rows': input_rows,
+        'output_rows': output_rows,
+        'loaded_rows': loaded_rows,
+        'conversion_ms': conversion_ms,
+        'load_ms': load_ms,
+        'conversion_rows_per_sec': rows_per_sec(input_rows, conversion_ms),
+        'load_rows_per_sec': rows_per_sec(loaded_rows, load_ms)
+    }
+
+def new_throughput():
+    """スループット集計用の累積値（低速ファイルは上位N件のみヒープで保持）"""
+    return {
+        'input_bytes': 0,
+        'input_rows': 0,
+        'loaded_rows': 0,
+        'conversion_ms': 0,
+        'load_ms': 0,
+        'seq': 0,
+        'slowest': []
+    }
+
+def add_throughput(throughput, file_stat):
+    """1ファイル分の統計を累積"""
+    total_ms = (file_stat['conversion_ms'] or 0) + (file_stat['load_ms'] or 0)
+    throughput['input_bytes'] += file_stat['input_bytes'] or 0
+    throughput['input_rows'] += file_stat['input_rows'] or 0
+    throughput['loaded_rows'] += file_stat['loaded_rows'] or 0
+    throughput['conversion_ms'] += file_stat['conversion_ms'] or 0
+    throughput['load_ms'] += file_stat['load_ms'] or 0
+    
+    entry = (total_ms, throughput['seq'], {
+        'file': file_stat['file'],
+        'total_ms': total_ms,
+        'conversion_ms': file_stat['conversion_ms'],
+        'load_ms': file_stat['load_ms']
+    })
+    throughput['seq'] += 1
+    if len(throughput['slowest']) < SLOWEST_FILES_LIMIT:
+        heapq.heappush(throughput['slowest'], entry)
+    elif SLOWEST_FILES_LIMIT > 0 and entry[0] > throughput['slowest'][0][0]:
+        heapq.heapreplace(throughput['slowest'], entry)
+
+def summarize_throughput(throughput):
+    """バッチ全体のサイズ・所要時間・スループットと低速ファイル上位"""
+    return {
+        "total_input_bytes": throughput['input_bytes'],
+        "total_conversion_ms": throughput['conversion_ms'],
+        "total_load_ms": throughput['load_ms'],
+        "conversion_rows_per_sec": rows_per_sec(throughput['input_rows'], throughput['conversion_ms']),
+        "load_rows_per_sec": rows_per_sec(throughput['loaded_rows'], throughput['load_ms']),
+        "slowest_files": [entry[2] for entry in sorted(throughput['slowest'], key=lambda e: e[0], reverse=True)]
+    }
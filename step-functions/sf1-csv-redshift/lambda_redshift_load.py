@@ -1,135 +1,475 @@
 """
 Redshift データロードLambda
 ParquetファイルをRedshiftにCOPY
+
+action:
+- load:    COPYを実行し完了まで待機（従来動作）
+- submit:  COPYを投入して即座に返却（完了待ちはStep Functions側のWait/ポーリングで実施）
+- collect: 投入済みステートメントの結果から件数・証跡を作成
 """
 import json
 import boto3
 import os
 import time
 from datetime import datetime
+from etl_poller import bind_context, get_wait_stats, poll_until
+from map_results_reader import iter_map_results
 
 redshift_data = boto3.client('redshift-data')
+s3 = boto3.client('s3')
+
+STAGING_BUCKET = os.environ.get('STAGING_BUCKET', 'etl-observer-dev-staging')
+
+# バッチロードのファイル別内訳をステート上に持つ上限（超える場合はS3に保存し参照のみ渡す）
+INLINE_FILES_LIMIT = int(os.environ.get('INLINE_FILES_LIMIT', '100'))
+
+# 直前のCOPYの件数とクエリID（同一セッション内でのみ有効）
+COPY_COUNT_SQL = "SELECT pg_last_copy_count(), pg_last_copy_id();"
 
 def lambda_handler(event, context):
     """
     ParquetファイルをRedshiftにロード
+    load_scope=batch の場合はバッチ全体を1回のマニフェストCOPYでロード
     """
-    batch_id = event.get('batch_id')
-    parquet_s3_uri = event.get('parquet_s3_uri')
-    redshift_config = event.get('redshift_config', {})
-    dataset = event.get('dataset', 'unknown')
-    file_key = event.get('file_key', '')
+    bind_context(context)
+    action = event.get('action', 'load')
     
-    # Redshift設定
-    workgroup = redshift_config.get('workgroup', 'default')
-    database = redshift_config.get('database', 'dev')
-    iam_role = redshift_config.get('iam_role', 'arn:aws:iam::YOUR_AWS_ACCOUNT_ID:role/redshift-copy-role')
-    target_table = redshift_config.get('target_table', 'public.etl_data')
-    copy_options = redshift_config.get('copy_options', 'FORMAT AS PARQUET')
+    if action == 'collect':
+        return collect_load(event['load_context'])
     
-    inserted_rows = 0
-    error_message = None
-    success = True
+    try:
+        if event.get('load_scope') == 'batch':
+            load_context, sqls = plan_batch_load(event)
+        else:
+            load_context, sqls = plan_file_load(event)
+    except Exception as e:
+        print(f"Error preparing Redshift load: {e}")
+        return build_result(event_to_context(event), {}, False, str(e))
     
     try:
-        # 一時的なステージングテーブル名生成
-        timestamp = str(int(time.time()))
-        staging_table = f"{target_table}_staging_{timestamp}"
-        
-        # 直接対象テーブルにCOPY
-        copy_sql = f"""
-        COPY {target_table}
-        FROM '{parquet_s3_uri}/'
-        IAM_ROLE '{iam_role}'
-        {copy_options};
-        """
-        
-        print(f"Loading Parquet data from {parquet_s3_uri} to {target_table}")
-        
-        # COPYコマンド実行
-        copy_response = redshift_data.execute_statement(
-            WorkgroupName=workgroup,
-            Database=database,
-            Sql=copy_sql
-        )
-        
-        copy_statement_id = copy_response['Id']
-        wait_for_completion(copy_statement_id, workgroup, database)
-        
-        # 件数確認
-        count_response = redshift_data.execute_statement(
-            WorkgroupName=workgroup,
-            Database=database,
-            Sql=f"SELECT COUNT(*) FROM {target_table};"
+        # 全ステートメントを同一セッション・単一トランザクションで実行
+        # （pg_last_copy_countはセッション単位、MERGEはCOPYと原子的に反映）
+        batch_response = redshift_data.batch_execute_statement(
+            WorkgroupName=load_context['workgroup'],
+            Database=load_context['database'],
+            Sqls=sqls
         )
+        load_context['statement_id'] = batch_response['Id']
+    except Exception as e:
+        print(f"Error submitting Redshift load: {e}")
+        return build_result(load_context, {}, False, str(e))
+    
+    if action == 'submit':
+        print(f"Submitted Redshift load {load_context['statement_id']} for {load_context['source']}")
+        return {
+            'statusCode': 202,
+            'batch_id': load_context['batch_id'],
+            'submitted': True,
+            'statement_id': load_context['statement_id'],
+            'load_context': load_context
+        }
+    
+    try:
+        wait_for_completion(load_context['statement_id'], load_context['workgroup'], load_context['database'])
+    except Exception as e:
+        print(f"Error loading to Redshift: {e}")
+        return build_result(load_context, {}, False, str(e))
+    
+    return collect_load(load_context)
+
+def event_to_context(event):
+    """イベントからロード情報の共通部分を取得"""
+    redshift_config = event.get('redshift_config', {})
+    return {
+        'batch_id': event.get('batch_id'),
+        'dataset': event.get('dataset', 'unknown'),
+        'load_scope': event.get('load_scope', 'file'),
+        'workgroup': redshift_config.get('workgroup', 'default'),
+        'database': redshift_config.get('database', 'dev'),
+        'target_table': redshift_config.get('target_table', 'public.etl_data'),
+        # append: 対象テーブルへ直接COPY / merge: ステージング経由でキー単位にUPSERT（再実行で重複しない）
+        'load_mode': redshift_config.get('load_mode', 'append'),
+        'source': event.get('parquet_s3_uri', ''),
+        'file_key': event.get('file_key', ''),
+        'files': [],
+        'file_count': 0
+    }
+
+def plan_file_load(event):
+    """1ファイル分のロードSQLを作成"""
+    redshift_config = event.get('redshift_config', {})
+    load_context = event_to_context(event)
+    parquet_s3_uri = load_context['source']
+    
+    sqls, copy_index, count_index = build_load_statements(
+        load_context['load_mode'], load_context['target_table'],
+        make_staging_table_name(load_context['target_table']), f"'{parquet_s3_uri}/'",
+        redshift_config.get('iam_role', 'arn:aws:iam::YOUR_AWS_ACCOUNT_ID:role/redshift-copy-role'),
+        redshift_config.get('copy_options', 'FORMAT AS PARQUET'),
+        redshift_config.get('merge_keys', [])
+    )
+    load_context.update({'copy_index': copy_index, 'count_index': count_index})
+    
+    print(f"Loading Parquet data from {parquet_s3_uri} to {load_context['target_table']} (mode={load_context['load_mode']})")
+    return load_context, sqls
+
+def plan_batch_load(event):
+    """
+    Map後のバッチ単位ロード
+    変換に成功した全ParquetをCOPYマニフェストにまとめ、1回のCOPYで全スライスに並列ロード
+    """
+    redshift_config = event.get('redshift_config', {})
+    load_context = event_to_context(event)
+    
+    # 変換成功ファイルのParquetプレフィックス収集
+    # Map結果はインライン（リスト）またはResultWriterでS3出力されたもの
+    file_keys = [
+        result['file_input']['key'] for result in iter_map_results(event.get('map_results', []), s3)
+        if result.get('glue_result', {}).get('JobRunState') == 'SUCCEEDED'
+    ]
+    if not file_keys:
+        raise Exception("No converted Parquet files to load")
+    
+    manifest_s3_uri, file_loads = write_copy_manifest(load_context['batch_id'], load_context['dataset'], file_keys)
+    
+    sqls, copy_index, count_index = build_load_statements(
+        load_context['load_mode'], load_context['target_table'],
+        make_staging_table_name(load_context['target_table']), f"'{manifest_s3_uri}'",
+        redshift_config.get('iam_role', 'arn:aws:iam::YOUR_AWS_ACCOUNT_ID:role/redshift-copy-role'),
+        f"{redshift_config.get('copy_options', 'FORMAT AS PARQUET')} MANIFEST",
+        redshift_config.get('merge_keys', [])
+    )
+    load_context.update({
+        'source': manifest_s3_uri,
+        'copy_index': copy_index,
+        'count_index': count_index
+    })
+    store_file_loads(load_context, file_loads)
+    
+    print(f"Loading {len(file_keys)} files via manifest {manifest_s3_uri} to {load_context['target_table']} (mode={load_context['load_mode']})")
+    return load_context, sqls
+
+def make_staging_table_name(target_table):
+    """一時的なステージングテーブル名生成（TEMPテーブルのためスキーマ指定なし）"""
+    timestamp = str(int(time.time()))
+    return f"{target_table.split('.')[-1]}_staging_{timestamp}"
+
+def collect_load(load_context):
+    """
+    完了したステートメントから件数・所要時間を取得し結果を作成
+    失敗・中断していた場合はエラー結果を返す
+    """
+    statement_id = load_context['statement_id']
+    workgroup = load_context['workgroup']
+    database = load_context['database']
+    
+    try:
+        description = redshift_data.describe_statement(Id=statement_id)
+        if description['Status'] in ['FAILED', 'ABORTED']:
+            raise Exception(f"Statement failed: {description.get('Error', 'Unknown error')}")
+        if description['Status'] != 'FINISHED':
+            raise Exception(f"Statement not finished: {description['Status']}")
         
-        count_statement_id = count_response['Id']
-        wait_for_completion(count_statement_id, workgroup, database)
-        
-        # 結果取得
-        count_result = redshift_data.get_statement_result(Id=count_statement_id)
-        if count_result['Records']:
-            inserted_rows = int(count_result['Records'][0][0]['longValue'])
-        
-        print(f"Successfully loaded {inserted_rows} rows to {target_table}")
+        # COPY自体の件数・所要時間・スキャンバイト数（テーブルサイズに依存しない）
+        copy_stats = fetch_copy_stats(statement_id, load_context['copy_index'], load_context['count_index'],
+                                      workgroup, database, description)
         
+        if load_context['load_scope'] == 'batch':
+            # ファイル単位の行数をロード明細から割り当て
+            file_loads = get_file_loads(load_context)
+            attribute_file_rows(file_loads, copy_stats['copy_query_id'], workgroup, database)
+            store_file_loads(load_context, file_loads)
+    
     except Exception as e:
-        success = False
-        error_message = str(e)
         print(f"Error loading to Redshift: {e}")
+        return build_result(load_context, {}, False, str(e))
+    
+    print(f"Successfully loaded {copy_stats['inserted_rows']} rows to {load_context['target_table']} "
+          f"({copy_stats['bytes_scanned']} bytes, {copy_stats['duration_ms']} ms)")
+    return build_result(load_context, copy_stats, True, None)
+
+def build_result(load_context, copy_stats, success, error_message):
+    """Lambda戻り値と証跡情報を作成"""
+    inserted_rows = copy_stats.get('inserted_rows', 0)
+    bytes_scanned = copy_stats.get('bytes_scanned', 0)
+    duration_ms = copy_stats.get('duration_ms', 0)
+    target_table = load_context['target_table']
+    is_batch = load_context['load_scope'] == 'batch'
+    
+    load = {
+        "table": target_table,
+        "inserted_rows": inserted_rows,
+        "dropped_rows": 0,
+        "load_mode": load_context['load_mode'],
+        "bytes_scanned": bytes_scanned,
+        "duration_ms": duration_ms,
+        "reason": error_message if error_message else ("successful batch load" if is_batch else "successful load")
+    }
+    if is_batch:
+        load["files"] = load_context['files']
+        if load_context.get('files_s3_uri'):
+            load["files_s3_uri"] = load_context['files_s3_uri']
+        input_info = {
+            "s3": load_context['source'],
+            "dataset": load_context['dataset'],
+            "files": load_context['file_count']
+        }
+        note = f"Loaded {inserted_rows} rows from {load_context['file_count']} files into {target_table}"
+    else:
+        input_info = {
+            "s3": load_context['source'],
+            "dataset": load_context['dataset'],
+            "file": load_context['file_key']
+        }
+        note = f"Loaded {inserted_rows} rows into {target_table}"
     
     # 証跡情報
     evidence = {
-        "batch_id": batch_id,
+        "batch_id": load_context['batch_id'],
         "test_id": "",
         "flow": "csv-to-parquet-pipeline",
         "step": "redshift_load",
-        "input": {
-            "s3": parquet_s3_uri,
-            "dataset": dataset,
-            "file": file_key
-        },
+        "input": input_info,
         "output": {
             "s3": "",  # Redshift なので S3 出力なし
             "rows": inserted_rows if success else 0
         },
-        "load": {
-            "table": target_table,
-            "inserted_rows": inserted_rows,
-            "dropped_rows": 0,
-            "reason": error_message if error_message else "successful load"
-        },
+        "load": load,
         "ok": success,
         "ts": datetime.now().isoformat(),
-        "note": error_message if error_message else f"Loaded {inserted_rows} rows into {target_table}"
+        "note": error_message if error_message else note
     }
     
-    return {
+    result = {
         'statusCode': 200 if success else 500,
-        'batch_id': batch_id,
+        'batch_id': load_context['batch_id'],
         'inserted_rows': inserted_rows,
+        'bytes_scanned': bytes_scanned,
+        'duration_ms': duration_ms,
         'target_table': target_table,
         'success': success,
         'evidence': evidence,
         'error': error_message
     }
+    if is_batch:
+        result['load_scope'] = 'batch'
+        result['files'] = load_context['files']
+        result['file_count'] = load_context['file_count']
+        if load_context.get('files_s3_uri'):
+            result['files_s3_uri'] = load_context['files_s3_uri']
+    
+    wait_stats = get_wait_stats()
+    if wait_stats:
+        result['wait_stats'] = wait_stats
+    
+    return result
 
-def wait_for_completion(statement_id, workgroup, database, max_wait_seconds=300):
+def write_copy_manifest(batch_id, dataset, file_keys):
     """
-    Redshift Data API ステートメント完了待機
+    各ファイルのParquet出力（パートファイル群）を列挙しCOPYマニフェストをS3に保存
+    Parquetのマニフェストにはcontent_lengthが必須
     """
-    waited = 0
-    while waited < max_wait_seconds:
-        response = redshift_data.describe_statement(Id=statement_id)
-        status = response['Status']
+    entries = []
+    file_loads = []
+    
+    for file_key in file_keys:
+        prefix = f"parquet/{dataset}/{file_key}/"
+        part_count = 0
+        part_bytes = 0
         
-        if status == 'FINISHED':
-            return True
-        elif status in ['FAILED', 'ABORTED']:
-            error = response.get('Error', 'Unknown error')
-            raise Exception(f"Statement failed: {error}")
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=STAGING_BUCKET, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                name = obj['Key'].rsplit('/', 1)[-1]
+                # Spark出力の_SUCCESS等のマーカーファイルは除外
+                if obj['Size'] == 0 or name.startswith(('_', '.')):
+                    continue
+                entries.append({
+                    'url': f"s3://{STAGING_BUCKET}/{obj['Key']}",
+                    'mandatory': True,
+                    'meta': {'content_length': obj['Size']}
+                })
+                part_count += 1
+                part_bytes += obj['Size']
+        
+        file_loads.append({
+            'file': file_key,
+            'parquet_s3_uri': f"s3://{STAGING_BUCKET}/{prefix}",
+            'parts': part_count,
+            'bytes': part_bytes,
+            'rows': None
+        })
+    
+    manifest_key = f"manifests/{batch_id}/copy_manifest.json"
+    s3.put_object(
+        Bucket=STAGING_BUCKET,
+        Key=manifest_key,
+        Body=json.dumps({'entries': entries}).encode('utf-8'),
+        ContentType='application/json'
+    )
+    
+    return f"s3://{STAGING_BUCKET}/{manifest_key}", file_loads
+
+def store_file_loads(load_context, file_loads):
+    """
+    ファイル別内訳をload_contextに格納
+    件数が多い場合はS3に保存し、ステート（256KB上限）にはURIのみ載せる
+    """
+    load_context['file_count'] = len(file_loads)
+    if len(file_loads) <= INLINE_FILES_LIMIT:
+        load_context['files'] = file_loads
+        return
+    
+    files_key = f"manifests/{load_context['batch_id']}/copy_files.json"
+    s3.put_object(
+        Bucket=STAGING_BUCKET,
+        Key=files_key,
+        Body=json.dumps(file_loads, ensure_ascii=False).encode('utf-8'),
+        ContentType='application/json'
+    )
+    load_context['files'] = []
+    load_context['files_s3_uri'] = f"s3://{STAGING_BUCKET}/{files_key}"
+
+def get_file_loads(load_context):
+    """load_contextのファイル別内訳取得（S3保存分は読み込み）"""
+    if not load_context.get('files_s3_uri'):
+        return load_context['files']
+    
+    files_key = load_context['files_s3_uri'].split(f"s3://{STAGING_BUCKET}/", 1)[1]
+    return json.loads(s3.get_object(Bucket=STAGING_BUCKET, Key=files_key)['Body'].read())
+
+def attribute_file_rows(file_loads, copy_query_id, workgroup, database):
+    """
+    SYS_LOAD_DETAILのファイル別スキャン行数を元ファイル単位に集計
+    明細が未反映の場合はrowsをNoneのまま残す
+    """
+    if copy_query_id < 0:
+        return
+    
+    try:
+        response = redshift_data.execute_statement(
+            WorkgroupName=workgroup,
+            Database=database,
+            Sql=f"SELECT TRIM(file_name), SUM(lines_scanned) FROM sys_load_detail WHERE query_id = {copy_query_id} GROUP BY 1;"
+        )
+        wait_for_completion(response['Id'], workgroup, database)
+        result = redshift_data.get_statement_result(Id=response['Id'])
+    except Exception as e:
+        print(f"Per-file attribution skipped: {e}")
+        return
+    
+    rows_by_part = {
+        record[0].get('stringValue', ''): int(record[1].get('longValue', 0))
+        for record in result.get('Records', [])
+    }
+    for file_load in file_loads:
+        prefix = file_load['parquet_s3_uri']
+        matched = [rows for part, rows in rows_by_part.items() if part.startswith(prefix)]
+        if matched:
+            file_load['rows'] = sum(matched)
+
+def build_load_statements(load_mode, target_table, staging_table, source, iam_role, copy_options, merge_keys):
+    """
+    ロードモード別のSQL一覧を生成
+    戻り値: (SQL一覧, COPYの位置, 件数取得の位置)  ※位置はData APIのサブステートメント番号（1始まり）
+    """
+    if load_mode == 'append':
+        copy_sql = f"""
+        COPY {target_table}
+        FROM {source}
+        IAM_ROLE '{iam_role}'
+        {copy_options};
+        """
+        return [copy_sql, COPY_COUNT_SQL], 1, 2
+    
+    if load_mode == 'merge':
+        if not merge_keys:
+            raise ValueError("merge_keys is required when load_mode is 'merge'")
         
-        time.sleep(2)
-        waited += 2
+        join_condition = ' AND '.join(
+            f"{target_table}.{key} = {staging_table}.{key}" for key in merge_keys
+        )
+        sqls = [
+            f"CREATE TEMP TABLE {staging_table} (LIKE {target_table});",
+            f"""
+        COPY {staging_table}
+        FROM {source}
+        IAM_ROLE '{iam_role}'
+        {copy_options};
+        """,
+            COPY_COUNT_SQL,
+            f"MERGE INTO {target_table} USING {staging_table} ON {join_condition} REMOVE DUPLICATES;",
+            f"DROP TABLE {staging_table};"
+        ]
+        return sqls, 2, 3
+    
+    raise ValueError(f"Unsupported load_mode: {load_mode}")
+
+def wait_for_completion(statement_id, workgroup, database, max_wait_seconds=300):
+    """
+    Redshift Data API ステートメント完了待機（バックオフ付き、Lambda残り時間を考慮）
+    """
+    result = poll_until(
+        lambda: redshift_data.describe_statement(Id=statement_id),
+        lambda response: response['Status'] in ['FINISHED', 'FAILED', 'ABORTED'],
+        label=f"redshift:{statement_id}",
+        initial_interval=0.5,
+        max_interval=10,
+        max_wait_seconds=max_wait_seconds,
+        get_state=lambda response: response['Status']
+    )
+    
+    response = result['status']
+    if response['Status'] in ['FAILED', 'ABORTED']:
+        error = response.get('Error', 'Unknown error')
+        raise Exception(f"Statement failed: {error}")
+    
+    return True
+
+def fetch_copy_stats(statement_id, copy_index, count_index, workgroup, database, description=None):
+    """
+    バッチ実行したCOPYの件数・所要時間・スキャンバイト数を取得
+    対象テーブルの全件COUNTは行わない
+    """
+    count_result = redshift_data.get_statement_result(Id=f"{statement_id}:{count_index}")
+    record = count_result['Records'][0]
+    inserted_rows = int(record[0].get('longValue', 0))
+    copy_query_id = int(record[1].get('longValue', -1))
+    
+    # 所要時間はサブステートメントのDuration（ナノ秒）から算出
+    duration_ms = 0
+    if description is None:
+        description = redshift_data.describe_statement(Id=statement_id)
+    for sub_statement in description.get('SubStatements', []):
+        if sub_statement['Id'] == f"{statement_id}:{copy_index}":
+            duration_ms = int(sub_statement.get('Duration', 0) / 1_000_000)
+    
+    return {
+        'inserted_rows': inserted_rows,
+        'copy_query_id': copy_query_id,
+        'duration_ms': duration_ms,
+        'bytes_scanned': fetch_bytes_scanned(copy_query_id, workgroup, database)
+    }
+
+def fetch_bytes_scanned(copy_query_id, workgroup, database):
+    """
+    SYS_LOAD_HISTORYからCOPYの読み込みバイト数を取得（クエリID指定のため定数コスト）
+    システムビューへの反映遅延等で取得できない場合は0
+    """
+    if copy_query_id < 0:
+        return 0
+    
+    try:
+        response = redshift_data.execute_statement(
+            WorkgroupName=workgroup,
+            Database=database,
+            Sql=f"SELECT COALESCE(SUM(source_file_bytes), 0) FROM sys_load_history WHERE query_id = {copy_query_id};"
+        )
+        wait_for_completion(response['Id'], workgroup, database)
+        result = redshift_data.get_statement_result(Id=response['Id'])
+        if result['Records']:
+            return int(result['Records'][0][0].get('longValue', 0))
+    except Exception as e:
+        print(f"Load stats lookup skipped: {e}")
     
-    raise Exception(f"Statement timeout after {max_wait_seconds} seconds")
\ No newline at end of file
+    return 0
@@ -0,0 +1,281 @@
+"""
+バッチ変換エンジン - Step Functions 2用
+宣言的な変換定義（項目マッピング・型変換・既定値・派生項目）をデータセット単位でコンパイルし、
+アイテムのチャンクに列単位で適用（アイテムごとに変換定義を解釈しない）
+
+変換定義の例:
+{
+  "fields": {
+    "name":     {"source": "product.name", "type": "string", "default": ""},
+    "price":    {"source": "price", "type": "float", "default": 0},
+    "released": {"source": "release_date", "type": "date"}
+  },
+  "derived": {
+    "label":    {"op": "template", "template": "{category}/{name}"},
+    "total":    {"op": "product", "fields": ["price", "quantity"]},
+    "name_key": {"op": "lower", "field": "name"}
+  },
+  "drop": ["internal_note"],
+  "keep_unmapped": true
+}
+"""
+import json
+import string
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+# 値が存在しないことを表す番兵
+_MISSING = object()
+
+def _to_string(value: Any) -> str:
+    if isinstance(value, (dict, list)):
+        raise TypeError(f"invalid string: {type(value).__name__}")
+    return str(value)
+
+def _to_bool(value: Any) -> bool:
+    if isinstance(value, (dict, list)):
+        raise TypeError(f"invalid boolean: {type(value).__name__}")
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in ['true', '1', 'yes', 'y']:
+            return True
+        if lowered in ['false', '0', 'no', 'n', '']:
+            return False
+        raise ValueError(f"invalid boolean: {value}")
+    return bool(value)
+
+def _to_int(value: Any) -> int:
+    if isinstance(value, str):
+        return int(float(value)) if '.' in value else int(value)
+    return int(value)
+
+def _to_date(value: Any) -> str:
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value).date().isoformat()
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00')).date().isoformat()
+
+def _to_datetime(value: Any) -> str:
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value).isoformat()
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00')).isoformat()
+
+# 型名 → 変換関数（json以外の型ではdict/listの値は変換失敗）
+COERCERS: Dict[str, Callable[[Any], Any]] = {
+    'string': _to_string,
+    'int': _to_int,
+    'float': float,
+    'bool': _to_bool,
+    'date': _to_date,
+    'datetime': _to_datetime,
+    'json': lambda value: value if isinstance(value, (dict, list)) else json.loads(value)
+}
+
+# 値の種類が少ない型（変換結果をチャンク内で再利用）
+MEMOIZED_TYPES = ['bool', 'date', 'datetime']
+
+def _compile_column_getter(path: str) -> Callable[[List[Dict[str, Any]]], List[Any]]:
+    """ドット区切りパスの列取得関数（1階層は内包表記でdict.getを直接呼び出し）"""
+    keys = path.split('.')
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda items: [item.get(key, _MISSING) for item in items]
+    
+    def get(item):
+        value = item
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                return _MISSING
+            value = value[key]
+        return value
+    return lambda items: list(map(get, items))
+
+def _coerce_column(values: List[Any], coerce: Optional[Callable[[Any], Any]], default: Any, errors: Dict[str, int],
+                   field: str, memoize: bool = False) -> List[Any]:
+    """
+    1列分の型変換と既定値補完（まず列全体を一括変換し、失敗時のみ値ごとに変換）
+    defaultは変換済み（値がない場合も変換に失敗した場合も同じ既定値）
+    """
+    if coerce is None:
+        return [default if value is _MISSING or value is None else value for value in values]
+    if memoize:
+        # 同じ値の変換は1回のみ（dict/listはハッシュできないため変換せず失敗として記録）
+        memo = {}
+        for value in set(value for value in values
+                         if value is not _MISSING and value is not None and not isinstance(value, (dict, list))):
+            try:
+                memo[value] = coerce(value)
+            except (TypeError, ValueError):
+                memo[value] = _MISSING
+        coerced = []
+        for value in values:
+            if value is _MISSING or value is None:
+                coerced.append(default)
+                continue
+            result = _MISSING if isinstance(value, (dict, list)) else memo[value]
+            if result is _MISSING:
+                errors[field] = errors.get(field, 0) + 1
+                result = default
+            coerced.append(result)
+        return coerced
+    try:
+        return [default if value is _MISSING or value is None else coerce(value) for value in values]
+    except (TypeError, ValueError):
+        pass
+    
+    coerced = []
+    for value in values:
+        if value is _MISSING or value is None:
+            coerced.append(default)
+            continue
+        try:
+            coerced.append(coerce(value))
+        except (TypeError, ValueError):
+            errors[field] = errors.get(field, 0) + 1
+            coerced.append(default)
+    return coerced
+
+def _numeric(values):
+    return [value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)]
+
+def _product(values):
+    numbers = _numeric(values)
+    if not numbers:
+        return None
+    result = 1
+    for number in numbers:
+        result *= number
+    return result
+
+def _compile_derived(name: str, spec: Dict[str, Any]):
+    """派生項目の列演算関数（入力列のリスト → 出力列）を作成"""
+    op = spec['op']
+    
+    if op == 'const':
+        value = spec.get('value')
+        return [], lambda columns, count: [value] * count
+    
+    if op == 'template':
+        template = spec['template']
+        fields = [field for _, field, _, _ in string.Formatter().parse(template) if field]
+        if not fields:
+            return [], lambda columns, count: [template] * count
+        return fields, lambda columns, count: [
+            template.format(**{field: '' if value is None else value for field, value in zip(fields, values)})
+            for values in zip(*columns)
+        ]
+    
+    if op in ['upper', 'lower', 'strip']:
+        method = {'upper': str.upper, 'lower': str.lower, 'strip': str.strip}[op]
+        return [spec['field']], lambda columns, count: [
+            method(value) if isinstance(value, str) else value for value in columns[0]
+        ]
+    
+    if op == 'length':
+        return [spec['field']], lambda columns, count: [
+            len(value) if isinstance(value, (str, list, dict)) else None for value in columns[0]
+        ]
+    
+    fields = spec['fields']
+    if op == 'concat':
+        separator = spec.get('separator', '')
+        return fields, lambda columns, count: [
+            separator.join(str(value) for value in values if value is not None) for values in zip(*columns)
+        ]
+    if op == 'sum':
+        return fields, lambda columns, count: [
+            sum(_numeric(values)) if _numeric(values) else None for values in zip(*columns)
+        ]
+    if op == 'product':
+        return fields, lambda columns, count: [_product(values) for values in zip(*columns)]
+    if op == 'coalesce':
+        return fields, lambda columns, count: [
+            next((value for value in values if value is not None), None) for values in zip(*columns)
+        ]
+    raise ValueError(f"Unknown derived op for '{name}': {op}")
+
+class BatchTransform:
+    """コンパイル済みの変換定義"""
+    
+    def __init__(self, spec: Dict[str, Any]):
+        self.mappings = []
+        for name, field_spec in (spec.get('fields') or {}).items():
+            if isinstance(field_spec, str):
+                field_spec = {'source': field_spec}
+            type_name = field_spec.get('type')
+            if type_name is not None and type_name not in COERCERS:
+                raise ValueError(f"Unknown type for '{name}': {type_name}")
+            coerce = COERCERS.get(type_name)
+            # 既定値はコンパイル時に1回だけ変換（例: float型の既定値 0 → 0.0）
+            default = field_spec.get('default')
+            if coerce is not None and default is not None:
+                try:
+                    default = coerce(default)
+                except (TypeError, ValueError) as e:
+                    raise ValueError(f"Invalid default for '{name}': {e}")
+            self.mappings.append((
+                name,
+                _compile_column_getter(field_spec.get('source', name)),
+                coerce,
+                default,
+                type_name in MEMOIZED_TYPES
+            ))
+        self.derived = [
+            (name, *_compile_derived(name, derived_spec))
+            for name, derived_spec in (spec.get('derived') or {}).items()
+        ]
+        self.drop = set(spec.get('drop') or [])
+        self.keep_unmapped = spec.get('keep_unmapped', True)
+        self.stats = {'chunks': 0, 'items': 0, 'coercion_errors': {}}
+    
+    def _column(self, name: str, columns: Dict[str, List[Any]], items: List[Dict[str, Any]]) -> List[Any]:
+        """派生項目の入力列（変換済み列を優先し、なければ元アイテムから取得）"""
+        if name in columns:
+            return columns[name]
+        return [None if value is _MISSING else value for value in _compile_column_getter(name)(items)]
+    
+    def apply(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """チャンク（アイテムのリスト）を列単位で変換"""
+        count = len(items)
+        columns: Dict[str, List[Any]] = {}
+        
+        for name, get_column, coerce, default, memoize in self.mappings:
+            columns[name] = _coerce_column(get_column(items), coerce, default,
+                                           self.stats['coercion_errors'], name, memoize)
+        
+        for name, inputs, compute in self.derived:
+            columns[name] = compute([self._column(field, columns, items) for field in inputs], count)
+        
+        names = [name for name in columns if name not in self.drop]
+        rows = [dict(zip(names, values)) for values in zip(*(columns[name] for name in names))] if names \
+            else [{} for _ in range(count)]
+        
+        if self.keep_unmapped:
+            drop = self.drop
+            if drop:
+                rows = [{**{k: v for k, v in item.items() if k not in drop}, **row} for item, row in zip(items, rows)]
+            else:
+                rows = [{**item, **row} for item, row in zip(items, rows)]
+        
+        self.stats['chunks'] += 1
+        self.stats['items'] += count
+        return rows
+    
+    def summary(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'fields': len(self.mappings),
+            'derived': len(self.derived)
+        }
+
+# データセット名＋変換定義 → コンパイル済み変換（ウォームスタート時は再利用）
+_transform_cache: Dict[str, BatchTransform] = {}
+
+def get_transform(dataset: str, spec: Dict[str, Any]) -> BatchTransform:
+    """データセット用の変換を取得（初回のみコンパイル、統計は呼び出しごとにリセット）"""
+    cache_key = f"{dataset}:{json.dumps(spec, sort_keys=True)}"
+    transform = _transform_cache.get(cache_key)
+    if transform is None:
+        transform = BatchTransform(spec)
+        _transform_cache[cache_key] = transform
+    transform.stats = {'chunks': 0, 'items': 0, 'coercion_errors': {}}
+    return transform
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+DynamoDB書き込みベンチマーク - Step Functions 2用
+lambda_dynamodb_writer をプロセス内のDynamoDB代替（またはDynamoDB Local）に対して実行し、
+items/sec・バッチレイテンシ（p50/p99）・メモリ使用量を計測
+
+実行例:
+  python benchmark_dynamodb_writer.py                                  # 1k / 100k / 1M × small / medium / large
+  python benchmark_dynamodb_writer.py --counts 1000,100000 --sizes medium
+  python benchmark_dynamodb_writer.py --provisioned-wcu 2000 --latency-ms 5
+  python benchmark_dynamodb_writer.py --endpoint-url http://localhost:8000  # DynamoDB Local
+
+アイテムはS3クレームチェック経由（items_s3）と同じ経路で1件ずつ生成して流すため、
+件数を増やしてもベンチマーク自体のメモリ使用量は増えない
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import string
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, Iterator, List
+
+# 書き込みLambdaはモジュール読み込み時にboto3クライアントを作成するため、リージョン未設定でも動くよう既定値を設定
+os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-northeast-1')
+
+import lambda_dynamodb_writer
+from botocore.exceptions import ClientError
+
+DEFAULT_COUNTS = [1000, 100000, 1000000]
+
+# 合成アイテムのサイズ区分（description部の文字数）
+ITEM_SIZES = {
+    'small': 100,
+    'medium': 2000,
+    'large': 20000
+}
+
+BENCHMARK_TABLE = 'benchmark-json-processing-table'
+
+class InMemoryDynamoDB:
+    """
+    DynamoDB低レベルAPIのプロセス内代替
+    BatchWriteItem / BatchGetItem / PutItem / DescribeTable のみ実装
+    provisioned_wcu 指定時は直近1秒の消費WCUが上限を超えるリクエストをスロットリング
+    """
+    
+    def __init__(self, provisioned_wcu: int = 0, latency_ms: float = 0.0, store_items: bool = False):
+        self.provisioned_wcu = provisioned_wcu
+        self.latency = latency_ms / 1000.0
+        self.store_items = store_items
+        self.items: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        self.window: List[tuple] = []
+        self.written = 0
+    
+    def describe_table(self, TableName):
+        if self.provisioned_wcu:
+            return {'Table': {
+                'TableName': TableName,
+                'BillingModeSummary': {'BillingMode': 'PROVISIONED'},
+                'ProvisionedThroughput': {'WriteCapacityUnits': self.provisioned_wcu, 'ReadCapacityUnits': self.provisioned_wcu}
+            }}
+        return {'Table': {'TableName': TableName, 'BillingModeSummary': {'BillingMode': 'PAY_PER_REQUEST'}}}
+    
+    @staticmethod
+    def _wcu(item: Dict[str, Any]) -> int:
+        # 属性名＋値のサイズをJSON長で近似
+        return max(1, -(-len(json.dumps(item, default=str)) // 1024))
+    
+    def _consume(self, units: int) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.provisioned_wcu:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.window = [entry for entry in self.window if now - entry[0] < 1.0]
+            if sum(entry[1] for entry in self.window) + units > self.provisioned_wcu:
+                raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException',
+                                             'Message': 'Rate of requests exceeds the allowed throughput'}},
+                                  'BatchWriteItem')
+            self.window.append((now, units))
+    
+    def _store(self, item: Dict[str, Any]) -> None:
+        with self.lock:
+            self.written += 1
+            if self.store_items:
+                self.items[item['id']['S']] = item
+    
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity='NONE'):
+        consumed = []
+        for table_name, requests in RequestItems.items():
+            items = [request['PutRequest']['Item'] for request in requests]
+            units = sum(self._wcu(item) for item in items)
+            self._consume(units)
+            for item in items:
+                self._store(item)
+            consumed.append({'TableName': table_name, 'CapacityUnits': float(units)})
+        return {'UnprocessedItems': {}, 'ConsumedCapacity': consumed}
+    
+    def put_item(self, TableName, Item, ReturnConsumedCapacity='NONE', ConditionExpression=None,
+                 ExpressionAttributeValues=None):
+        units = self._wcu(Item)
+        self._consume(units)
+        if ConditionExpression:
+            stored = self.items.get(Item['id']['S'])
+            if stored and stored.get('content_hash') == ExpressionAttributeValues[':content_hash']:
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                             'Message': 'The conditional request failed'}}, 'PutItem')
+        self._store(Item)
+        return {'ConsumedCapacity': {'TableName': TableName, 'CapacityUnits': float(units)}}
+    
+    def batch_get_item(self, RequestItems, ReturnConsumedCapacity='NONE'):
+        responses = {}
+        consumed = []
+        for table_name, request in RequestItems.items():
+            found = [self.items[key['id']['S']] for key in request['Keys'] if key['id']['S'] in self.items]
+            responses[table_name] = [
+                {name: item[name] for name in ['id', 'content_hash'] if name in item} for item in found
+            ]
+            consumed.append({'TableName': table_name, 'CapacityUnits': len(request['Keys']) * 0.5})
+        return {'Responses': responses, 'UnprocessedKeys': {}, 'ConsumedCapacity': consumed}
+
+class TimedClient:
+    """書き込み系API呼び出しのレイテンシを記録するラッパー"""
+    
+    def __init__(self, client):
+        self.client = client
+        self.latencies: List[float] = []
+        self.lock = threading.Lock()
+    
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if name not in ['batch_write_item', 'put_item']:
+            return method
+        
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self.lock:
+                    self.latencies.append(elapsed)
+        return timed
+
+class SyntheticItemsBody:
+    """合成アイテムのNDJSONをS3オブジェクト本文として逐次生成（iter_linesのみ対応）"""
+    
+    def __init__(self, batch_id: str, count: int, description_chars: int, seed: int):
+        self.batch_id = batch_id
+        self.count = count
+        self.description_chars = description_chars
+        self.seed = seed
+    
+    def iter_lines(self, chunk_size: int = 0) -> Iterator[bytes]:
+        for item in generate_items(self.batch_id, self.count, self.description_chars, self.seed):
+            yield json.dumps(item, ensure_ascii=False).encode('utf-8')
+
+class SyntheticS3:
+    """get_objectで合成アイテム本文を返すS3代替"""
+    
+    def __init__(self, body: SyntheticItemsBody):
+        self.body = body
+    
+    def get_object(self, Bucket, Key):
+        return {'Body': self.body}
+
+def generate_items(batch_id: str, count: int, description_chars: int, seed: int = 0) -> Iterator[Dict[str, Any]]:
+    """前処理Lambdaの出力形式（processed item）の合成アイテムを生成"""
+    rng = random.Random(seed)
+    categories = ['electronics', 'books', 'clothing', 'food', 'toys']
+    # 文字列生成のコストを抑えるため、ランダム文字列のプールから切り出す
+    pool = ''.join(rng.choices(string.ascii_letters + string.digits + ' ', k=description_chars + 4096))
+    timestamp = '2025-01-01T00:00:00'
+    
+    for index in range(count):
+        offset = rng.randrange(4096)
+        yield {
+            'id': f'bench-{seed}-{index:09d}',
+            'batch_id': batch_id,
+            'timestamp': timestamp,
+            'processed_at': timestamp,
+            'data': {
+                'name': f'item-{index}',
+                'category': categories[index % len(categories)],
+                'description': pool[offset:offset + description_chars],
+                'price': round(rng.uniform(1, 1000), 2),
+                'stock': rng.randrange(1000),
+                'tags': rng.sample(categories, 2)
+            }
+        }
+
+def percentile(values: List[float], ratio: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+def run_scenario(client_factory, count: int, size_name: str, args) -> Dict[str, Any]:
+    """1シナリオ（件数×サイズ）を実行し計測結果を返す"""
+    batch_id = f'BENCH_{size_name}_{count}'
+    timed_client = TimedClient(client_factory())
+    lambda_dynamodb_writer.dynamodb_client = timed_client
+    lambda_dynamodb_writer.s3 = SyntheticS3(SyntheticItemsBody(batch_id, count, ITEM_SIZES[size_name], args.seed))
+    
+    event = {
+        'batch_id': batch_id,
+        'table_name': args.table_name,
+        'items_s3': {'bucket': 'benchmark', 'key': f'{batch_id}.ndjson', 'compression': 'none', 'item_count': count},
+        'write_mode': args.write_mode,
+        # オンデマンドの代替テーブルではリミッタ自体の上限を計測することになるため、容量指定時のみ有効
+        'rate_limit': not args.no_rate_limit and bool(args.provisioned_wcu or args.endpoint_url)
+    }
+    
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    result = lambda_dynamodb_writer.lambda_handler(event, None)
+    elapsed = time.perf_counter() - started
+    peak_bytes = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+    
+    write_stats = result.get('write_stats', {})
+    return {
+        'items': count,
+        'size': size_name,
+        'status_code': result.get('statusCode'),
+        'success_count': result.get('success_count', 0),
+        'failed_count': result.get('failed_count', 0),
+        'duration_sec': round(elapsed, 2),
+        'items_per_sec': round(count / elapsed, 1) if elapsed > 0 else None,
+        'batch_latency_ms': {
+            'p50': round(percentile(timed_client.latencies, 0.50) * 1000, 2),
+            'p99': round(percentile(timed_client.latencies, 0.99) * 1000, 2)
+        },
+        'requests': write_stats.get('requests', 0),
+        'throttle_retries': write_stats.get('throttle_retries', 0),
+        'consumed_wcu': result.get('consumed_wcu', 0),
+        'avg_item_bytes': result.get('item_sizes', {}).get('avg_bytes', 0),
+        'peak_traced_mb': round(peak_bytes / 1024 / 1024, 1) if peak_bytes is not None else None,
+        # ru_maxrssはLinuxではKB単位（プロセス全体の最大値のため、シナリオ間で単調増加）
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='DynamoDB書き込みスループットのベンチマーク')
+    parser.add_argument('--counts', default=','.join(str(count) for count in DEFAULT_COUNTS),
+                        help='アイテム件数（カンマ区切り）')
+    parser.add_argument('--sizes', default=','.join(ITEM_SIZES), help='アイテムサイズ区分: small,medium,large')
+    parser.add_argument('--endpoint-url', help='DynamoDB LocalのURL（未指定時はプロセス内代替を使用）')
+    parser.add_argument('--table-name', default=BENCHMARK_TABLE)
+    parser.add_argument('--provisioned-wcu', type=int, default=0, help='代替テーブルのWCU（0: オンデマンド）')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='代替テーブルの1リクエストあたり遅延')
+    parser.add_argument('--write-mode', default='put', choices=['put', 'skip_unchanged', 'conditional'])
+    parser.add_argument('--workers', type=int, help='WRITE_WORKERS の上書き')
+    parser.add_argument('--segment-size', type=int, help='WRITE_SEGMENT_SIZE の上書き')
+    parser.add_argument('--no-rate-limit', action='store_true', help='レートリミッタを無効化')
+    parser.add_argument('--tracemalloc', action='store_true', help='tracemallocでピークメモリを計測（低速）')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='結果JSONの出力先')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    counts = [int(count) for count in args.counts.split(',') if count]
+    sizes = [size for size in args.sizes.split(',') if size]
+    
+    if args.workers:
+        lambda_dynamodb_writer.WRITE_WORKERS = args.workers
+    if args.segment_size:
+        lambda_dynamodb_writer.WRITE_SEGMENT_SIZE = args.segment_size
+    # 計測対象は書き込み経路のため、イベント／結果のログ出力は抑止
+    lambda_dynamodb_writer.print = lambda *a, **k: None
+    
+    if args.endpoint_url:
+        import boto3
+        
+        def client_factory():
+            return boto3.client('dynamodb', endpoint_url=args.endpoint_url)
+    else:
+        def client_factory():
+            return InMemoryDynamoDB(args.provisioned_wcu, args.latency_ms,
+                                    store_items=args.write_mode != 'put')
+    
+    results = []
+    print(f"{'items':>9} {'size':>6} {'items/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'throttle':>8} {'WCU':>10} {'RSS MB':>8}")
+    for size_name in sizes:
+        for count in counts:
+            result = run_scenario(client_factory, count, size_name, args)
+            results.append(result)
+            print(f"{result['items']:>9} {result['size']:>6} {result['items_per_sec']:>10} "
+                  f"{result['batch_latency_ms']['p50']:>8} {result['batch_latency_ms']['p99']:>8} "
+                  f"{result['throttle_retries']:>8} {result['consumed_wcu']:>10} {result['max_rss_mb']:>8}")
+            if result['status_code'] != 200:
+                print(f"  ⚠️ statusCode={result['status_code']} failed={result['failed_count']}", file=sys.stderr)
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+                'results': results
+            }, f, ensure_ascii=False, indent=2)
+        print(f"結果を出力: {args.output}")
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+DynamoDBアイテムエンコーダ - Step Functions 2用
+書き込みアイテムをコンパクトに組み立て、WCU消費を抑える
+
+- 属性プロジェクション: 検索・表示に使う項目のみ個別属性として保持
+- metadata: 既定は従来どおり data 全体のJSON文字列
+  （オプトイン: プロジェクション済み項目の除外、閾値以上のzlib/zstd圧縮（Binary属性））
+- TTL: バッチ単位で1回だけ計算
+- アイテムサイズ（DynamoDBの課金サイズ近似）を集計し、証跡に出力
+"""
+import json
+import math
+import time
+import zlib
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+
+try:
+    import zstandard
+except ImportError:  # Lambdaレイヤー未導入時はzlibで代替
+    zstandard = None
+
+DEFAULT_PROJECTION = ['name', 'category', 'description']
+
+# 書き込み1WCUあたりのアイテムサイズ
+WCU_ITEM_BYTES = 1024
+
+# zstdフレームのマジックナンバー（読み出し時の判別用）
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def attribute_size(value: Any) -> int:
+    """DynamoDBの属性値サイズ近似（文字列はUTF-8バイト数、数値は有効桁/2+1）"""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, (int, float, Decimal)):
+        digits = len(str(abs(value)).replace('.', '').lstrip('0')) or 1
+        return math.ceil(digits / 2) + 1
+    if isinstance(value, dict):
+        return 3 + sum(len(k.encode('utf-8')) + attribute_size(v) + 1 for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return 3 + sum(attribute_size(v) + 1 for v in value)
+    return len(str(value).encode('utf-8'))
+
+def item_size(item: Dict[str, Any]) -> int:
+    """アイテムサイズ（属性名＋属性値）"""
+    return sum(len(name.encode('utf-8')) + attribute_size(value) for name, value in item.items())
+
+def decode_metadata(value: Any) -> Dict[str, Any]:
+    """metadata属性の復元（JSON文字列／zlib／zstdを自動判別）"""
+    if isinstance(value, str):
+        return json.loads(value)
+    data = bytes(value)
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to decode this metadata')
+        return json.loads(zstandard.ZstdDecompressor().decompress(data))
+    return json.loads(zlib.decompress(data))
+
+class ItemEncoder:
+    """バッチ単位のエンコード設定とサイズ統計"""
+    
+    def __init__(self, batch_id: str, projection: Optional[List[str]] = None,
+                 metadata_encoding: str = 'json', compress_min_bytes: int = 256,
+                 include_projected_in_metadata: bool = True, ttl_days: int = 30):
+        self.batch_id = batch_id
+        self.projection = DEFAULT_PROJECTION if projection is None else projection
+        self.metadata_encoding = metadata_encoding
+        if metadata_encoding == 'zstd' and zstandard is None:
+            print('zstandard未導入のためmetadataはzlibで圧縮')
+            self.metadata_encoding = 'zlib'
+        self.compress_min_bytes = compress_min_bytes
+        self.include_projected_in_metadata = include_projected_in_metadata
+        # TTLはバッチ内で共通（アイテムごとの時刻取得を行わない）
+        self.ttl = int(time.time()) + ttl_days * 24 * 60 * 60
+        self._compressor = zstandard.ZstdCompressor(level=3) if self.metadata_encoding == 'zstd' else None
+        self.stats = {
+            'items': 0,
+            'total_bytes': 0,
+            'max_bytes': 0,
+            'estimated_wcu': 0,
+            'metadata_raw_bytes': 0,
+            'metadata_stored_bytes': 0,
+            'compressed_items': 0
+        }
+    
+    @classmethod
+    def from_config(cls, batch_id: str, config: Dict[str, Any]) -> 'ItemEncoder':
+        """イベント／環境変数の設定値から生成"""
+        projection = config.get('projection')
+        if isinstance(projection, str):
+            projection = [field.strip() for field in projection.split(',') if field.strip()]
+        return cls(
+            batch_id,
+            projection=projection,
+            metadata_encoding=config.get('metadata_encoding', 'json'),
+            compress_min_bytes=int(config.get('compress_min_bytes', 256)),
+            include_projected_in_metadata=str(config.get('include_projected_in_metadata', 'true')).lower() == 'true',
+            ttl_days=int(config.get('ttl_days', 30))
+        )
+    
+    def _encode_metadata(self, data: Dict[str, Any]) -> Any:
+        if self.metadata_encoding == 'none':
+            return None
+        if self.include_projected_in_metadata:
+            payload = data
+        else:
+            payload = {k: v for k, v in data.items() if k not in self.projection}
+        # 全体コピー時は従来どおり空でも保持
+        if not payload and not self.include_projected_in_metadata:
+            return None
+        
+        raw = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+        raw_bytes = raw.encode('utf-8')
+        self.stats['metadata_raw_bytes'] += len(raw_bytes)
+        
+        if self.metadata_encoding == 'json' or len(raw_bytes) < self.compress_min_bytes:
+            return raw
+        
+        if self._compressor is not None:
+            compressed = self._compressor.compress(raw_bytes)
+        else:
+            compressed = zlib.compress(raw_bytes, 6)
+        # 圧縮で小さくならない場合は元のJSONを保持
+        if len(compressed) >= len(raw_bytes):
+            return raw
+        self.stats['compressed_items'] += 1
+        return compressed
+    
+    def encode(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        """前処理済みアイテムをDynamoDBアイテムに変換"""
+        data = item['data']
+        dynamodb_item = {
+            'id': item['id'],
+            'batch_id': item['batch_id'],
+            'timestamp': item['timestamp'],
+            'processed_at': item['processed_at'],
+            'ttl': self.ttl
+        }
+        # 差分書き込み用の内容ハッシュ（決定的IDモード時のみ付与される）
+        if item.get('content_hash'):
+            dynamodb_item['content_hash'] = item['content_hash']
+        for field in self.projection:
+            dynamodb_item[field] = data.get(field, '')
+        
+        metadata = self._encode_metadata(data)
+        if metadata is not None:
+            dynamodb_item['metadata'] = metadata
+            self.stats['metadata_stored_bytes'] += attribute_size(metadata)
+        
+        size = item_size(dynamodb_item)
+        self.stats['items'] += 1
+        self.stats['total_bytes'] += size
+        self.stats['max_bytes'] = max(self.stats['max_bytes'], size)
+        self.stats['estimated_wcu'] += math.ceil(size / WCU_ITEM_BYTES)
+        return dynamodb_item
+    
+    def summary(self) -> Dict[str, Any]:
+        """証跡用のサイズ統計"""
+        items = self.stats['items']
+        raw = self.stats['metadata_raw_bytes']
+        return {
+            **self.stats,
+            'avg_bytes': round(self.stats['total_bytes'] / items, 1) if items else 0,
+            'metadata_compression_ratio': round(self.stats['metadata_stored_bytes'] / raw, 3) if raw else None,
+            'projection': self.projection,
+            'metadata_encoding': self.metadata_encoding
+        }
@@ -0,0 +1,141 @@
+"""
+DynamoDB投入件数検証 - Step Functions 2用
+バッチIDのアイテム件数を実際にテーブルから数え、書き込みLambdaの報告件数と照合
+
+- GSI指定時: batch_idをキーとするGSIをQuery（Select=COUNT）でページング
+- GSI未指定時: セグメント分割した並列Scan（Select=COUNT＋batch_idフィルタ）
+読み込みはRCU予算（トークンバケット）内に抑え、スロットリング時は予算を自動で絞る
+"""
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+from botocore.exceptions import ClientError
+from dynamodb_rate_limiter import AdaptiveRateLimiter
+
+# スロットリング系エラー（バックオフして再試行）
+RETRYABLE_ERROR_CODES = [
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'InternalServerError'
+]
+
+# 1ページ（1MB）読み込みあたりのRCU見積り（結果整合性読み込み: 4KBあたり0.5RCU）
+PAGE_RCU_ESTIMATE = 128.0
+
+class LoadVerifier:
+    """バッチ単位の件数検証"""
+    
+    def __init__(self, client, table_name: str, index_name: Optional[str] = None, segments: int = 16,
+                 max_workers: int = 16, rcu_budget: float = 2000.0, consistent_read: bool = False,
+                 max_retries: int = 8):
+        self.client = client
+        self.table_name = table_name
+        self.index_name = index_name
+        self.segments = max(1, segments)
+        self.max_workers = max(1, max_workers)
+        self.consistent_read = consistent_read and not index_name
+        self.max_retries = max_retries
+        # 予算0は無制限
+        self.rate_limiter = AdaptiveRateLimiter(rcu_budget, max_rate=rcu_budget) if rcu_budget > 0 else None
+    
+    def _request(self, operation, params: Dict[str, Any], estimate: float) -> Dict[str, Any]:
+        """RCU予算内で1ページ読み込み（スロットリング時はバックオフ）"""
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(estimate)
+            try:
+                response = operation(**params)
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code', '')
+                if code not in RETRYABLE_ERROR_CODES or attempt >= self.max_retries:
+                    raise
+                if self.rate_limiter is not None:
+                    self.rate_limiter.on_throttle()
+                time.sleep(random.uniform(0, min(5.0, 0.05 * (2 ** attempt))))
+                attempt += 1
+                continue
+            if self.rate_limiter is not None:
+                consumed = response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+                self.rate_limiter.record(consumed, estimate)
+            return response
+    
+    def _count_pages(self, operation, params: Dict[str, Any]) -> Dict[str, Any]:
+        """LastEvaluatedKeyがなくなるまでCOUNTを集計"""
+        totals = {'count': 0, 'scanned_count': 0, 'consumed_rcu': 0.0, 'pages': 0}
+        estimate = PAGE_RCU_ESTIMATE * (2 if self.consistent_read else 1)
+        while True:
+            response = self._request(operation, params, estimate)
+            consumed = response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+            totals['count'] += response.get('Count', 0)
+            totals['scanned_count'] += response.get('ScannedCount', 0)
+            totals['consumed_rcu'] += consumed
+            totals['pages'] += 1
+            # 次ページの見積りは直前ページの実績値
+            estimate = consumed or estimate
+            if 'LastEvaluatedKey' not in response:
+                return totals
+            params = {**params, 'ExclusiveStartKey': response['LastEvaluatedKey']}
+    
+    def _base_params(self, batch_id: str) -> Dict[str, Any]:
+        return {
+            'TableName': self.table_name,
+            'Select': 'COUNT',
+            'ExpressionAttributeNames': {'#batch_id': 'batch_id'},
+            'ExpressionAttributeValues': {':batch_id': {'S': batch_id}},
+            'ReturnConsumedCapacity': 'TOTAL'
+        }
+    
+    def count(self, batch_id: str) -> Dict[str, Any]:
+        """バッチIDのアイテム件数を取得"""
+        if self.index_name:
+            params = {
+                **self._base_params(batch_id),
+                'IndexName': self.index_name,
+                'KeyConditionExpression': '#batch_id = :batch_id'
+            }
+            return {'method': 'query', 'index_name': self.index_name, 'segments': 1,
+                    **self._count_pages(self.client.query, params)}
+        
+        base = {
+            **self._base_params(batch_id),
+            'FilterExpression': '#batch_id = :batch_id',
+            'ConsistentRead': self.consistent_read,
+            'TotalSegments': self.segments
+        }
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, self.segments)) as executor:
+            results = list(executor.map(
+                lambda segment: self._count_pages(self.client.scan, {**base, 'Segment': segment}),
+                range(self.segments)
+            ))
+        
+        totals = {'method': 'scan', 'index_name': None, 'segments': self.segments,
+                  'count': 0, 'scanned_count': 0, 'consumed_rcu': 0.0, 'pages': 0}
+        for result in results:
+            for key in ['count', 'scanned_count', 'consumed_rcu', 'pages']:
+                totals[key] += result[key]
+        return totals
+    
+    def verify(self, batch_id: str, expected: int) -> Dict[str, Any]:
+        """期待件数と実件数を照合（MATCH / MISSING / EXTRA）"""
+        started = time.time()
+        counted = self.count(batch_id)
+        observed = counted.pop('count')
+        if observed == expected:
+            status = 'MATCH'
+        elif observed < expected:
+            status = 'MISSING'
+        else:
+            status = 'EXTRA'
+        return {
+            'table_name': self.table_name,
+            'expected': expected,
+            'observed': observed,
+            'difference': observed - expected,
+            'status': status,
+            **counted,
+            'consumed_rcu': round(counted['consumed_rcu'], 1),
+            'duration_ms': int((time.time() - started) * 1000)
+        }
@@ -0,0 +1,120 @@
+"""
+DynamoDB書き込みレートリミッタ - Step Functions 2用
+テーブル容量（DescribeTable）を初期値とするトークンバケットをAIMDで調整
+
+- 加算増加: スロットリングがない間は毎秒一定量ずつレートを上げる（上限まで）
+- 乗算減少: スロットリング（例外・UnprocessedItems）検出時にレートを半減（クールダウン中は1回のみ）
+- 消費WCUの実績値で見積りとの差分をトークンから精算
+複数スレッド（書き込みセグメント）から共有して使用する
+"""
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# オンデマンドテーブルの初期レート・上限（WCU/秒）
+DEFAULT_ON_DEMAND_INITIAL = 1000.0
+DEFAULT_ON_DEMAND_MAX = 40000.0
+
+class AdaptiveRateLimiter:
+    """AIMD調整付きトークンバケット（スレッドセーフ）"""
+    
+    def __init__(self, initial_rate: float, max_rate: Optional[float] = None, min_rate: float = 1.0,
+                 increase_per_sec: Optional[float] = None, decrease_factor: float = 0.5,
+                 cooldown_seconds: float = 1.0, burst_seconds: float = 1.0):
+        self.rate = max(min_rate, initial_rate)
+        self.max_rate = max(self.rate, max_rate or self.rate)
+        self.min_rate = min_rate
+        # 既定では初期レートの5%/秒ずつ増加
+        self.increase_per_sec = increase_per_sec or max(1.0, self.rate * 0.05)
+        self.decrease_factor = decrease_factor
+        self.cooldown_seconds = cooldown_seconds
+        self.burst_seconds = burst_seconds
+        self.tokens = self.rate * burst_seconds
+        self.lock = threading.Lock()
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0.0
+        self.stats = {
+            'initial_rate': round(self.rate, 1),
+            'min_rate_seen': self.rate,
+            'max_rate_seen': self.rate,
+            'throttle_events': 0,
+            'rate_decreases': 0,
+            'wait_seconds': 0.0
+        }
+    
+    @classmethod
+    def from_table(cls, client, table_name: str, share: float = 1.0, headroom: float = 1.0,
+                   on_demand_initial: float = DEFAULT_ON_DEMAND_INITIAL,
+                   on_demand_max: float = DEFAULT_ON_DEMAND_MAX) -> 'AdaptiveRateLimiter':
+        """
+        DescribeTableの容量から生成
+        - プロビジョンド: テーブルとGSIのうち最小のWCUを初期値、headroom倍を上限
+        - オンデマンド: on_demand_initial から開始し、MaxWriteRequestUnits（未設定時はon_demand_max）まで増加
+        share: 同時に書き込むLambda（シャード）1つあたりの割り当て比率
+        """
+        table = client.describe_table(TableName=table_name)['Table']
+        billing_mode = table.get('BillingModeSummary', {}).get('BillingMode', 'PROVISIONED')
+        
+        if billing_mode == 'PAY_PER_REQUEST':
+            max_units = table.get('OnDemandThroughput', {}).get('MaxWriteRequestUnits') or 0
+            max_rate = max_units if max_units > 0 else on_demand_max
+            initial_rate = min(on_demand_initial, max_rate)
+        else:
+            capacities = [table.get('ProvisionedThroughput', {}).get('WriteCapacityUnits', 0)]
+            # GSIへの書き込みも同じアイテム書き込みで消費されるため、最も小さい容量に合わせる
+            for index in table.get('GlobalSecondaryIndexes', []):
+                capacities.append(index.get('ProvisionedThroughput', {}).get('WriteCapacityUnits', 0))
+            initial_rate = min(capacity for capacity in capacities if capacity > 0) if any(capacities) else on_demand_initial
+            max_rate = initial_rate * headroom
+        
+        limiter = cls(initial_rate * share, max_rate=max_rate * share)
+        limiter.stats['billing_mode'] = billing_mode
+        return limiter
+    
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if now - self.last_decrease >= self.cooldown_seconds:
+            self.rate = min(self.max_rate, self.rate + self.increase_per_sec * elapsed)
+            self.stats['max_rate_seen'] = max(self.stats['max_rate_seen'], self.rate)
+        self.tokens = min(self.rate * self.burst_seconds, self.tokens + self.rate * elapsed)
+    
+    def acquire(self, units: float) -> None:
+        """unitsぶんのトークンが貯まるまで待機して消費（バケット容量を超える要求は満杯時に許可）"""
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= min(units, self.rate * self.burst_seconds):
+                    self.tokens -= units
+                    return
+                wait_seconds = (min(units, self.rate * self.burst_seconds) - self.tokens) / self.rate
+                self.stats['wait_seconds'] += wait_seconds
+            time.sleep(wait_seconds)
+    
+    def record(self, consumed: float, estimated: float) -> None:
+        """実際の消費WCUと見積りの差分を精算"""
+        with self.lock:
+            self.tokens -= consumed - estimated
+    
+    def on_throttle(self) -> None:
+        """スロットリング検出時にレートを乗算減少"""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.stats['throttle_events'] += 1
+            if now - self.last_decrease >= self.cooldown_seconds:
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                self.tokens = min(self.tokens, 0.0)
+                self.last_decrease = now
+                self.stats['rate_decreases'] += 1
+                self.stats['min_rate_seen'] = min(self.stats['min_rate_seen'], self.rate)
+    
+    def summary(self) -> Dict[str, Any]:
+        """証跡用の統計"""
+        return {
+            **self.stats,
+            'final_rate': round(self.rate, 1),
+            'min_rate_seen': round(self.stats['min_rate_seen'], 1),
+            'max_rate_seen': round(self.stats['max_rate_seen'], 1),
+            'wait_seconds': round(self.stats['wait_seconds'], 2)
+        }
@@ -0,0 +1,420 @@
+"""
+DynamoDB並列書き込みエンジン - Step Functions 2用
+アイテムをセグメントに分割し、スレッドプールで並列にBatchWriteItem
+
+- セグメントごとに専用のバッチライター（25件単位でフラッシュ）
+- UnprocessedItems を指数バックオフ＋ジッターで再送
+- 再送上限超過・検証エラーをアイテム単位の失敗として集計
+- ReturnConsumedCapacity で消費WCUを記録
+- レートリミッタ指定時は送信前にトークンを取得し、スロットリングを通知（AIMD）
+- failure_sink指定時は失敗アイテムを逐次引き渡し、統計には件数のみ保持（大量失敗時のメモリ抑制）
+- 差分書き込み（content_hash）: BatchGetItemで既存ハッシュを照合して未変更アイテムを除外（skip_unchanged）、
+  または条件付きPutItemで変更時のみ上書き（conditional）
+  ttl_refresh_before指定時は、未変更でも保存済みttlがその時刻より前のアイテムは上書きしてttlを延長
+"""
+import random
+import time
+from decimal import Decimal
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+
+# BatchWriteItemの1リクエストあたり上限
+BATCH_WRITE_LIMIT = 25
+# BatchGetItemの1リクエストあたり上限
+BATCH_GET_LIMIT = 100
+
+# 書き込みモード
+# put: 常に上書き / skip_unchanged: 既存と同じcontent_hashのアイテムを除外 / conditional: 条件付きPutItem
+WRITE_MODES = ['put', 'skip_unchanged', 'conditional']
+
+# スロットリング系エラー（バックオフして再送）
+RETRYABLE_ERROR_CODES = [
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'InternalServerError'
+]
+
+_serializer = TypeSerializer()
+
+def to_dynamodb_value(value: Any) -> Any:
+    """TypeSerializerが受け付けないfloatをDecimalに変換（文字列経由で2進誤差を持ち込まない）"""
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {key: to_dynamodb_value(child) for key, child in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamodb_value(child) for child in value]
+    return value
+
+def serialize_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Python型のアイテムを低レベルAPI形式（AttributeValue）に変換
+    変換できない値（NaN・Infinity・未対応の型）はTypeErrorまたはValueError
+    """
+    return {key: _serializer.serialize(to_dynamodb_value(value)) for key, value in item.items()}
+
+def attribute_key(serialized: Dict[str, Any], key_attributes: List[str]) -> Tuple:
+    """低レベルAPI形式のキー属性を照合用のタプルに変換（型も含めて比較）"""
+    return tuple(next(iter(serialized[name].items())) for name in key_attributes)
+
+def new_write_stats() -> Dict[str, Any]:
+    return {
+        'success_count': 0,
+        'failed_count': 0,
+        'failed_items': [],
+        'consumed_wcu': 0.0,
+        'requests': 0,
+        'unprocessed_retries': 0,
+        'throttle_retries': 0,
+        'segments': 0,
+        'skipped_unchanged': 0,
+        'consumed_rcu': 0.0
+    }
+
+def merge_write_stats(total: Dict[str, Any], stats: Dict[str, Any]) -> None:
+    """セグメント単位の統計を全体へ加算"""
+    total['success_count'] += stats['success_count']
+    total['failed_count'] += stats['failed_count']
+    total['failed_items'].extend(stats['failed_items'])
+    total['consumed_wcu'] += stats['consumed_wcu']
+    total['requests'] += stats['requests']
+    total['unprocessed_retries'] += stats['unprocessed_retries']
+    total['throttle_retries'] += stats['throttle_retries']
+    total['segments'] += stats['segments']
+    total['skipped_unchanged'] += stats['skipped_unchanged']
+    total['consumed_rcu'] += stats['consumed_rcu']
+
+class SegmentBatchWriter:
+    """
+    1セグメント専用のバッチライター
+    スレッド間で共有しない（統計もセグメント内で完結させ、最後に呼び出し元で集計）
+    """
+    
+    def __init__(self, client, table_name: str, max_retries: int, base_backoff: float, max_backoff: float,
+                 conditional: bool = False, rate_limiter=None, failure_sink=None,
+                 ttl_refresh_before: Optional[int] = None):
+        self.client = client
+        self.ttl_refresh_before = ttl_refresh_before
+        self.failure_sink = failure_sink
+        self.table_name = table_name
+        self.conditional = conditional
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.buffer: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+        self.stats = new_write_stats()
+        self.stats['segments'] = 1
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+    
+    def put_item(self, item: Dict[str, Any]) -> None:
+        try:
+            serialized = serialize_item(item)
+        except (TypeError, ValueError, ArithmeticError) as e:
+            # 変換できないアイテムのみ失敗として扱い、呼び出し全体は止めない
+            self._fail([(item, None)], f'SerializationError: {e}')
+            return
+        self.buffer.append((item, serialized))
+        if len(self.buffer) >= BATCH_WRITE_LIMIT:
+            self.flush()
+    
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+        pending = self.buffer
+        self.buffer = []
+        if self.conditional:
+            # BatchWriteItemは条件式を指定できないため1件ずつ条件付きで書き込み
+            self._put_individually(pending)
+        else:
+            self._send(pending)
+    
+    def _sleep(self, attempt: int) -> None:
+        """指数バックオフ（full jitter）"""
+        time.sleep(random.uniform(0, min(self.max_backoff, self.base_backoff * (2 ** attempt))))
+    
+    def _fail(self, entries, error: str) -> None:
+        for item, _ in entries:
+            self.stats['failed_count'] += 1
+            if self.failure_sink is not None:
+                self.failure_sink(item, error)
+            else:
+                self.stats['failed_items'].append({'item': item, 'error': error})
+    
+    def _add_consumed(self, consumed, estimated: float = 0) -> None:
+        units = sum(capacity.get('CapacityUnits', 0) for capacity in consumed or [])
+        self.stats['consumed_wcu'] += units
+        if self.rate_limiter is not None and units:
+            self.rate_limiter.record(units, estimated)
+    
+    def _acquire(self, units: float) -> None:
+        """送信前にトークンを取得（1アイテム=1WCUで見積り、実績で精算）"""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(units)
+    
+    def _throttled(self) -> None:
+        if self.rate_limiter is not None:
+            self.rate_limiter.on_throttle()
+    
+    def _send(self, entries) -> None:
+        """BatchWriteItemを送信し、未処理分はバックオフして再送"""
+        attempt = 0
+        
+        while entries:
+            try:
+                self._acquire(len(entries))
+                self.stats['requests'] += 1
+                response = self.client.batch_write_item(
+                    RequestItems={
+                        self.table_name: [{'PutRequest': {'Item': serialized}} for _, serialized in entries]
+                    },
+                    ReturnConsumedCapacity='TOTAL'
+                )
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code', '')
+                if code in RETRYABLE_ERROR_CODES and attempt < self.max_retries:
+                    self.stats['throttle_retries'] += 1
+                    self._throttled()
+                    self._sleep(attempt)
+                    attempt += 1
+                    continue
+                if code == 'ValidationException':
+                    # バッチ全体が拒否されるため、1件ずつ書き込んで原因アイテムを特定
+                    self._put_individually(entries)
+                else:
+                    self._fail(entries, str(e))
+                return
+            
+            self._add_consumed(response.get('ConsumedCapacity'), len(entries))
+            
+            unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            unprocessed_items = [request['PutRequest']['Item'] for request in unprocessed]
+            remaining = self._match_unprocessed(entries, unprocessed_items)
+            self.stats['success_count'] += len(entries) - len(remaining)
+            entries = remaining
+            
+            if entries:
+                if attempt >= self.max_retries:
+                    self._fail(entries, f'UnprocessedItems: retry limit ({self.max_retries}) exceeded')
+                    return
+                # UnprocessedItemsもスロットリングの兆候として扱う
+                self.stats['unprocessed_retries'] += 1
+                self._throttled()
+                self._sleep(attempt)
+                attempt += 1
+    
+    @staticmethod
+    def _match_unprocessed(entries, unprocessed_items):
+        """応答のUnprocessedItemsを元アイテムに対応付け"""
+        if not unprocessed_items:
+            return []
+        remaining = []
+        matched = set()
+        for unprocessed_item in unprocessed_items:
+            for index, (item, serialized) in enumerate(entries):
+                if index not in matched and serialized == unprocessed_item:
+                    matched.add(index)
+                    remaining.append((item, serialized))
+                    break
+        return remaining
+    
+    def _put_individually(self, entries) -> None:
+        for item, serialized in entries:
+            request = {
+                'TableName': self.table_name,
+                'Item': serialized,
+                'ReturnConsumedCapacity': 'TOTAL'
+            }
+            if self.conditional and 'content_hash' in serialized:
+                # 新規、またはcontent_hashが変わった場合のみ上書き
+                request['ConditionExpression'] = 'attribute_not_exists(content_hash) OR content_hash <> :content_hash'
+                request['ExpressionAttributeValues'] = {':content_hash': serialized['content_hash']}
+                if self.ttl_refresh_before is not None:
+                    # 未変更でもttlの期限が近いアイテムは上書きしてttlを延長
+                    request['ConditionExpression'] += ' OR attribute_not_exists(#ttl) OR #ttl < :refresh_before'
+                    request['ExpressionAttributeNames'] = {'#ttl': 'ttl'}
+                    request['ExpressionAttributeValues'][':refresh_before'] = {'N': str(self.ttl_refresh_before)}
+            
+            attempt = 0
+            while True:
+                try:
+                    self._acquire(1)
+                    self.stats['requests'] += 1
+                    response = self.client.put_item(**request)
+                    self._add_consumed([response.get('ConsumedCapacity', {})], 1)
+                    self.stats['success_count'] += 1
+                except ClientError as e:
+                    code = e.response.get('Error', {}).get('Code', '')
+                    if code == 'ConditionalCheckFailedException':
+                        self.stats['skipped_unchanged'] += 1
+                    elif code in RETRYABLE_ERROR_CODES and attempt < self.max_retries:
+                        self.stats['throttle_retries'] += 1
+                        self._throttled()
+                        self._sleep(attempt)
+                        attempt += 1
+                        continue
+                    else:
+                        self._fail([(item, serialized)], str(e))
+                break
+    
+    def drop_unchanged(self, items: List[Dict[str, Any]], key_attributes: List[str]) -> List[Dict[str, Any]]:
+        """
+        BatchGetItemで既存アイテムのcontent_hash・ttlを取得し、同一ハッシュのアイテムを除外
+        （ttl_refresh_before指定時は、保存済みttlがその時刻より前のアイテムは除外せずttlを延長）
+        読み込みに失敗した場合は除外せず全件を書き込み対象とする
+        """
+        existing = {}
+        keys_by_item = []
+        for start in range(0, len(items), BATCH_GET_LIMIT):
+            # 同一リクエスト内のキー重複はValidationExceptionになるため除外
+            keys = {}
+            for item in items[start:start + BATCH_GET_LIMIT]:
+                key = None
+                if 'content_hash' in item:
+                    try:
+                        serialized_key = serialize_item({name: item[name] for name in key_attributes})
+                    except (TypeError, ValueError, ArithmeticError):
+                        # 照合せず書き込み対象とする（書き込み時に失敗として記録される）
+                        serialized_key = None
+                    if serialized_key is not None:
+                        key = attribute_key(serialized_key, key_attributes)
+                        keys[key] = serialized_key
+                keys_by_item.append(key)
+            if keys:
+                try:
+                    existing.update(self._get_stored(list(keys.values()), key_attributes))
+                except ClientError as e:
+                    print(f"既存アイテム照合エラー（全件書き込み）: {e}")
+                    return items
+        
+        changed = []
+        for item, key in zip(items, keys_by_item):
+            stored = existing.get(key) if key is not None else None
+            if stored and stored['content_hash'] == item['content_hash'] and not self._ttl_expiring(stored):
+                self.stats['skipped_unchanged'] += 1
+            else:
+                changed.append(item)
+        return changed
+    
+    def _ttl_expiring(self, stored: Dict[str, Any]) -> bool:
+        """保存済みttlが延長対象か（ttl_refresh_before未指定時は常にFalse）"""
+        if self.ttl_refresh_before is None:
+            return False
+        return stored['ttl'] is None or stored['ttl'] < self.ttl_refresh_before
+    
+    def _get_stored(self, keys: List[Dict[str, Any]], key_attributes: List[str]) -> Dict[Tuple, Dict[str, Any]]:
+        """キーごとの保存済みcontent_hash・ttl"""
+        names = {f"#k{index}": name for index, name in enumerate(key_attributes)}
+        names['#ttl'] = 'ttl'
+        stored_items = {}
+        attempt = 0
+        
+        while keys:
+            self.stats['requests'] += 1
+            response = self.client.batch_get_item(
+                RequestItems={
+                    self.table_name: {
+                        'Keys': keys,
+                        'ProjectionExpression': ', '.join(list(names) + ['content_hash']),
+                        'ExpressionAttributeNames': names
+                    }
+                },
+                ReturnConsumedCapacity='TOTAL'
+            )
+            for capacity in response.get('ConsumedCapacity') or []:
+                self.stats['consumed_rcu'] += capacity.get('CapacityUnits', 0)
+            
+            for stored in response.get('Responses', {}).get(self.table_name, []):
+                if 'content_hash' in stored:
+                    stored_items[attribute_key(stored, key_attributes)] = {
+                        'content_hash': stored['content_hash'].get('S'),
+                        'ttl': int(stored['ttl']['N']) if 'N' in stored.get('ttl', {}) else None
+                    }
+            
+            keys = response.get('UnprocessedKeys', {}).get(self.table_name, {}).get('Keys', [])
+            if keys:
+                if attempt >= self.max_retries:
+                    raise ClientError({'Error': {'Code': 'UnprocessedKeys', 'Message': 'retry limit exceeded'}}, 'BatchGetItem')
+                self._sleep(attempt)
+                attempt += 1
+        return stored_items
+
+class DynamoDBWriteEngine:
+    """セグメント分割＋スレッドプールによる並列書き込み"""
+    
+    def __init__(self, client, table_name: str, max_workers: int = 4, segment_size: int = 500,
+                 max_retries: int = 8, base_backoff: float = 0.05, max_backoff: float = 5.0,
+                 write_mode: str = 'put', key_attributes: List[str] = None, rate_limiter=None,
+                 failure_sink=None, ttl_refresh_before: Optional[int] = None):
+        self.client = client
+        self.ttl_refresh_before = ttl_refresh_before
+        self.failure_sink = failure_sink
+        self.table_name = table_name
+        self.rate_limiter = rate_limiter
+        self.write_mode = write_mode if write_mode in WRITE_MODES else 'put'
+        self.key_attributes = key_attributes or ['id']
+        self.max_workers = max(1, max_workers)
+        self.segment_size = max(BATCH_WRITE_LIMIT, segment_size)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+    
+    def _segments(self, items: Iterable[Dict[str, Any]]) -> Iterator[List[Dict[str, Any]]]:
+        segment = []
+        for item in items:
+            segment.append(item)
+            if len(segment) >= self.segment_size:
+                yield segment
+                segment = []
+        if segment:
+            yield segment
+    
+    def _write_segment(self, segment: List[Dict[str, Any]]) -> Dict[str, Any]:
+        with SegmentBatchWriter(self.client, self.table_name, self.max_retries,
+                                self.base_backoff, self.max_backoff,
+                                conditional=self.write_mode == 'conditional',
+                                rate_limiter=self.rate_limiter,
+                                failure_sink=self.failure_sink,
+                                ttl_refresh_before=self.ttl_refresh_before) as writer:
+            if self.write_mode == 'skip_unchanged':
+                segment = writer.drop_unchanged(segment, self.key_attributes)
+            for item in segment:
+                writer.put_item(item)
+        return writer.stats
+    
+    def write(self, items: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        アイテムを並列書き込み
+        itemsはイテレータでもよい（投入中セグメント数を制限し、メモリ使用量を一定に保つ）
+        """
+        started = time.time()
+        total = new_write_stats()
+        in_flight = set()
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for segment in self._segments(items):
+                in_flight.add(executor.submit(self._write_segment, segment))
+                if len(in_flight) >= self.max_workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        merge_write_stats(total, future.result())
+            
+            for future in in_flight:
+                merge_write_stats(total, future.result())
+        
+        total['consumed_wcu'] = round(total['consumed_wcu'], 1)
+        total['consumed_rcu'] = round(total['consumed_rcu'], 1)
+        duration = time.time() - started
+        total['duration_ms'] = int(duration * 1000)
+        total['items_per_sec'] = round((total['success_count'] + total['skipped_unchanged']) / duration, 1) if duration > 0 else None
+        if self.rate_limiter is not None:
+            total['rate_limiter'] = self.rate_limiter.summary()
+        return total
@@ -0,0 +1,120 @@
+"""
+失敗アイテム退避 - Step Functions 2用
+書き込みに失敗したアイテムを全件、エラー理由付きでS3（NDJSON.gz）へ退避し、再投入時に読み戻す
+
+レコード形式（1行1件）:
+- {"stage": "encode", "error": ..., "source": 前処理済みアイテム}  … 変換で失敗（再投入時は変換からやり直し）
+- {"stage": "write",  "error": ..., "item": DynamoDBアイテム}      … 書き込みで失敗（再投入時はそのまま書き込み）
+Binary属性（圧縮metadata）は {"__bytes__": base64} で表現
+"""
+import base64
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+from decimal import Decimal
+from typing import Any, Dict, Iterator, List, Optional
+
+# 結果JSONに含める失敗サンプル件数
+FAILED_SAMPLE_LIMIT = 5
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(bytes(value)).decode('ascii')}
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, set):
+        return list(value)
+    return str(value)
+
+def _json_object_hook(value: Dict[str, Any]) -> Any:
+    if len(value) == 1 and '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+def describe_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """失敗レコードの要約（IDとエラーのみ）"""
+    target = record.get('item') or record.get('source')
+    if isinstance(target, dict):
+        item_id = target.get('id')
+    else:
+        item_id = str(target)[:200]
+    return {'id': item_id, 'stage': record['stage'], 'error': record['error']}
+
+class FailureSpool:
+    """
+    失敗アイテムを/tmp上のgzip NDJSONへ逐次追記（書き込みスレッドから並行して呼ばれる）
+    メモリには件数・エラー種別ごとの件数・先頭のサンプルのみ保持
+    """
+    
+    def __init__(self):
+        self.raw = tempfile.NamedTemporaryFile(suffix='.ndjson.gz', dir='/tmp', delete=False)
+        self.path = self.raw.name
+        self.stream = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=6)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.errors: Dict[str, int] = {}
+        self.samples: List[Dict[str, Any]] = []
+        self.closed = False
+    
+    def write(self, stage: str, error: str, item: Any = None, source: Any = None) -> None:
+        record = {'stage': stage, 'error': error}
+        if item is not None:
+            record['item'] = item
+        if source is not None:
+            if isinstance(source, (bytes, bytearray)):
+                source = bytes(source).decode('utf-8', errors='replace')
+            if isinstance(source, str):
+                # NDJSONの行はJSONとして復元できれば復元（再投入時に変換し直すため）
+                try:
+                    source = json.loads(source)
+                except ValueError:
+                    pass
+            record['source'] = source
+        line = (json.dumps(record, ensure_ascii=False, default=_json_default) + '\n').encode('utf-8')
+        
+        # エラー種別はメッセージ先頭で集計（アイテム固有の値で種別が増えすぎないように）
+        error_kind = error.split(':')[0][:100]
+        with self.lock:
+            self.stream.write(line)
+            self.count += 1
+            self.errors[error_kind] = self.errors.get(error_kind, 0) + 1
+            if len(self.samples) < FAILED_SAMPLE_LIMIT:
+                self.samples.append(describe_record(record))
+    
+    def close(self) -> None:
+        if not self.closed:
+            self.stream.close()
+            self.raw.close()
+            self.closed = True
+    
+    def upload(self, s3_client, bucket: str, key: str) -> Optional[Dict[str, Any]]:
+        """失敗が1件以上あればS3へアップロードし、再投入用のポインタを返却"""
+        self.close()
+        if not self.count:
+            return None
+        s3_client.upload_file(self.path, bucket, key)
+        return {
+            'bucket': bucket,
+            'key': key,
+            'format': 'ndjson',
+            'compression': 'gzip',
+            'item_count': self.count,
+            'stored_bytes': os.path.getsize(self.path),
+            'errors': self.errors
+        }
+    
+    def discard(self) -> None:
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def iter_failed_records(s3_client, failed_items_s3: Dict[str, Any], buffer_size: int = 1024 * 1024) -> Iterator[Dict[str, Any]]:
+    """退避した失敗レコードを1件ずつ読み込み"""
+    body = s3_client.get_object(Bucket=failed_items_s3['bucket'], Key=failed_items_s3['key'])['Body']
+    stream = io.BufferedReader(gzip.GzipFile(fileobj=body, mode='rb'), buffer_size=buffer_size)
+    for line in iter(stream.readline, b''):
+        if line.strip():
+            yield json.loads(line, object_hook=_json_object_hook)
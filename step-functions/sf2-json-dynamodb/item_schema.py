@@ -0,0 +1,123 @@
+"""
+アイテムスキーマ検証 - Step Functions 2用
+JSON Schemaのサブセットを事前にクロージャへコンパイルし、1件あたりの検証を軽量化
+
+対応キーワード:
+- トップレベル: required / properties / additionalProperties
+- プロパティ: type / enum / minLength / maxLength / minimum / maximum
+コンパイル結果はデータセット単位でキャッシュ（ウォームスタート時は再利用）
+"""
+import json
+from typing import Any, Callable, Dict, List, Optional
+
+DEFAULT_SCHEMA = {
+    'type': 'object',
+    'required': ['name', 'category']
+}
+
+# JSON Schemaの型名 → Python型
+TYPE_MAP = {
+    'string': (str,),
+    'number': (int, float),
+    'integer': (int,),
+    'boolean': (bool,),
+    'object': (dict,),
+    'array': (list,),
+    'null': (type(None),)
+}
+
+# データセット名＋スキーマ → コンパイル済みバリデータ
+_validator_cache: Dict[str, Callable[[Any], Optional[List[str]]]] = {}
+
+def _compile_type(type_names: Any) -> Callable[[Any], bool]:
+    if isinstance(type_names, str):
+        type_names = [type_names]
+    python_types = tuple(t for name in type_names for t in TYPE_MAP[name])
+    # boolはintのサブクラスのため、数値型指定時は明示的に除外
+    exclude_bool = 'boolean' not in type_names
+    
+    def check(value):
+        return isinstance(value, python_types) and not (exclude_bool and isinstance(value, bool))
+    return check
+
+def _compile_property(field: str, spec: Dict[str, Any]) -> List[Callable[[Any], Optional[str]]]:
+    """1プロパティ分の検証関数リストを作成（該当キーワードのみ）"""
+    checks = []
+    
+    if 'type' in spec:
+        type_check = _compile_type(spec['type'])
+        expected = spec['type']
+        checks.append(lambda value: None if type_check(value) else f"'{field}'の型が不正です（期待: {expected}）")
+    
+    if 'enum' in spec:
+        allowed = spec['enum']
+        checks.append(lambda value: None if value in allowed else f"'{field}'の値が許可リストにありません")
+    
+    if 'minLength' in spec or 'maxLength' in spec:
+        min_length = spec.get('minLength', 0)
+        max_length = spec.get('maxLength')
+        checks.append(lambda value: None if not isinstance(value, str) or (
+            len(value) >= min_length and (max_length is None or len(value) <= max_length)
+        ) else f"'{field}'の長さが範囲外です")
+    
+    if 'minimum' in spec or 'maximum' in spec:
+        minimum = spec.get('minimum')
+        maximum = spec.get('maximum')
+        checks.append(lambda value: None if not isinstance(value, (int, float)) or (
+            (minimum is None or value >= minimum) and (maximum is None or value <= maximum)
+        ) else f"'{field}'の値が範囲外です")
+    
+    return checks
+
+def compile_schema(schema: Dict[str, Any]) -> Callable[[Any], Optional[List[str]]]:
+    """
+    スキーマをバリデータ関数へコンパイル
+    バリデータは正常時None、異常時エラーメッセージのリストを返す
+    """
+    required = list(schema.get('required', []))
+    required_set = frozenset(required)
+    properties = schema.get('properties') or {}
+    property_checks = [
+        (field, checks)
+        for field, checks in ((field, _compile_property(field, spec)) for field, spec in properties.items())
+        if checks
+    ]
+    allowed_fields = None if schema.get('additionalProperties', True) else frozenset(properties)
+    
+    def validate(item: Any) -> Optional[List[str]]:
+        if not isinstance(item, dict):
+            return ['アイテムがDict形式ではありません']
+        
+        errors = None
+        # 必須項目は集合演算で一括判定し、欠落時のみ個別にメッセージ化
+        if not required_set <= item.keys():
+            errors = [f"必須フィールド'{field}'が存在しません" for field in required if field not in item]
+        
+        for field, checks in property_checks:
+            if field in item:
+                value = item[field]
+                for check in checks:
+                    message = check(value)
+                    if message:
+                        errors = errors or []
+                        errors.append(message)
+        
+        if allowed_fields is not None:
+            extra = item.keys() - allowed_fields
+            if extra:
+                errors = errors or []
+                errors.append(f"未定義のフィールドがあります: {sorted(extra)}")
+        
+        return errors
+    
+    return validate
+
+def get_validator(dataset: str, schema: Optional[Dict[str, Any]] = None) -> Callable[[Any], Optional[List[str]]]:
+    """データセット用のバリデータを取得（初回のみコンパイル）"""
+    schema = schema or DEFAULT_SCHEMA
+    cache_key = f"{dataset}:{json.dumps(schema, sort_keys=True)}"
+    validator = _validator_cache.get(cache_key)
+    if validator is None:
+        validator = compile_schema(schema)
+        _validator_cache[cache_key] = validator
+    return validator
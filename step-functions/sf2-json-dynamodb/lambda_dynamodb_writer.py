@@ -1,25 +1,74 @@
 """
 DynamoDB書き込みLambda - Step Functions 2用
 処理済みJSONデータをDynamoDBテーブルに書き込み
+
+失敗アイテムは全件S3へ退避（failed_items_s3）し、replay_s3 に指定すると失敗分のみ再投入
 """
+import io
 import json
+import gzip
+import os
+import time
 import boto3
 from datetime import datetime
 from typing import Dict, Any, List
-from botocore.exceptions import ClientError
+from dynamodb_item_encoder import ItemEncoder
+from failed_items_spool import FailureSpool, iter_failed_records
+from dynamodb_rate_limiter import AdaptiveRateLimiter
+from dynamodb_write_engine import DynamoDBWriteEngine
+from structured_logger import get_logger
+
+dynamodb_client = boto3.client('dynamodb')
+s3 = boto3.client('s3')
+logger = get_logger('lambda_dynamodb_writer')
+
+# クレームチェック読み込み時のバッファサイズ
+READ_BUFFER_BYTES = int(os.environ.get('READ_BUFFER_BYTES', str(1024 * 1024)))
+
+# 失敗アイテムの退避先（クレームチェックと同じステージングバケットの failed-items/ 配下）
+FAILED_ITEMS_BUCKET = os.environ.get('FAILED_ITEMS_BUCKET', 'etl-observer-dev-staging')
+
+# 並列書き込み設定
+WRITE_WORKERS = int(os.environ.get('WRITE_WORKERS', '4'))
+WRITE_SEGMENT_SIZE = int(os.environ.get('WRITE_SEGMENT_SIZE', '500'))
+WRITE_MAX_RETRIES = int(os.environ.get('WRITE_MAX_RETRIES', '8'))
+# put: 常に上書き / skip_unchanged: 既存と同じcontent_hashは書き込まない / conditional: 条件付き上書き
+WRITE_MODE = os.environ.get('WRITE_MODE', 'put')
+# 差分書き込みでも、保存済みttlの残りがこの日数未満のアイテムは上書きしてttlを延長（未指定時はITEM_TTL_DAYSの半分）
+# 未変更アイテムが期限切れで消えないよう、投入間隔はこの日数より短くする
+TTL_REFRESH_DAYS = os.environ.get('TTL_REFRESH_DAYS', '')
+
+# 書き込みレート制御（DescribeTableの容量から開始し、スロットリングでAIMD調整）
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_HEADROOM = float(os.environ.get('RATE_LIMIT_HEADROOM', '1.0'))
+ON_DEMAND_INITIAL_WCU = float(os.environ.get('ON_DEMAND_INITIAL_WCU', '1000'))
+ON_DEMAND_MAX_WCU = float(os.environ.get('ON_DEMAND_MAX_WCU', '40000'))
 
-dynamodb = boto3.resource('dynamodb')
+# アイテムエンコード設定（projection: 個別属性として保持する項目、metadata_encoding: json / zlib / zstd / none）
+# 既定は従来のアイテム形式（metadataはdata全体のJSON文字列）。圧縮・プロジェクション項目の除外はオプトイン
+# （metadataを読む側が decode_metadata に対応してから有効にする）
+ITEM_ENCODING_DEFAULTS = {
+    'projection': os.environ.get('ITEM_PROJECTION', 'name,category,description'),
+    'metadata_encoding': os.environ.get('METADATA_ENCODING', 'json'),
+    'compress_min_bytes': os.environ.get('METADATA_COMPRESS_MIN_BYTES', '256'),
+    'include_projected_in_metadata': os.environ.get('METADATA_INCLUDE_PROJECTED', 'true'),
+    'ttl_days': os.environ.get('ITEM_TTL_DAYS', '30')
+}
 
 def lambda_handler(event, context):
     """DynamoDB書き込みメイン関数"""
-    print(f"DynamoDB書き込み開始: {json.dumps(event, default=str)}")
+    logger.log_event("DynamoDB書き込み開始", event, context)
     
     try:
         batch_id = event.get('batch_id')
         processed_items = event.get('processed_items', [])
+        # クレームチェックモード: アイテム本体はS3上のNDJSON（ポインタのみ受け取る）
+        items_s3 = event.get('items_s3')
+        # 再投入モード: 前回退避した失敗アイテム（failed_items_s3）のみを書き込み
+        replay_s3 = event.get('replay_s3')
         table_name = event.get('table_name', 'json-processing-table')
         
-        if not processed_items:
+        if not processed_items and not (items_s3 and items_s3.get('item_count')) and not replay_s3:
             return {
                 'statusCode': 400,
                 'batch_id': batch_id,
@@ -29,45 +78,66 @@ def lambda_handler(event, context):
                                           {'error': '処理対象データなし'})
             }
         
-        # DynamoDBテーブル取得
-        table = dynamodb.Table(table_name)
+        # アイテムエンコード設定（環境変数の既定値をイベントで上書き可能）
+        encoding_config = {**ITEM_ENCODING_DEFAULTS, **event.get('item_encoding', {})}
+        encoder = ItemEncoder.from_config(batch_id, encoding_config)
         
-        # バッチ書き込み実行
-        success_count = 0
-        failed_items = []
+        # 書き込み対象アイテムを1件ずつ生成（変換エラーはアイテム単位の失敗として退避）
+        source_lines = iter_s3_lines(items_s3) if items_s3 and not replay_s3 else None
+        counter = {'total': 0}
+        failure_spool = FailureSpool()
         
-        # 25件ずつバッチ処理（DynamoDBの制限）
-        for i in range(0, len(processed_items), 25):
-            batch_items = processed_items[i:i+25]
-            
-            with table.batch_writer() as batch:
-                for item in batch_items:
-                    try:
-                        # DynamoDB用データ形式に調整
-                        dynamodb_item = {
-                            'id': item['id'],
-                            'batch_id': item['batch_id'],
-                            'timestamp': item['timestamp'],
-                            'name': item['data'].get('name', ''),
-                            'category': item['data'].get('category', ''),
-                            'description': item['data'].get('description', ''),
-                            'metadata': json.dumps(item['data']),
-                            'processed_at': item['processed_at'],
-                            'ttl': int((datetime.now().timestamp()) + (30 * 24 * 60 * 60))  # 30日後
-                        }
-                        
-                        batch.put_item(Item=dynamodb_item)
-                        success_count += 1
-                        
-                    except Exception as e:
-                        failed_items.append({
-                            'item': item,
-                            'error': str(e)
-                        })
-                        print(f"アイテム書き込みエラー: {e}")
+        def dynamodb_items():
+            if replay_s3:
+                yield from replay_items()
+                return
+            for source in (source_lines if source_lines is not None else processed_items):
+                counter['total'] += 1
+                try:
+                    item = json.loads(source) if source_lines is not None else source
+                    yield encoder.encode(item)
+                except Exception as e:
+                    failure_spool.write('encode', str(e), source=source)
+                    print(f"アイテム変換エラー: {e}")
+        
+        def replay_items():
+            for record in iter_failed_records(s3, replay_s3, READ_BUFFER_BYTES):
+                counter['total'] += 1
+                if record['stage'] == 'write':
+                    # 変換済みのため再エンコードせずそのまま書き込み
+                    yield record['item']
+                    continue
+                try:
+                    yield encoder.encode(record['source'])
+                except Exception as e:
+                    failure_spool.write('encode', str(e), source=record['source'])
+        
+        try:
+            # セグメント単位で並列書き込み（UnprocessedItemsはエンジン内で再送）
+            engine = DynamoDBWriteEngine(
+                dynamodb_client, table_name,
+                max_workers=WRITE_WORKERS,
+                segment_size=WRITE_SEGMENT_SIZE,
+                max_retries=WRITE_MAX_RETRIES,
+                write_mode=event.get('write_mode', WRITE_MODE),
+                rate_limiter=create_rate_limiter(event, table_name),
+                failure_sink=lambda item, error: failure_spool.write('write', error, item=item),
+                ttl_refresh_before=ttl_refresh_before(event, encoding_config)
+            )
+            write_stats = engine.write(dynamodb_items())
+            failed_items_s3 = failure_spool.upload(s3, FAILED_ITEMS_BUCKET, failed_items_key(batch_id, event))
+        finally:
+            failure_spool.discard()
+        
+        # 未変更でスキップしたアイテムも反映済みとして成功に含める
+        skipped_count = write_stats['skipped_unchanged']
+        success_count = write_stats['success_count'] + skipped_count
+        failed_count = failure_spool.count
+        for failed in failure_spool.samples:
+            print(f"アイテム失敗（{failed['stage']}）: {failed['error']}")
         
         # 結果判定
-        total_items = len(processed_items)
+        total_items = counter['total']
         success_rate = success_count / total_items if total_items > 0 else 0
         overall_success = success_rate >= 0.9  # 90%以上成功で全体成功とみなす
         
@@ -77,34 +147,130 @@ def lambda_handler(event, context):
             'success': overall_success,
             'total_items': total_items,
             'success_count': success_count,
-            'failed_count': len(failed_items),
+            'written_count': write_stats['success_count'],
+            'skipped_unchanged': skipped_count,
+            'failed_count': failed_count,
+            'failed_items_s3': failed_items_s3,
             'table_name': table_name,
+            'write_mode': engine.write_mode,
+            'source': 'replay' if replay_s3 else ('s3' if items_s3 else 'inline'),
+            'shard_index': event.get('shard_index'),
+            'consumed_wcu': write_stats['consumed_wcu'],
+            'duration_ms': write_stats['duration_ms'],
+            'error': None,
+            'item_sizes': encoder.summary(),
+            'write_stats': {
+                'requests': write_stats['requests'],
+                'segments': write_stats['segments'],
+                'unprocessed_retries': write_stats['unprocessed_retries'],
+                'throttle_retries': write_stats['throttle_retries'],
+                'consumed_rcu': write_stats['consumed_rcu'],
+                'duration_ms': write_stats['duration_ms'],
+                'items_per_sec': write_stats['items_per_sec'],
+                'rate_limiter': write_stats.get('rate_limiter')
+            },
             'evidence': create_evidence(batch_id, 'dynamodb_write', overall_success, {
                 'input_count': total_items,
                 'success_count': success_count,
-                'failed_count': len(failed_items),
-                'table_name': table_name
+                'skipped_unchanged': skipped_count,
+                'failed_count': failed_count,
+                'failed_items_s3': failed_items_s3,
+                'table_name': table_name,
+                'consumed_wcu': write_stats['consumed_wcu'],
+                'unprocessed_retries': write_stats['unprocessed_retries'],
+                'throttle_retries': write_stats['throttle_retries'],
+                'items_per_sec': write_stats['items_per_sec'],
+                'rate_limiter': write_stats.get('rate_limiter'),
+                'item_sizes': encoder.summary()
             })
         }
         
-        if failed_items:
-            result['failed_items'] = failed_items[:5]  # 最初の5件のみ
+        if failed_count:
+            # 先頭のサンプルのみ（全件は failed_items_s3、圧縮metadata等のバイナリを含むためIDとエラーのみ）
+            result['failed_items'] = failure_spool.samples
         
         print(f"DynamoDB書き込み完了: {success_count}/{total_items}件成功")
         return result
-        
+    
     except Exception as e:
         error_msg = f"DynamoDB書き込みエラー: {str(e)}"
         print(error_msg)
+        # 書き込み結果が不明なため対象全件を失敗として数える（ShardWriteFailedと同じ件数）
+        item_count = (event.get('items_s3') or {}).get('item_count', len(event.get('processed_items') or []))
+        # シャード書き込み（Map内のResultSelector）が参照する件数・ポインタは失敗時も返す
         return {
             'statusCode': 500,
-            'batch_id': batch_id,
+            'batch_id': event.get('batch_id'),
             'success': False,
+            'total_items': item_count,
+            'success_count': 0,
+            'skipped_unchanged': 0,
+            'failed_count': item_count,
+            'failed_items_s3': None,
+            'table_name': event.get('table_name', 'json-processing-table'),
+            'shard_index': event.get('shard_index'),
+            'consumed_wcu': 0,
+            'duration_ms': None,
             'error': error_msg,
             'evidence': create_evidence(batch_id, 'dynamodb_write', False, 
                                       {'error': error_msg})
         }
 
+def failed_items_key(batch_id: str, event: Dict[str, Any]) -> str:
+    """失敗アイテム退避先キー（シャード・再投入ごとに別ファイル）"""
+    if event.get('replay_s3'):
+        name = f"replay-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    elif event.get('shard_index') is not None:
+        name = f"shard-{int(event['shard_index']):05d}"
+    else:
+        name = 'items'
+    return f"failed-items/{batch_id}/{name}.ndjson.gz"
+
+def ttl_refresh_before(event: Dict[str, Any], encoding_config: Dict[str, Any]) -> int:
+    """未変更アイテムでもttlを延長する境界時刻（保存済みttlがこれより前なら上書き）"""
+    ttl_days = float(encoding_config.get('ttl_days', 30))
+    refresh_days = float(event.get('ttl_refresh_days') or TTL_REFRESH_DAYS or ttl_days / 2)
+    return int(time.time() + refresh_days * 24 * 60 * 60)
+
+def create_rate_limiter(event: Dict[str, Any], table_name: str):
+    """
+    テーブル容量に基づくレートリミッタを作成
+    シャード並列時は同時実行数で容量を按分（DescribeTable失敗時はレート制御なし）
+    """
+    if not RATE_LIMIT_ENABLED or event.get('rate_limit') is False:
+        return None
+    
+    concurrency = min(
+        int(event.get('write_concurrency') or 1),
+        int(event.get('shard_count') or 1)
+    )
+    try:
+        return AdaptiveRateLimiter.from_table(
+            dynamodb_client, table_name,
+            share=1.0 / max(1, concurrency),
+            headroom=RATE_LIMIT_HEADROOM,
+            on_demand_initial=ON_DEMAND_INITIAL_WCU,
+            on_demand_max=ON_DEMAND_MAX_WCU
+        )
+    except Exception as e:
+        print(f"テーブル容量取得エラー（レート制御なしで続行）: {e}")
+        return None
+
+def iter_s3_lines(items_s3: Dict[str, Any]):
+    """S3上のNDJSON（gzip可）を1行ずつストリーム読み込み（ファイル全体をメモリに載せない）"""
+    response = s3.get_object(Bucket=items_s3['bucket'], Key=items_s3['key'])
+    body = response['Body']
+    
+    if items_s3.get('compression') == 'gzip':
+        stream = io.BufferedReader(gzip.GzipFile(fileobj=body, mode='rb'), buffer_size=READ_BUFFER_BYTES)
+        lines = iter(stream.readline, b'')
+    else:
+        lines = body.iter_lines(chunk_size=READ_BUFFER_BYTES)
+    
+    for line in lines:
+        if line.strip():
+            yield line
+
 def create_evidence(batch_id: str, step: str, success: bool, details: Dict[str, Any]) -> Dict[str, Any]:
     """エビデンス作成"""
     note = f"DynamoDB書き込み{'成功' if success else '失敗'}"
@@ -122,8 +288,23 @@ def create_evidence(batch_id: str, step: str, success: bool, details: Dict[str,
         'output': {'items': details.get('success_count', 0)},
         'load': {
             'table': details.get('table_name', ''),
-            'inserted_rows': details.get('success_count', 0),
+            'inserted_rows': details.get('success_count', 0) - details.get('skipped_unchanged', 0),
+            'skipped_unchanged': details.get('skipped_unchanged', 0),
             'dropped_rows': details.get('failed_count', 0),
+            'failed_items_s3': (details.get('failed_items_s3') or {}).get('key'),
+            'consumed_wcu': details.get('consumed_wcu', 0),
+            'unprocessed_retries': details.get('unprocessed_retries', 0),
+            'throttle_retries': details.get('throttle_retries', 0),
+            'throttle_events': (details.get('rate_limiter') or {}).get('throttle_events', 0),
+            'items_per_sec': details.get('items_per_sec'),
+            'write_rate': {
+                key: details['rate_limiter'].get(key)
+                for key in ['billing_mode', 'initial_rate', 'final_rate', 'min_rate_seen', 'max_rate_seen']
+            } if details.get('rate_limiter') else None,
+            'item_bytes': {
+                key: details.get('item_sizes', {}).get(key, 0)
+                for key in ['total_bytes', 'avg_bytes', 'max_bytes', 'estimated_wcu', 'metadata_compression_ratio']
+            },
             'reason': 'DynamoDB batch write operation'
         },
         'ok': success,
@@ -2,14 +2,26 @@
 JSON処理完了Lambda - Step Functions 2用
 JSON→DynamoDBパイプラインの最終処理と統計情報生成
 """
-import json
+import os
 import boto3
 from datetime import datetime
 from typing import Dict, Any, List
+from dynamodb_load_verifier import LoadVerifier
+from structured_logger import get_logger
+
+dynamodb_client = boto3.client('dynamodb')
+logger = get_logger('lambda_json_finalizer')
+
+# 投入件数検証（テーブルを実際に数えて書き込み件数と照合）
+VERIFY_LOAD = os.environ.get('VERIFY_LOAD', 'false').lower() == 'true'
+# batch_idをパーティションキーとするGSI名（未指定時は並列Scan）
+VERIFY_INDEX_NAME = os.environ.get('VERIFY_INDEX_NAME', '')
+VERIFY_SEGMENTS = int(os.environ.get('VERIFY_SEGMENTS', '16'))
+VERIFY_RCU_BUDGET = float(os.environ.get('VERIFY_RCU_BUDGET', '2000'))
 
 def lambda_handler(event, context):
     """JSON処理完了メイン関数"""
-    print(f"JSON処理完了開始: {json.dumps(event, default=str)}")
+    logger.log_event("JSON処理完了開始", event, context)
     
     try:
         batch_id = event.get('batch_id')
@@ -17,9 +29,22 @@ def lambda_handler(event, context):
         dynamodb_result = event.get('dynamodb_result', {})
         status = event.get('status', 'UNKNOWN')
         
+        # シャード書き込み: シャードごとの結果を1つの書き込み結果に統合
+        shard_results = event.get('shard_results')
+        if shard_results is not None:
+            dynamodb_result = merge_shard_results(shard_results)
+            if status == 'SHARDED':
+                status = 'SUCCESS' if dynamodb_result['success'] else 'PARTIAL_SUCCESS'
+        
         # 統計情報集計
         statistics = calculate_statistics(preprocess_result, dynamodb_result)
         
+        # 投入件数検証（有効時のみ）。不足があれば検証失敗とする
+        if str(event.get('verify_load', VERIFY_LOAD)).lower() == 'true' and dynamodb_result:
+            statistics['verification'] = verify_load(batch_id, dynamodb_result)
+            if statistics['verification']['status'] == 'MISSING':
+                status = 'VERIFICATION_FAILED'
+        
         # 全体成功判定
         overall_success = status == 'SUCCESS'
         
@@ -37,6 +62,8 @@ def lambda_handler(event, context):
                 'status': status,
                 'statistics': statistics,
                 'failures': get_failures(preprocess_result, dynamodb_result),
+                # 失敗アイテムのみを書き込みLambdaへ再投入するためのイベント
+                'replay_requests': build_replay_requests(batch_id, dynamodb_result),
                 'completed_at': datetime.now().isoformat()
             },
             'evidence': evidence
@@ -44,7 +71,7 @@ def lambda_handler(event, context):
         
         print(f"JSON処理完了: {batch_id} - {status}")
         return result
-        
+    
     except Exception as e:
         error_msg = f"JSON処理完了エラー: {str(e)}"
         print(error_msg)
@@ -67,12 +94,23 @@ def calculate_statistics(preprocess_result: Dict[str, Any], dynamodb_result: Dic
     }
     
     if preprocess_result:
-        stats['input_items'] = len(preprocess_result.get('processed_items', []))
+        # クレームチェックモードではprocessed_itemsがステートに含まれないため入力件数を優先
+        stats['input_items'] = preprocess_result.get('input_count', len(preprocess_result.get('processed_items', [])))
         stats['preprocessed_items'] = preprocess_result.get('item_count', 0)
+        # 決定的IDが重複したアイテム（前処理で除外済み、投入件数には含まれない）
+        stats['duplicate_keys'] = preprocess_result.get('duplicate_keys', 0)
     
     if dynamodb_result:
         stats['dynamodb_success'] = dynamodb_result.get('success_count', 0)
         stats['dynamodb_failed'] = dynamodb_result.get('failed_count', 0)
+        stats['consumed_wcu'] = dynamodb_result.get('consumed_wcu', 0)
+        stats['skipped_unchanged'] = dynamodb_result.get('skipped_unchanged', 0)
+        failed_files = failed_item_files(dynamodb_result)
+        if failed_files:
+            stats['failed_items_s3'] = [f"s3://{pointer['bucket']}/{pointer['key']}" for pointer in failed_files]
+        if 'shards' in dynamodb_result:
+            stats['shard_count'] = len(dynamodb_result['shards'])
+            stats['shards'] = dynamodb_result['shards']
     
     total_processed = stats['preprocessed_items']
     if total_processed > 0:
@@ -80,6 +118,91 @@ def calculate_statistics(preprocess_result: Dict[str, Any], dynamodb_result: Dic
     
     return stats
 
+def verify_load(batch_id: str, dynamodb_result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    テーブル上のbatch_idの件数と書き込み件数を照合
+    未変更スキップ分は以前のbatch_idのまま残るため期待件数から除外
+    """
+    expected = dynamodb_result.get('success_count', 0) - dynamodb_result.get('skipped_unchanged', 0)
+    verifier = LoadVerifier(
+        dynamodb_client,
+        dynamodb_result.get('table_name') or 'json-processing-table',
+        index_name=VERIFY_INDEX_NAME or None,
+        segments=VERIFY_SEGMENTS,
+        max_workers=VERIFY_SEGMENTS,
+        rcu_budget=VERIFY_RCU_BUDGET
+    )
+    try:
+        verification = verifier.verify(batch_id, expected)
+    except Exception as e:
+        # 検証自体の失敗は処理結果を変えず、証跡に記録のみ
+        print(f"投入件数検証エラー: {e}")
+        return {'status': 'ERROR', 'expected': expected, 'observed': None, 'error': str(e)}
+    print(f"投入件数検証: {verification['observed']}/{expected}件 ({verification['status']}, "
+          f"{verification['method']}, {verification['duration_ms']}ms)")
+    return verification
+
+def merge_shard_results(shard_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """シャード別の書き込み結果（件数・WCU・証跡）を合算"""
+    merged = {
+        'success_count': 0,
+        'failed_count': 0,
+        'total_items': 0,
+        'consumed_wcu': 0.0,
+        'skipped_unchanged': 0,
+        'failed_items': [],
+        'failed_items_s3': [],
+        'shards': []
+    }
+    errors = []
+    
+    for index, shard in enumerate(shard_results):
+        merged['success_count'] += shard.get('success_count', 0)
+        merged['failed_count'] += shard.get('failed_count', 0)
+        merged['total_items'] += shard.get('total_items', 0)
+        merged['consumed_wcu'] += shard.get('consumed_wcu', 0)
+        merged['skipped_unchanged'] += shard.get('skipped_unchanged', 0)
+        merged['failed_items'].extend(shard.get('failed_items', [])[:5 - len(merged['failed_items'])])
+        if shard.get('failed_items_s3'):
+            merged['failed_items_s3'].append(shard['failed_items_s3'])
+        merged.setdefault('table_name', shard.get('table_name'))
+        if shard.get('error'):
+            errors.append(shard['error'])
+        
+        merged['shards'].append({
+            'shard_index': shard.get('shard_index', index),
+            'success': shard.get('success', False),
+            'total_items': shard.get('total_items', 0),
+            'success_count': shard.get('success_count', 0),
+            'failed_count': shard.get('failed_count', 0),
+            'consumed_wcu': shard.get('consumed_wcu', 0),
+            'duration_ms': shard.get('duration_ms', shard.get('write_stats', {}).get('duration_ms'))
+        })
+    
+    merged['consumed_wcu'] = round(merged['consumed_wcu'], 1)
+    # 書き込みLambdaと同じく90%以上成功で成功（Lambda自体がエラー終了したシャードがあれば失敗）
+    success_rate = merged['success_count'] / merged['total_items'] if merged['total_items'] else 0
+    merged['success'] = success_rate >= 0.9 and not errors
+    if errors:
+        merged['error'] = errors[0]
+    return merged
+
+def failed_item_files(dynamodb_result: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """失敗アイテム退避ファイルのポインタ一覧（シャード統合後はリスト、単一書き込みは1件）"""
+    pointers = (dynamodb_result or {}).get('failed_items_s3') or []
+    return pointers if isinstance(pointers, list) else [pointers]
+
+def build_replay_requests(batch_id: str, dynamodb_result: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """退避ファイルごとの再投入イベント（書き込みLambdaへそのまま渡せる形）"""
+    return [
+        {
+            'batch_id': batch_id,
+            'table_name': dynamodb_result.get('table_name'),
+            'replay_s3': pointer
+        }
+        for pointer in failed_item_files(dynamodb_result)
+    ]
+
 def get_failures(preprocess_result, dynamodb_result):
     """失敗情報収集"""
     failures = []
@@ -111,6 +234,9 @@ def create_evidence(batch_id: str, success: bool, statistics: Dict[str, Any], st
         success_count = statistics.get('dynamodb_success', 0)
         failed_count = statistics.get('dynamodb_failed', 0)
         note_parts.append(f"{success_count}件成功, {failed_count}件失敗")
+        if statistics.get('verification'):
+            verification = statistics['verification']
+            note_parts.append(f"検証: {verification.get('observed')}/{verification.get('expected')}件 {verification['status']}")
     
     if error:
         note_parts.append(f"エラー: {error}")
@@ -133,6 +259,10 @@ def create_evidence(batch_id: str, success: bool, statistics: Dict[str, Any], st
             'table': 'consolidated_summary',
             'inserted_rows': statistics.get('dynamodb_success', 0),
             'dropped_rows': statistics.get('dynamodb_failed', 0),
+            'verification': {
+                key: statistics['verification'].get(key)
+                for key in ['status', 'expected', 'observed', 'method', 'consumed_rcu', 'duration_ms']
+            } if statistics.get('verification') else None,
             'reason': f"JSON処理完了: {status}"
         },
         'ok': success,
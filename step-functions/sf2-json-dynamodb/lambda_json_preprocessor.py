@@ -1,61 +1,149 @@
 """
 JSON前処理Lambda - Step Functions 2用
 JSONデータを検証・変換してDynamoDB投入用に準備
+
+入力はイベント内の input_data、またはS3上のJSON／JSON Lines（input_s3）
+S3入力はストリームで1件ずつ読み込み、検証・変換・退避までを一定メモリで実行
 """
+import io
 import json
-import boto3
+import os
+import gzip
+import hashlib
+import time
 import uuid
+import tempfile
+import boto3
 from datetime import datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Iterable, Iterator
+from batch_transform import get_transform
+from item_schema import get_validator
+from json_stream import iter_json_array
+from structured_logger import get_logger
+
+s3 = boto3.client('s3')
+logger = get_logger('lambda_json_preprocessor')
+
+# クレームチェック（アイテムをS3へ退避しステートにはポインタのみ渡す）設定
+# auto: インライン上限を超えたらS3へ / always: 常にS3へ / never: 常にインライン
+# 退避先は共通のステージングバケット（config/system_config.json の s3_buckets.staging、権限は config/json-processor-lambda-policy.json）
+CLAIM_CHECK_MODE = os.environ.get('CLAIM_CHECK_MODE', 'auto')
+CLAIM_CHECK_BUCKET = os.environ.get('CLAIM_CHECK_BUCKET', 'etl-observer-dev-staging')
+CLAIM_CHECK_COMPRESSION = os.environ.get('CLAIM_CHECK_COMPRESSION', 'gzip')
+# ステート上限256KBに対し、他の項目分の余裕を残したインライン上限
+INLINE_ITEMS_LIMIT_BYTES = int(os.environ.get('INLINE_ITEMS_LIMIT_BYTES', str(128 * 1024)))
+
+# シャード分割設定（1: 分割なし）。シャードごとに書き込みLambdaを並列起動
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '1'))
+MAX_SHARD_COUNT = int(os.environ.get('MAX_SHARD_COUNT', '64'))
+WRITE_CONCURRENCY = int(os.environ.get('WRITE_CONCURRENCY', '8'))
+
+# 入力読み込み・検証設定
+READ_BUFFER_BYTES = int(os.environ.get('READ_BUFFER_BYTES', str(1024 * 1024)))
+MAX_VALIDATION_ERRORS = int(os.environ.get('MAX_VALIDATION_ERRORS', '100'))
+# fail: 不正アイテムが1件でもあればバッチ失敗 / skip: 不正アイテムを除外して続行
+INVALID_ITEMS_MODE = os.environ.get('INVALID_ITEMS_MODE', 'fail')
+
+# 変換はこの件数ごとのチャンクに列単位で適用
+TRANSFORM_CHUNK_SIZE = int(os.environ.get('TRANSFORM_CHUNK_SIZE', '1000'))
+
+# アイテムID設定
+# uuid: 毎回新規ID / deterministic: キー項目のハッシュをIDとし、内容ハッシュ（content_hash）を付与
+ID_MODE = os.environ.get('ID_MODE', 'uuid')
+# 決定的IDの元にするキー項目（未指定時はアイテム全体）
+ID_KEY_FIELDS = os.environ.get('ID_KEY_FIELDS', '')
+
+class ItemValidationError(Exception):
+    """アイテム検証でバッチを失敗させる場合の例外（退避途中の一時ファイルは破棄される）"""
+    
+    def __init__(self, errors: List[str]):
+        super().__init__(f"JSON検証失敗: {errors}")
+        self.errors = errors
 
 def lambda_handler(event, context):
     """JSON前処理メイン関数"""
-    print(f"JSON前処理開始: {json.dumps(event, default=str)}")
+    logger.log_event("JSON前処理開始", event, context)
     
     try:
         batch_id = event.get('batch_id', f'JSON_{datetime.now().strftime("%Y%m%d%H%M")}')
-        input_data = event.get('input_data', {})
+        input_s3 = event.get('input_s3')
         
-        # JSONデータ検証
-        validation_result = validate_json_data(input_data)
-        if not validation_result['valid']:
-            return {
-                'statusCode': 400,
-                'batch_id': batch_id,
-                'success': False,
-                'error': f"JSON検証失敗: {validation_result['errors']}",
-                'evidence': create_evidence(batch_id, 'json_preprocess', False, 
-                                          {'error': validation_result['errors']})
-            }
+        if input_s3:
+            source_items = iter_s3_items(input_s3)
+        else:
+            input_data = event.get('input_data', {})
+            # ドキュメント構造の検証（アイテム単位の検証はストリーム処理中に実施）
+            validation_result = validate_json_data(input_data)
+            if not validation_result['valid']:
+                return validation_failure(batch_id, validation_result['errors'])
+            source_items = input_data['items']
         
-        # DynamoDB用データ変換
-        processed_items = []
-        for item in input_data.get('items', []):
-            processed_item = {
-                'id': str(uuid.uuid4()),
-                'batch_id': batch_id,
-                'timestamp': datetime.now().isoformat(),
-                'data': item,
-                'processed_at': datetime.now().isoformat()
-            }
-            processed_items.append(processed_item)
+        validation = ItemValidation(
+            get_validator(event.get('dataset', 'default'), event.get('schema')),
+            int(event.get('max_validation_errors', MAX_VALIDATION_ERRORS)),
+            event.get('invalid_items', INVALID_ITEMS_MODE) == 'skip'
+        )
+        
+        # 変換定義（データセット単位でコンパイル済みのものを再利用、未指定時は変換なし）
+        transform = get_transform(event.get('dataset', 'default'), event['transform']) if event.get('transform') else None
+        
+        # 読み込み→検証→変換→退避（件数が多い場合はS3へNDJSONで退避）をチャンク単位で流す
+        started = time.time()
+        id_stats = {'duplicate_keys': 0}
+        try:
+            staged = stage_items(
+                batch_id,
+                build_processed_items(
+                    batch_id, validation.filter(source_items),
+                    event.get('id_mode', ID_MODE),
+                    parse_fields(event.get('id_key_fields', ID_KEY_FIELDS)),
+                    event.get('dataset', 'default'),
+                    transform,
+                    id_stats
+                ),
+                claim_check_mode(event.get('claim_check', CLAIM_CHECK_MODE)),
+                event.get('claim_check_compression', CLAIM_CHECK_COMPRESSION),
+                min(int(event.get('shard_count', SHARD_COUNT)), MAX_SHARD_COUNT)
+            )
+        except ItemValidationError as e:
+            return validation_failure(batch_id, e.errors, validation.summary())
+        
+        duration = time.time() - started
+        throughput = {
+            'duration_ms': int(duration * 1000),
+            'items_per_sec': round(validation.input_count / duration, 1) if duration > 0 else None
+        }
         
         # 成功レスポンス
         result = {
             'statusCode': 200,
             'batch_id': batch_id,
             'success': True,
-            'processed_items': processed_items,
-            'item_count': len(processed_items),
+            **staged,
+            # シャード書き込みの同時実行数（MapのMaxConcurrencyPathで参照）
+            'write_concurrency': int(event.get('write_concurrency', WRITE_CONCURRENCY)),
+            'input_count': validation.input_count,
+            'id_mode': event.get('id_mode', ID_MODE),
+            'duplicate_keys': id_stats['duplicate_keys'],
+            'source': 's3' if input_s3 else 'inline',
+            'validation': validation.summary(),
+            'transform': transform.summary() if transform else None,
+            'throughput': throughput,
             'evidence': create_evidence(batch_id, 'json_preprocess', True, {
-                'input_count': len(input_data.get('items', [])),
-                'output_count': len(processed_items)
+                'input': {key: input_s3[key] for key in ['bucket', 'key'] if key in input_s3} if input_s3 else {},
+                'input_count': validation.input_count,
+                'output_count': staged['item_count'],
+                'invalid_count': validation.invalid_count,
+                'duplicate_keys': id_stats['duplicate_keys'],
+                'items_s3': staged.get('items_s3'),
+                'shard_count': staged.get('shard_count'),
+                'throughput': throughput
             })
         }
         
-        print(f"JSON前処理完了: {result['item_count']}件処理")
+        print(f"JSON前処理完了: {result['item_count']}件処理 ({throughput['items_per_sec']} items/sec)")
         return result
-        
+    
     except Exception as e:
         error_msg = f"JSON前処理エラー: {str(e)}"
         print(error_msg)
@@ -68,8 +156,265 @@ def lambda_handler(event, context):
                                       {'error': error_msg})
         }
 
+def validation_failure(batch_id: str, errors: List[str], validation: Dict[str, Any] = None) -> Dict[str, Any]:
+    """検証失敗レスポンス"""
+    return {
+        'statusCode': 400,
+        'batch_id': batch_id,
+        'success': False,
+        'error': f"JSON検証失敗: {errors}",
+        'validation': validation,
+        'evidence': create_evidence(batch_id, 'json_preprocess', False, 
+                                  {'error': errors, **(validation or {})})
+    }
+
+class ItemValidation:
+    """
+    アイテムを流しながら検証し、件数とエラー（上限付き）を集計
+    fail モードでは不正アイテム検出後、エラー上限到達またはストリーム終端で ItemValidationError
+    """
+    
+    def __init__(self, validator, max_errors: int, skip_invalid: bool):
+        self.validator = validator
+        self.max_errors = max(1, max_errors)
+        self.skip_invalid = skip_invalid
+        self.input_count = 0
+        self.invalid_count = 0
+        self.errors: List[str] = []
+    
+    def filter(self, items: Iterable[Any]) -> Iterator[Dict[str, Any]]:
+        validator = self.validator
+        for index, item in enumerate(items):
+            self.input_count += 1
+            messages = validator(item)
+            if not messages:
+                yield item
+                continue
+            
+            self.invalid_count += 1
+            for message in messages:
+                if len(self.errors) < self.max_errors:
+                    self.errors.append(f"アイテム{index}: {message}")
+            if not self.skip_invalid and len(self.errors) >= self.max_errors:
+                raise ItemValidationError(self.errors)
+        
+        if self.input_count == 0:
+            raise ItemValidationError(["'items'が空です"])
+        if self.invalid_count and not self.skip_invalid:
+            raise ItemValidationError(self.errors)
+    
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'input_count': self.input_count,
+            'invalid_count': self.invalid_count,
+            'errors': self.errors,
+            'errors_truncated': self.invalid_count > len(self.errors)
+        }
+
+def iter_s3_items(input_s3: Dict[str, Any]) -> Iterator[Any]:
+    """
+    S3上のJSON／JSON Lines（gzip可）を1件ずつストリーム読み込み
+    - json: トップレベル配列、または items_key（既定 'items'）の配列
+    - jsonl / ndjson: 1行1アイテム
+    形式・圧縮の指定がない場合はキーの拡張子から判定
+    """
+    key = input_s3['key']
+    compression = input_s3.get('compression') or ('gzip' if key.endswith('.gz') else 'none')
+    data_format = input_s3.get('format') or (
+        'jsonl' if key.replace('.gz', '').endswith(('.jsonl', '.ndjson')) else 'json'
+    )
+    
+    body = s3.get_object(Bucket=input_s3['bucket'], Key=key)['Body']
+    stream = io.BufferedReader(gzip.GzipFile(fileobj=body, mode='rb'), buffer_size=READ_BUFFER_BYTES) \
+        if compression == 'gzip' else body
+    
+    if data_format in ['jsonl', 'ndjson']:
+        lines = iter(stream.readline, b'') if compression == 'gzip' else body.iter_lines(chunk_size=READ_BUFFER_BYTES)
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+        return
+    
+    yield from iter_json_array(stream, chunk_size=READ_BUFFER_BYTES, array_key=input_s3.get('items_key', 'items'))
+
+def build_processed_items(batch_id: str, items: Iterable[Dict[str, Any]], id_mode: str = 'uuid',
+                          key_fields: List[str] = None, dataset: str = 'default', transform=None,
+                          id_stats: Dict[str, int] = None):
+    """
+    入力アイテムをDynamoDB投入用に変換（チャンク単位で変換し1件ずつ生成）
+    タイムスタンプはバッチで1回、uuidモードのIDは実行ごとの接頭辞＋連番
+    deterministicモードで同じIDが重複した場合は最初のアイテムのみ生成し、
+    重複件数を id_stats['duplicate_keys'] に記録（シャード間で書き込み順が決まらず、投入件数の照合もずれるため）
+    """
+    processed_at = datetime.now().isoformat()
+    id_prefix = uuid.uuid4().hex
+    sequence = 0
+    seen_ids = set()
+    
+    for chunk in iter_chunks(items, TRANSFORM_CHUNK_SIZE):
+        if transform is not None:
+            chunk = transform.apply(chunk)
+        for item in chunk:
+            processed = {
+                'id': f"{id_prefix}-{sequence:08d}",
+                'batch_id': batch_id,
+                'timestamp': processed_at,
+                'data': item,
+                'processed_at': processed_at
+            }
+            if id_mode == 'deterministic':
+                processed['id'], processed['content_hash'] = item_hashes(item, key_fields, dataset)
+                if processed['id'] in seen_ids:
+                    if id_stats is not None:
+                        id_stats['duplicate_keys'] = id_stats.get('duplicate_keys', 0) + 1
+                    continue
+                seen_ids.add(processed['id'])
+            sequence += 1
+            yield processed
+
+def iter_chunks(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """イテレータを指定件数のリストに分割"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def item_hashes(item: Dict[str, Any], key_fields: List[str], dataset: str):
+    """
+    決定的ID（データセット＋キー項目）と内容ハッシュを計算
+    再実行・リトライ時も同じアイテムは同じIDになり、内容が変わらなければ同じハッシュになる
+    """
+    content = json.dumps(item, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+    content_hash = hashlib.blake2b(content, digest_size=16).hexdigest()
+    
+    if key_fields:
+        key = json.dumps([item.get(field) for field in key_fields], ensure_ascii=False, default=str).encode('utf-8')
+        key_hash = hashlib.blake2b(key, digest_size=16, person=b'item-id').hexdigest()
+    else:
+        key_hash = hashlib.blake2b(content, digest_size=16, person=b'item-id').hexdigest()
+    return f"{dataset}#{key_hash}", content_hash
+
+def parse_fields(value: Any) -> List[str]:
+    """カンマ区切り文字列またはリストの項目名指定を正規化"""
+    if isinstance(value, str):
+        return [field.strip() for field in value.split(',') if field.strip()]
+    return list(value or [])
+
+def claim_check_mode(value: Any) -> str:
+    """claim_check指定の正規化（true/false も受け付ける）"""
+    if isinstance(value, bool):
+        return 'always' if value else 'never'
+    return value if value in ['auto', 'always', 'never'] else 'auto'
+
+def stage_items(batch_id: str, items: Iterable[Dict[str, Any]], claim_check_mode: str,
+                compression: str, shard_count: int = 1) -> Dict[str, Any]:
+    """
+    変換済みアイテムの受け渡し方法を決定
+    インライン上限内なら processed_items としてそのまま返却、
+    超えた時点でNDJSON（gzip可）の一時ファイルへ切り替え、S3へアップロードしてポインタを返却
+    shard_count > 1 の場合は常にS3へ退避し、ラウンドロビンでN個のシャードに分割
+    """
+    if shard_count > 1:
+        claim_check_mode = 'always'
+    
+    inline = []
+    inline_bytes = 0
+    spools = []
+    item_count = 0
+    
+    try:
+        for item in items:
+            line = (json.dumps(item, ensure_ascii=False) + '\n').encode('utf-8')
+            
+            if spools:
+                spools[item_count % len(spools)].write(line)
+                item_count += 1
+                continue
+            
+            item_count += 1
+            inline.append((item, line))
+            inline_bytes += len(line)
+            if claim_check_mode == 'always' or (claim_check_mode == 'auto' and inline_bytes > INLINE_ITEMS_LIMIT_BYTES):
+                spools = [Spool(compression) for _ in range(max(1, shard_count))]
+                for index, (_, pending_line) in enumerate(inline):
+                    spools[index % len(spools)].write(pending_line)
+                inline = []
+        
+        if not spools:
+            return {
+                'processed_items': [item for item, _ in inline],
+                'item_count': item_count
+            }
+        
+        if shard_count <= 1:
+            return {
+                'items_s3': upload_spool(batch_id, spools[0], compression, 'items'),
+                'item_count': item_count
+            }
+        
+        shards = [
+            upload_spool(batch_id, spool, compression, f"shard-{index:05d}")
+            for index, spool in enumerate(spools) if spool.item_count
+        ]
+        return {
+            'shards': shards,
+            'shard_count': len(shards),
+            'item_count': item_count
+        }
+    finally:
+        for spool in spools:
+            spool.discard()
+
+class Spool:
+    """/tmp上のNDJSON一時ファイル（gzip圧縮可）"""
+    
+    def __init__(self, compression: str):
+        self.raw = tempfile.NamedTemporaryFile(suffix='.ndjson', dir='/tmp', delete=False)
+        self.path = self.raw.name
+        self.stream = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=6) if compression == 'gzip' else self.raw
+        self.raw_bytes = 0
+        self.item_count = 0
+    
+    def write(self, line: bytes):
+        self.stream.write(line)
+        self.raw_bytes += len(line)
+        self.item_count += 1
+    
+    def close(self):
+        if self.stream is not self.raw:
+            self.stream.close()
+        self.raw.close()
+    
+    def discard(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def upload_spool(batch_id: str, spool: Spool, compression: str, name: str) -> Dict[str, Any]:
+    """一時ファイルをS3へアップロードし、後続へ渡すポインタを作成"""
+    spool.close()
+    suffix = '.ndjson.gz' if compression == 'gzip' else '.ndjson'
+    key = f"claim-check/{batch_id}/{name}{suffix}"
+    s3.upload_file(spool.path, CLAIM_CHECK_BUCKET, key)
+    
+    items_s3 = {
+        'bucket': CLAIM_CHECK_BUCKET,
+        'key': key,
+        'format': 'ndjson',
+        'compression': compression if compression == 'gzip' else 'none',
+        'item_count': spool.item_count,
+        'raw_bytes': spool.raw_bytes,
+        'stored_bytes': os.path.getsize(spool.path)
+    }
+    print(f"クレームチェック: {spool.item_count}件を s3://{CLAIM_CHECK_BUCKET}/{key} へ退避 ({items_s3['stored_bytes']} bytes)")
+    return items_s3
+
 def validate_json_data(data: Dict[str, Any]) -> Dict[str, Any]:
-    """JSONデータ検証"""
+    """JSONドキュメント構造の検証（アイテム単位の検証は ItemValidation で実施）"""
     errors = []
     
     if not isinstance(data, dict):
@@ -83,13 +428,6 @@ def validate_json_data(data: Dict[str, Any]) -> Dict[str, Any]:
     elif len(data['items']) == 0:
         errors.append("'items'が空です")
     
-    # 必須フィールドチェック
-    required_fields = ['name', 'category']
-    for i, item in enumerate(data.get('items', [])):
-        for field in required_fields:
-            if field not in item:
-                errors.append(f"アイテム{i}: 必須フィールド'{field}'が存在しません")
-    
     return {
         'valid': len(errors) == 0,
         'errors': errors
@@ -103,8 +441,12 @@ def create_evidence(batch_id: str, step: str, success: bool, details: Dict[str,
         'flow': 'json-to-dynamodb-pipeline',
         'step': step,
         'input': details.get('input', {}),
-        'output': details.get('output', {}),
-        'load': {},
+        'output': details.get('output', {
+            key: details[key] for key in ['items_s3', 'shard_count'] if details.get(key)
+        }),
+        'load': {
+            key: details[key] for key in ['invalid_count', 'duplicate_keys', 'throughput'] if details.get(key) is not None
+        },
         'ok': success,
         'ts': datetime.now().isoformat(),
         'note': f"JSON前処理{'成功' if success else '失敗'}: {details.get('input_count', 0)}→{details.get('output_count', 0)}件"
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+ログレベル分類ベンチマーク - Step Functions 3用
+フォーマットごとに合成ログ（正解レベル付き）を生成し、従来の処理（全体をデコードして行分割＋部分文字列判定）と
+LogLineReader.iter_blocks（bytes）＋log_level_classifier の lines/sec・正解率を、同じバイト列から比較
+
+実行例:
+  python benchmark_log_classifier.py                          # 各フォーマット 200,000行
+  python benchmark_log_classifier.py --lines 1000000 --formats plain,json
+  python benchmark_log_classifier.py --output classifier_benchmark.json
+"""
+import argparse
+import io
+import json
+import random
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from log_level_classifier import LEVELS, LogLevelClassifier
+from log_stream_reader import LogLineReader
+
+DEFAULT_FORMATS = ['plain', 'json', 'syslog', 'alb', 'cloudfront']
+
+# 本文に別レベルの単語を含むメッセージ（従来の判定が誤分類するケース）
+MESSAGES = [
+    'request completed',
+    'user login succeeded',
+    'retrying after error from upstream',
+    'cache miss, warning threshold not reached',
+    'connection reset by peer',
+    'debug flag ignored in production'
+]
+
+def legacy_count(data: bytes) -> Dict[str, int]:
+    """変更前の process_log_file と同じ処理（全体のデコード・行分割、1行最大4回のupper()と部分文字列検索）"""
+    lines = data.decode('utf-8', errors='ignore').split('\n')
+    log_levels = {'ERROR': 0, 'WARN': 0, 'INFO': 0, 'DEBUG': 0, 'OTHER': 0}
+    for line in lines:
+        if 'ERROR' in line.upper():
+            log_levels['ERROR'] += 1
+        elif 'WARN' in line.upper():
+            log_levels['WARN'] += 1
+        elif 'INFO' in line.upper():
+            log_levels['INFO'] += 1
+        elif 'DEBUG' in line.upper():
+            log_levels['DEBUG'] += 1
+        elif line.strip():
+            log_levels['OTHER'] += 1
+    return log_levels
+
+def _status_for(level: str, rng: random.Random) -> str:
+    return {'ERROR': rng.choice(['500', '502', '503']), 'WARN': rng.choice(['400', '403', '404'])}.get(level, '200')
+
+def generate_line(log_format: str, level: str, rng: random.Random) -> str:
+    """正解レベルを持つ1行を生成"""
+    message = rng.choice(MESSAGES)
+    if log_format == 'plain':
+        return f"2024-05-01 12:00:{rng.randint(0, 59):02d},123 [worker-{rng.randint(1, 8)}] {level} app.module - {message}"
+    if log_format == 'json':
+        return json.dumps({'timestamp': '2024-05-01T12:00:00Z', 'level': level.lower(), 'logger': 'app.module',
+                           'message': message, 'request_id': f"{rng.getrandbits(64):016x}"})
+    if log_format == 'syslog':
+        severity = {'ERROR': 3, 'WARN': 4, 'INFO': 6, 'DEBUG': 7}[level]
+        return f"<{16 * 8 + severity}>May  1 12:00:00 host app[{rng.randint(100, 999)}]: {message}"
+    if log_format == 'alb':
+        return (f"https 2024-05-01T12:00:00.000000Z app/my-alb/50dc6c495c0c9188 192.168.131.39:2817 "
+                f"10.0.0.1:80 0.000 0.001 0.000 {_status_for(level, rng)} 200 34 366 "
+                f"\"GET https://www.example.com:443/api/items?q=error HTTP/1.1\" \"curl/7.46.0\" - -")
+    if log_format == 'cloudfront':
+        return '\t'.join(['2024-05-01', '12:00:00', 'NRT57-C1', '2390', '192.0.2.100', 'GET',
+                          'd111111abcdef8.cloudfront.net', '/error/index.html', _status_for(level, rng),
+                          '-', 'Mozilla/5.0', '-', '-', 'Hit'])
+    raise ValueError(f"Unknown log format: {log_format}")
+
+def generate_lines(log_format: str, count: int, seed: int = 1) -> Tuple[List[str], Dict[str, int]]:
+    """合成ログと正解のレベル別件数"""
+    rng = random.Random(seed)
+    weights = {'ERROR': 5, 'WARN': 10, 'INFO': 70, 'DEBUG': 15}
+    # アクセスログにはDEBUGがないためINFOとして扱う
+    levels = rng.choices(list(weights), weights=list(weights.values()), k=count)
+    if log_format in ['alb', 'cloudfront']:
+        levels = ['INFO' if level == 'DEBUG' else level for level in levels]
+    expected = dict.fromkeys(LEVELS, 0)
+    for level in levels:
+        expected[level] += 1
+    return [generate_line(log_format, level, rng) for level in levels], expected
+
+def accuracy(counts: Dict[str, int], expected: Dict[str, int]) -> float:
+    """レベル別件数の一致率（件数差の合計から算出）"""
+    total = sum(expected.values())
+    difference = sum(abs(counts.get(level, 0) - expected[level]) for level in LEVELS) / 2
+    return round(1 - difference / total, 4) if total else 1.0
+
+def classifier_count(data: bytes) -> Dict[str, Any]:
+    """ストリーミング読み込み（ブロック単位）＋フォーマット自動判別での集計"""
+    return LogLevelClassifier('auto').count(LogLineReader(io.BytesIO(data), 'benchmark.log').iter_blocks(decode=False))
+
+def measure(count: Callable[[bytes], Any], data: bytes, lines: int, repeat: int) -> Tuple[float, Any]:
+    """repeat回の最速値（lines/sec）"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = count(data)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return lines / best if best else 0.0, result
+
+def run_format(log_format: str, count: int, repeat: int) -> Dict[str, Any]:
+    lines, expected = generate_lines(log_format, count)
+    data = ('\n'.join(lines) + '\n').encode('utf-8')
+    legacy_rate, legacy_counts = measure(legacy_count, data, count, repeat)
+    rate, result = measure(classifier_count, data, count, repeat)
+    detected = result['format']
+    return {
+        'format': log_format,
+        'detected_format': detected,
+        'lines': count,
+        'legacy_lines_per_sec': int(legacy_rate),
+        'lines_per_sec': int(rate),
+        'speedup': round(rate / legacy_rate, 2) if legacy_rate else None,
+        'legacy_accuracy': accuracy(legacy_counts, expected),
+        'accuracy': accuracy(result['summary'], expected),
+        'expected': expected,
+        'legacy_counts': legacy_counts,
+        'counts': result['summary']
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='ログレベル分類ベンチマーク')
+    parser.add_argument('--lines', type=int, default=200000, help='フォーマットあたりの行数')
+    parser.add_argument('--formats', default=','.join(DEFAULT_FORMATS), help='カンマ区切りのフォーマット')
+    parser.add_argument('--repeat', type=int, default=3, help='計測回数（最速値を採用）')
+    parser.add_argument('--output', help='結果JSONの出力先')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    formats = [log_format for log_format in args.formats.split(',') if log_format]
+    
+    results = []
+    print(f"{'format':>10} {'detected':>10} {'legacy l/s':>12} {'new l/s':>12} {'speedup':>8} {'legacy acc':>10} {'new acc':>8}")
+    for log_format in formats:
+        result = run_format(log_format, args.lines, args.repeat)
+        results.append(result)
+        print(f"{result['format']:>10} {result['detected_format']:>10} {result['legacy_lines_per_sec']:>12} "
+              f"{result['lines_per_sec']:>12} {result['speedup']:>8} {result['legacy_accuracy']:>10} {result['accuracy']:>8}")
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"結果を出力: {args.output}")
+    return results
+
+if __name__ == "__main__":
+    main()
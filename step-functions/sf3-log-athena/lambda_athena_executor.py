@@ -2,18 +2,20 @@
 Athena クエリ実行Lambda - Step Functions 3用
 作成されたテーブルに対してAthenaクエリを実行し、結果を集計
 """
-import json
 import boto3
-import time
 from datetime import datetime
 from typing import Dict, Any, List
+from etl_poller import bind_context, get_wait_stats, poll_many
+from structured_logger import get_logger
 
 athena = boto3.client('athena')
 s3 = boto3.client('s3')
+logger = get_logger('lambda_athena_executor')
 
 def lambda_handler(event, context):
     """Athena クエリ実行メイン関数"""
-    print(f"Athena クエリ実行開始: {json.dumps(event, default=str)}")
+    bind_context(context)
+    logger.log_event("Athena クエリ実行開始", event, context)
     
     try:
         batch_id = event.get('batch_id')
@@ -34,32 +36,26 @@ def lambda_handler(event, context):
         query_results = []
         total_rows_analyzed = 0
         
-        for table_name in tables_created[:3]:  # 最大3テーブル処理
-            try:
-                # テーブル統計クエリ実行
-                query_result = execute_table_analysis_query(
-                    database_name, table_name, query_output_location
-                )
-                
-                if query_result['success']:
-                    query_results.append({
-                        'table': table_name,
-                        'row_count': query_result['row_count'],
-                        'error_count': query_result['error_count'],
-                        'sample_data': query_result['sample_data']
-                    })
-                    total_rows_analyzed += query_result['row_count']
-                else:
-                    query_results.append({
-                        'table': table_name,
-                        'error': query_result['error']
-                    })
-                    
-            except Exception as e:
-                print(f"テーブル分析エラー {table_name}: {e}")
+        # 全テーブルの分析クエリを一括投入し、まとめて完了待ち
+        target_tables = tables_created[:3]  # 最大3テーブル処理
+        analysis_results = analyze_tables(database_name, target_tables, query_output_location)
+        
+        for table_name in target_tables:
+            query_result = analysis_results[table_name]
+            
+            if query_result['success']:
                 query_results.append({
                     'table': table_name,
-                    'error': str(e)
+                    'row_count': query_result['row_count'],
+                    'error_count': query_result['error_count'],
+                    'sample_data': query_result['sample_data']
+                })
+                total_rows_analyzed += query_result['row_count']
+            else:
+                print(f"テーブル分析エラー {table_name}: {query_result['error']}")
+                query_results.append({
+                    'table': table_name,
+                    'error': query_result['error']
                 })
         
         # ログ分析サマリー生成
@@ -78,6 +74,7 @@ def lambda_handler(event, context):
             'log_summary': log_summary,
             'total_rows_analyzed': total_rows_analyzed,
             'successful_queries': successful_queries,
+            'wait_stats': get_wait_stats(),
             'evidence': create_evidence(batch_id, 'athena_query', overall_success, {
                 'database': database_name,
                 'tables_processed': len(query_results),
@@ -88,7 +85,7 @@ def lambda_handler(event, context):
         
         print(f"Athena クエリ実行完了: {successful_queries}/{len(tables_created)}テーブル成功")
         return result
-        
+    
     except Exception as e:
         error_msg = f"Athena クエリ実行エラー: {str(e)}"
         print(error_msg)
@@ -100,93 +97,117 @@ def lambda_handler(event, context):
             'evidence': create_evidence(batch_id, 'athena_query', False, {'error': error_msg})
         }
 
-def execute_table_analysis_query(database: str, table: str, output_location: str) -> Dict[str, Any]:
-    """テーブル分析クエリ実行"""
-    try:
+def analyze_tables(database: str, tables: List[str], output_location: str) -> Dict[str, Dict[str, Any]]:
+    """テーブル分析クエリ実行（行数・エラー行数・サンプルを全テーブル分並行実行）"""
+    queries = {}
+    for table in tables:
         # 行数カウントクエリ
-        count_query = f"SELECT COUNT(*) as row_count FROM {database}.{table}"
-        
-        count_result = execute_athena_query(count_query, database, output_location)
-        if not count_result['success']:
-            return {'success': False, 'error': count_result['error']}
-        
-        row_count = count_result['data'][0][0] if count_result['data'] else 0
-        
+        queries[(table, 'count')] = f"SELECT COUNT(*) as row_count FROM {database}.{table}"
         # エラーログ数カウント（ログテーブルの場合）
-        error_query = f"""
+        queries[(table, 'error')] = f"""
         SELECT COUNT(*) as error_count 
         FROM {database}.{table} 
         WHERE UPPER(col0) LIKE '%ERROR%' OR UPPER(col0) LIKE '%WARN%'
         """
-        
-        error_result = execute_athena_query(error_query, database, output_location, ignore_errors=True)
-        error_count = error_result['data'][0][0] if error_result.get('data') else 0
-        
         # サンプルデータ取得
-        sample_query = f"SELECT * FROM {database}.{table} LIMIT 5"
-        sample_result = execute_athena_query(sample_query, database, output_location)
+        queries[(table, 'sample')] = f"SELECT * FROM {database}.{table} LIMIT 5"
+    
+    results = execute_athena_queries(queries, database, output_location)
+    
+    analysis = {}
+    for table in tables:
+        count_result = results[(table, 'count')]
+        if not count_result['success']:
+            analysis[table] = {'success': False, 'error': count_result['error']}
+            continue
         
-        return {
+        error_result = results[(table, 'error')]
+        sample_result = results[(table, 'sample')]
+        analysis[table] = {
             'success': True,
-            'row_count': row_count,
-            'error_count': error_count,
+            'row_count': count_result['data'][0][0] if count_result['data'] else 0,
+            'error_count': error_result['data'][0][0] if error_result.get('data') else 0,
             'sample_data': sample_result.get('data', [])[:5]
         }
-        
-    except Exception as e:
-        return {'success': False, 'error': str(e)}
+    
+    return analysis
 
-def execute_athena_query(query: str, database: str, output_location: str, ignore_errors: bool = False) -> Dict[str, Any]:
-    """Athenaクエリ実行"""
-    try:
-        # クエリ実行
-        response = athena.start_query_execution(
-            QueryString=query,
-            QueryExecutionContext={'Database': database},
-            ResultConfiguration={'OutputLocation': output_location}
-        )
-        
-        query_execution_id = response['QueryExecutionId']
-        
-        # 実行完了待機
-        max_wait = 60  # 60秒
-        waited = 0
-        
-        while waited < max_wait:
-            status_response = athena.get_query_execution(QueryExecutionId=query_execution_id)
-            status = status_response['QueryExecution']['Status']['State']
-            
-            if status == 'SUCCEEDED':
-                # 結果取得
-                result_response = athena.get_query_results(QueryExecutionId=query_execution_id)
-                
-                data = []
-                for row in result_response['ResultSet']['Rows'][1:]:  # ヘッダー除外
-                    row_data = [col.get('VarCharValue', '') for col in row['Data']]
-                    # 数値変換試行
-                    converted_row = []
-                    for value in row_data:
-                        try:
-                            converted_row.append(int(value))
-                        except:
-                            converted_row.append(value)
-                    data.append(converted_row)
-                
-                return {'success': True, 'data': data}
-                
-            elif status == 'FAILED':
-                error_msg = status_response['QueryExecution']['Status'].get('StateChangeReason', 'Unknown error')
-                if ignore_errors:
-                    return {'success': False, 'error': error_msg, 'data': []}
-                return {'success': False, 'error': error_msg}
-            
-            time.sleep(5)
-            waited += 5
+def execute_athena_queries(queries: Dict[Any, str], database: str, output_location: str) -> Dict[Any, Dict[str, Any]]:
+    """Athenaクエリを一括実行し、batch_get_query_executionでまとめて完了待機"""
+    results = {}
+    execution_ids = {}
+    
+    # クエリ実行
+    for name, query in queries.items():
+        try:
+            response = athena.start_query_execution(
+                QueryString=query,
+                QueryExecutionContext={'Database': database},
+                ResultConfiguration={'OutputLocation': output_location}
+            )
+            execution_ids[name] = response['QueryExecutionId']
+        except Exception as e:
+            results[name] = {'success': False, 'error': str(e), 'data': []}
+    
+    if not execution_ids:
+        return results
+    
+    # 実行完了待機（最大50件ずつ一括で状態取得）
+    waited = poll_many(
+        list(execution_ids.values()),
+        fetch_query_states,
+        lambda execution: execution is not None and
+            execution['Status']['State'] in ['SUCCEEDED', 'FAILED', 'CANCELLED'],
+        label='athena',
+        initial_interval=0.5,
+        max_interval=5,
+        get_state=lambda execution: execution['Status']['State']
+    )
+    
+    for name, query_execution_id in execution_ids.items():
+        execution = waited['statuses'].get(query_execution_id)
         
-        return {'success': False, 'error': 'Query timeout'}
+        if query_execution_id in waited['pending'] or execution is None:
+            results[name] = {'success': False, 'error': 'Query timeout', 'data': []}
+            continue
         
-    except Exception as e:
-        return {'success': False, 'error': str(e)}
+        status = execution['Status']['State']
+        if status == 'SUCCEEDED':
+            try:
+                results[name] = {'success': True, 'data': fetch_query_rows(query_execution_id)}
+            except Exception as e:
+                results[name] = {'success': False, 'error': str(e), 'data': []}
+        else:
+            error_msg = execution['Status'].get('StateChangeReason', 'Unknown error')
+            results[name] = {'success': False, 'error': error_msg, 'data': []}
+    
+    return results
+
+def fetch_query_states(query_execution_ids: List[str]) -> Dict[str, Any]:
+    """複数クエリの実行状態を一括取得"""
+    response = athena.batch_get_query_execution(QueryExecutionIds=query_execution_ids)
+    return {
+        execution['QueryExecutionId']: execution
+        for execution in response.get('QueryExecutions', [])
+    }
+
+def fetch_query_rows(query_execution_id: str) -> List[List[Any]]:
+    """クエリ結果取得"""
+    result_response = athena.get_query_results(QueryExecutionId=query_execution_id)
+    
+    data = []
+    for row in result_response['ResultSet']['Rows'][1:]:  # ヘッダー除外
+        row_data = [col.get('VarCharValue', '') for col in row['Data']]
+        # 数値変換試行
+        converted_row = []
+        for value in row_data:
+            try:
+                converted_row.append(int(value))
+            except:
+                converted_row.append(value)
+        data.append(converted_row)
+    
+    return data
 
 def generate_log_summary(query_results: List[Dict[str, Any]]) -> Dict[str, Any]:
     """ログ分析サマリー生成"""
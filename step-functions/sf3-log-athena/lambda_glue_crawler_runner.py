@@ -2,17 +2,19 @@
 Glue Crawler実行Lambda - Step Functions 3用
 ログデータをGlue Crawlerでスキャンし、Athenaテーブル作成
 """
-import json
 import boto3
-import time
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List
+from etl_poller import PollTimeout, bind_context, get_wait_stats, poll_until
+from structured_logger import get_logger
 
 glue = boto3.client('glue')
+logger = get_logger('lambda_glue_crawler_runner')
 
 def lambda_handler(event, context):
     """Glue Crawler実行メイン関数"""
-    print(f"Glue Crawler実行開始: {json.dumps(event, default=str)}")
+    bind_context(context)
+    logger.log_event("Glue Crawler実行開始", event, context)
     
     try:
         batch_id = event.get('batch_id')
@@ -33,69 +35,77 @@ def lambda_handler(event, context):
         except glue.exceptions.CrawlerRunningException:
             print(f"Crawler実行中のため待機: {crawler_name}")
         
-        # 実行状況監視（最大5分）
-        max_wait_time = 300  # 5分
-        wait_interval = 30   # 30秒間隔
-        waited_time = 0
+        # 実行状況監視（最大5分、Lambda残り時間も考慮）
+        max_wait_time = event.get('max_wait_seconds', 300)
+        try:
+            waited = poll_until(
+                lambda: get_crawler_status(crawler_name),
+                lambda crawler: crawler['State'] == 'READY',
+                label=f'glue_crawler:{crawler_name}',
+                initial_interval=10,
+                max_interval=60,
+                max_wait_seconds=max_wait_time,
+                get_state=lambda crawler: crawler['State']
+            )
+        except PollTimeout:
+            # タイムアウト
+            return {
+                'statusCode': 408,
+                'batch_id': batch_id,
+                'success': False,
+                'error': f'Crawler実行タイムアウト: {max_wait_time}秒',
+                'wait_stats': get_wait_stats(),
+                'evidence': create_evidence(batch_id, 'glue_crawler', False, {
+                    'error': 'タイムアウト',
+                    'waited_time': get_wait_stats()[-1]['latency_ms'] / 1000
+                })
+            }
         
-        while waited_time < max_wait_time:
-            crawler_status = get_crawler_status(crawler_name)
-            print(f"Crawler状況: {crawler_status['state']}")
-            
-            if crawler_status['state'] == 'READY':
-                # 実行完了
-                tables_created = get_created_tables(database_name)
-                
-                result = {
-                    'statusCode': 200,
-                    'batch_id': batch_id,
-                    'success': True,
-                    'crawler_name': crawler_name,
-                    'database_name': database_name,
-                    'execution_time': waited_time,
-                    'tables_created': tables_created,
-                    'crawler_stats': crawler_status.get('lastCrawl', {}),
-                    'evidence': create_evidence(batch_id, 'glue_crawler', True, {
-                        'crawler_name': crawler_name,
-                        'database': database_name,
-                        'tables_created': len(tables_created),
-                        'execution_time': waited_time
-                    })
-                }
-                
-                print(f"Crawler完了: {len(tables_created)}テーブル作成")
-                return result
-                
-            elif crawler_status['state'] == 'FAILED':
-                # 実行失敗
-                error_msg = crawler_status.get('lastCrawl', {}).get('errorMessage', 'Unknown error')
-                return {
-                    'statusCode': 500,
-                    'batch_id': batch_id,
-                    'success': False,
-                    'error': f'Crawler実行失敗: {error_msg}',
-                    'evidence': create_evidence(batch_id, 'glue_crawler', False, {
-                        'error': error_msg,
-                        'crawler_name': crawler_name
-                    })
-                }
-            
-            # 待機
-            time.sleep(wait_interval)
-            waited_time += wait_interval
+        crawler_status = waited['status']
+        waited_time = round(waited['stats']['latency_ms'] / 1000, 1)
+        last_crawl = crawler_status.get('LastCrawl', {})
+        print(f"Crawler状況: {crawler_status['State']}")
         
-        # タイムアウト
-        return {
-            'statusCode': 408,
+        # Crawler自体の状態はREADYに戻るため、成否は直近実行結果で判定
+        if last_crawl.get('Status') in ['FAILED', 'CANCELLED']:
+            # 実行失敗
+            error_msg = last_crawl.get('ErrorMessage', 'Unknown error')
+            return {
+                'statusCode': 500,
+                'batch_id': batch_id,
+                'success': False,
+                'error': f'Crawler実行失敗: {error_msg}',
+                'wait_stats': get_wait_stats(),
+                'evidence': create_evidence(batch_id, 'glue_crawler', False, {
+                    'error': error_msg,
+                    'crawler_name': crawler_name
+                })
+            }
+        
+        # 実行完了
+        tables_created = get_created_tables(database_name)
+        
+        result = {
+            'statusCode': 200,
             'batch_id': batch_id,
-            'success': False,
-            'error': f'Crawler実行タイムアウト: {max_wait_time}秒',
-            'evidence': create_evidence(batch_id, 'glue_crawler', False, {
-                'error': 'タイムアウト',
-                'waited_time': waited_time
+            'success': True,
+            'crawler_name': crawler_name,
+            'database_name': database_name,
+            'execution_time': waited_time,
+            'tables_created': tables_created,
+            'crawler_stats': summarize_last_crawl(last_crawl),
+            'wait_stats': get_wait_stats(),
+            'evidence': create_evidence(batch_id, 'glue_crawler', True, {
+                'crawler_name': crawler_name,
+                'database': database_name,
+                'tables_created': len(tables_created),
+                'execution_time': waited_time
             })
         }
         
+        print(f"Crawler完了: {len(tables_created)}テーブル作成")
+        return result
+    
     except Exception as e:
         error_msg = f"Glue Crawler実行エラー: {str(e)}"
         print(error_msg)
@@ -149,6 +159,17 @@ def get_crawler_status(crawler_name: str) -> Dict[str, Any]:
     response = glue.get_crawler(Name=crawler_name)
     return response['Crawler']
 
+def summarize_last_crawl(last_crawl: Dict[str, Any]) -> Dict[str, Any]:
+    """直近実行結果からJSON化できる項目のみ抽出（StartTimeはISO文字列に変換）"""
+    summary = {}
+    for field in ['Status', 'ErrorMessage', 'LogGroup', 'LogStream', 'MessagePrefix']:
+        if last_crawl.get(field) is not None:
+            summary[field] = last_crawl[field]
+    start_time = last_crawl.get('StartTime')
+    if start_time is not None:
+        summary['StartTime'] = start_time.isoformat() if hasattr(start_time, 'isoformat') else str(start_time)
+    return summary
+
 def get_created_tables(database_name: str) -> List[str]:
     """作成されたテーブル一覧取得"""
     try:
@@ -1,29 +1,73 @@
 """
 ログ収集Lambda - Step Functions 3用
 S3からログファイルを収集・検証・集約処理
+ファイルごとのチェックポイントにより、前回から変更のないファイルは読み込まず、追記されたファイルは続きのみ読み込む
 """
-import json
+import os
+import time
 import boto3
 import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Iterator, Optional
 from urllib.parse import unquote
+from log_checkpoint_store import (
+    LogCheckpointStore, add_counts, build_checkpoint, checkpoint_key, plan_read, tail_bytes, total_counts
+)
+from log_level_classifier import LEVELS, LogLevelClassifier
+from log_stream_reader import TAIL_BYTES, iter_s3_lines
+from structured_logger import get_logger
 
 s3 = boto3.client('s3')
+logger = get_logger('lambda_log_collector')
+
+# 同時に処理するログファイル数
+COLLECT_WORKERS = int(os.environ.get('COLLECT_WORKERS', '8'))
+# 残り実行時間のうち、集計・結果返却用に残す余裕（秒）
+COLLECT_SAFETY_MARGIN_SECONDS = float(os.environ.get('COLLECT_SAFETY_MARGIN_SECONDS', '30'))
+# 結果JSONに含めるファイル別明細の上限（Step Functionsのペイロード上限256KB対策）
+PROCESSED_LOGS_LIMIT = int(os.environ.get('PROCESSED_LOGS_LIMIT', '100'))
+# 対象とするログファイルの拡張子（gzip/zstd圧縮済みを含む）
+LOG_FILE_SUFFIXES = tuple(
+    f"{suffix}{compressed}" for suffix in ['.log', '.txt'] for compressed in ['', '.gz', '.zst']
+)
+# ストリーミング読み込みのチャンクサイズ・1行の最大バイト数
+READ_CHUNK_BYTES = int(os.environ.get('READ_CHUNK_BYTES', str(1024 * 1024)))
+MAX_LINE_BYTES = int(os.environ.get('MAX_LINE_BYTES', str(1024 * 1024)))
+# ログフォーマット（auto / plain / json / syslog / alb / cloudfront）
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'auto')
+# チェックポイントの保存先（バケット未指定時はソースバケット）
+CHECKPOINT_ENABLED = os.environ.get('CHECKPOINT_ENABLED', 'true').lower() == 'true'
+CHECKPOINT_BUCKET = os.environ.get('CHECKPOINT_BUCKET', '')
+CHECKPOINT_PREFIX = os.environ.get('CHECKPOINT_PREFIX', 'checkpoints/log-collector/')
 
 def lambda_handler(event, context):
-    """ログ収集メイン関数"""
-    print(f"ログ収集開始: {json.dumps(event, default=str)}")
+    """
+    ログ収集メイン関数
+    プレフィックス配下の全ログファイルを一覧取得順（キー順）に並列処理し、
+    残り実行時間が少なくなった時点で打ち切って continuation を返却（Step Functionsでループして再開）
+    use_checkpoint=false で チェックポイントを使わずに全ファイルを読み込み、
+    reset_checkpoint=true で既存のチェックポイントを無視して全ファイルを読み込み直す（チェックポイントは保存）
+    """
+    logger.log_event("ログ収集開始", event, context)
+    
+    continuation = event.get('continuation') or {}
+    batch_id = event.get('batch_id') or continuation.get('batch_id') or f'LOG_{datetime.now().strftime("%Y%m%d%H%M")}'
     
     try:
-        batch_id = event.get('batch_id', f'LOG_{datetime.now().strftime("%Y%m%d%H%M")}')
         source_bucket = event.get('source_bucket', 'log-processing-dev-source')
         log_prefix = event.get('log_prefix', 'application-logs/')
+        classifier = LogLevelClassifier(event.get('log_format', LOG_FORMAT))
+        store = open_checkpoint_store(source_bucket, log_prefix, event)
+        started = time.time()
         
-        # ログファイル一覧取得
-        log_files = list_log_files(source_bucket, log_prefix)
+        collected = collect_log_files(source_bucket, log_prefix, continuation.get('start_after'), context,
+                                      classifier, store)
+        if store is not None:
+            store.save()
+        aggregated_stats = merge_stats(continuation.get('aggregated_stats'), collected)
         
-        if not log_files:
+        if not aggregated_stats['total_files'] and not collected['has_more']:
             return {
                 'statusCode': 404,
                 'batch_id': batch_id,
@@ -35,59 +79,46 @@ def lambda_handler(event, context):
                 })
             }
         
-        # ログファイル処理
-        processed_logs = []
-        total_lines = 0
-        error_lines = 0
-        
-        for log_file in log_files[:10]:  # 最大10ファイル処理
-            try:
-                log_content = process_log_file(source_bucket, log_file['key'])
-                processed_logs.append({
-                    'file': log_file['key'],
-                    'size': log_file['size'],
-                    'lines': log_content['lines'],
-                    'errors': log_content['errors'],
-                    'summary': log_content['summary']
-                })
-                total_lines += log_content['lines']
-                error_lines += log_content['errors']
-                
-            except Exception as e:
-                print(f"ログファイル処理エラー {log_file['key']}: {e}")
-                processed_logs.append({
-                    'file': log_file['key'],
-                    'error': str(e)
-                })
-        
-        # 集約統計
-        aggregated_stats = {
-            'total_files': len(log_files),
-            'processed_files': len([log for log in processed_logs if 'error' not in log]),
-            'total_log_lines': total_lines,
-            'error_log_lines': error_lines,
-            'error_rate': error_lines / total_lines if total_lines > 0 else 0
-        }
-        
+        processed_logs = collected['processed_logs']
         result = {
             'statusCode': 200,
             'batch_id': batch_id,
             'success': True,
             'source_bucket': source_bucket,
             'log_prefix': log_prefix,
-            'processed_logs': processed_logs,
+            'processed_logs': processed_logs[:PROCESSED_LOGS_LIMIT],
+            'processed_logs_truncated': len(processed_logs) > PROCESSED_LOGS_LIMIT,
             'aggregated_stats': aggregated_stats,
+            'has_more': collected['has_more'],
+            'continuation': {
+                'batch_id': batch_id,
+                'start_after': collected['start_after'],
+                'aggregated_stats': aggregated_stats
+            } if collected['has_more'] else None,
             'evidence': create_evidence(batch_id, 'log_collect', True, {
                 'input': f's3://{source_bucket}/{log_prefix}',
-                'files_processed': len(processed_logs),
-                'total_lines': total_lines,
-                'error_lines': error_lines
+                'files_processed': aggregated_stats['processed_files'],
+                'total_lines': aggregated_stats['total_log_lines'],
+                'error_lines': aggregated_stats['error_log_lines'],
+                'load': {
+                    'invocation': aggregated_stats['invocations'],
+                    'files_this_invocation': len(processed_logs),
+                    'failed_files': aggregated_stats['failed_files'],
+                    'skipped_files': collected['skipped_files'],
+                    'resumed_files': collected['resumed_files'],
+                    'bytes_read': collected['bytes_read'],
+                    'checkpoint': store is not None,
+                    'has_more': collected['has_more'],
+                    'workers': COLLECT_WORKERS,
+                    'duration_ms': int((time.time() - started) * 1000)
+                }
             })
         }
         
-        print(f"ログ収集完了: {len(processed_logs)}ファイル, {total_lines}行処理")
+        print(f"ログ収集完了: {len(processed_logs)}ファイル, {collected['total_lines']}行処理"
+              f"（累計 {aggregated_stats['total_files']}ファイル, 継続: {collected['has_more']}）")
         return result
-        
+    
     except Exception as e:
         error_msg = f"ログ収集エラー: {str(e)}"
         print(error_msg)
@@ -99,56 +130,230 @@ def lambda_handler(event, context):
             'evidence': create_evidence(batch_id, 'log_collect', False, {'error': error_msg})
         }
 
-def list_log_files(bucket: str, prefix: str) -> List[Dict[str, Any]]:
-    """S3からログファイル一覧取得"""
-    log_files = []
-    
-    try:
-        response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
-        
+def open_checkpoint_store(source_bucket: str, log_prefix: str, event: Dict[str, Any]) -> Optional[LogCheckpointStore]:
+    """チェックポイントの読み込み（無効時はNone）"""
+    if not CHECKPOINT_ENABLED or not event.get('use_checkpoint', True):
+        return None
+    store = LogCheckpointStore(s3, CHECKPOINT_BUCKET or source_bucket,
+                               checkpoint_key(CHECKPOINT_PREFIX, source_bucket, log_prefix))
+    return store if event.get('reset_checkpoint') else store.load()
+
+def iter_log_files(bucket: str, prefix: str, start_after: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """S3のログファイルをページングで順次取得（キー順、start_after指定時はその次のキーから）"""
+    params = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after:
+        params['StartAfter'] = start_after
+    while True:
+        response = s3.list_objects_v2(**params)
         for obj in response.get('Contents', []):
-            if obj['Key'].endswith(('.log', '.txt')) and obj['Size'] > 0:
-                log_files.append({
+            if obj['Key'].endswith(LOG_FILE_SUFFIXES) and obj['Size'] > 0:
+                yield {
                     'key': obj['Key'],
                     'size': obj['Size'],
+                    'etag': obj.get('ETag', ''),
                     'last_modified': obj['LastModified'].isoformat()
-                })
-                
+                }
+        if not response.get('IsTruncated'):
+            return
+        params['ContinuationToken'] = response['NextContinuationToken']
+
+def remaining_seconds(context) -> Optional[float]:
+    """Lambdaの残り実行時間（ローカル実行時はNone）"""
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return context.get_remaining_time_in_millis() / 1000
+
+def collect_one(bucket: str, log_file: Dict[str, Any], classifier: LogLevelClassifier,
+                store: Optional[LogCheckpointStore] = None) -> Dict[str, Any]:
+    """1ファイル処理（処理時間付き、チェックポイントがあれば変更のないファイルは読み込まず、追記分のみ読み込み）"""
+    started = time.time()
+    checkpoint = store.get(log_file['key']) if store is not None else None
+    plan = plan_read(log_file, checkpoint)
+    try:
+        if plan['mode'] == 'skip':
+            log_content = checkpoint_content(checkpoint)
+        else:
+            log_content = process_log_file(bucket, log_file['key'], classifier,
+                                           checkpoint if plan['mode'] == 'resume' else None, log_file)
     except Exception as e:
-        print(f"ログファイル一覧取得エラー: {e}")
+        log_content = {'processing_error': str(e)}
+    if 'processing_error' in log_content:
+        return {'file': log_file['key'], 'error': log_content['processing_error'],
+                'duration': time.time() - started}
+    if store is not None and 'checkpoint' in log_content:
+        store.put(log_file['key'], log_content['checkpoint'])
+    return {
+        'file': log_file['key'],
+        'size': log_file['size'],
+        'lines': log_content['lines'],
+        'errors': log_content['errors'],
+        'summary': log_content['summary'],
+        'format': log_content['format'],
+        'mode': log_content['mode'],
+        'read_stats': log_content['read_stats'],
+        'duration': time.time() - started
+    }
+
+def collect_log_files(bucket: str, prefix: str, start_after: Optional[str], context,
+                      classifier: LogLevelClassifier, store: Optional[LogCheckpointStore] = None) -> Dict[str, Any]:
+    """
+    ログファイルを並列処理（同時実行数はCOLLECT_WORKERS）
+    次のファイルを投入する前に、残り時間が「余裕＋これまでの最長処理時間」を下回っていれば投入を打ち切る
+    投入済みのファイルは全て完了を待つため、再開位置は最後に投入したファイルのキー
+    """
+    processed_logs = []
+    last_submitted = start_after
+    slowest = 0.0
+    has_more = False
+    
+    with ThreadPoolExecutor(max_workers=max(1, COLLECT_WORKERS)) as executor:
+        in_flight = set()
+        for log_file in iter_log_files(bucket, prefix, start_after):
+            remaining = remaining_seconds(context)
+            if remaining is not None and remaining < COLLECT_SAFETY_MARGIN_SECONDS + slowest:
+                has_more = True
+                break
+            if len(in_flight) >= COLLECT_WORKERS:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    processed_logs.append(future.result())
+                    slowest = max(slowest, processed_logs[-1]['duration'])
+            in_flight.add(executor.submit(collect_one, bucket, log_file, classifier, store))
+            last_submitted = log_file['key']
+        for future in in_flight:
+            processed_logs.append(future.result())
+    
+    # 明細は一覧取得順（キー順）に並べ直す
+    processed_logs.sort(key=lambda log: log['file'])
+    succeeded = [log for log in processed_logs if 'error' not in log]
+    for log in processed_logs:
+        log['duration_ms'] = int(log.pop('duration') * 1000)
+        if 'error' in log:
+            print(f"ログファイル処理エラー {log['file']}: {log['error']}")
     
-    return sorted(log_files, key=lambda x: x['last_modified'], reverse=True)
+    level_summary: Dict[str, int] = {}
+    for log in succeeded:
+        for level, count in log['summary'].items():
+            level_summary[level] = level_summary.get(level, 0) + count
+    
+    return {
+        'processed_logs': processed_logs,
+        'files': len(processed_logs),
+        'processed_files': len(succeeded),
+        'failed_files': len(processed_logs) - len(succeeded),
+        'total_lines': sum(log['lines'] for log in succeeded),
+        'error_lines': sum(log['errors'] for log in succeeded),
+        'total_bytes': sum(log['size'] for log in succeeded),
+        'skipped_files': sum(1 for log in succeeded if log['mode'] == 'skip'),
+        'resumed_files': sum(1 for log in succeeded if log['mode'] == 'resume'),
+        'bytes_read': sum(log['read_stats']['bytes_read'] for log in succeeded),
+        'level_summary': level_summary,
+        'start_after': last_submitted,
+        'has_more': has_more
+    }
 
-def process_log_file(bucket: str, key: str) -> Dict[str, Any]:
-    """個別ログファイル処理"""
+def merge_stats(previous: Optional[Dict[str, Any]], collected: Dict[str, Any]) -> Dict[str, Any]:
+    """前回までの累計にこの呼び出しの集計を加算"""
+    previous = previous or {}
+    level_summary = dict(previous.get('level_summary', {}))
+    for level, count in collected['level_summary'].items():
+        level_summary[level] = level_summary.get(level, 0) + count
+    total_lines = previous.get('total_log_lines', 0) + collected['total_lines']
+    error_lines = previous.get('error_log_lines', 0) + collected['error_lines']
+    return {
+        'total_files': previous.get('total_files', 0) + collected['files'],
+        'processed_files': previous.get('processed_files', 0) + collected['processed_files'],
+        'failed_files': previous.get('failed_files', 0) + collected['failed_files'],
+        'total_log_lines': total_lines,
+        'error_log_lines': error_lines,
+        'error_rate': error_lines / total_lines if total_lines > 0 else 0,
+        'total_bytes': previous.get('total_bytes', 0) + collected['total_bytes'],
+        'skipped_files': previous.get('skipped_files', 0) + collected['skipped_files'],
+        'resumed_files': previous.get('resumed_files', 0) + collected['resumed_files'],
+        'bytes_read': previous.get('bytes_read', 0) + collected['bytes_read'],
+        'level_summary': level_summary,
+        'invocations': previous.get('invocations', 0) + 1,
+        'complete': not collected['has_more']
+    }
+
+def checkpoint_content(checkpoint: Dict[str, Any]) -> Dict[str, Any]:
+    """変更のないファイルの集計結果（チェックポイントの件数をそのまま使用）"""
+    log_levels = total_counts(checkpoint)
+    return {
+        'lines': sum(log_levels.values()),
+        'errors': log_levels.get('ERROR', 0) + log_levels.get('WARN', 0),
+        'summary': log_levels,
+        'format': checkpoint['format'],
+        'mode': 'skip',
+        'read_stats': {
+            'compression': checkpoint['compression'],
+            'bytes_read': 0,
+            'decompressed_bytes': 0,
+            'lines': 0,
+            'truncated_lines': 0
+        }
+    }
+
+def process_log_file(bucket: str, key: str, classifier: Optional[LogLevelClassifier] = None,
+                     checkpoint: Optional[Dict[str, Any]] = None,
+                     log_file: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    個別ログファイル処理（チャンク単位のストリーミング読み込み、レベル判定は1行1回の照合）
+    checkpoint指定時は処理済み位置からRange GETで続きのみ読み込み、件数を加算
+    （処理済み部分の末尾が一致しなければ先頭から読み直す）
+    log_file（一覧取得時のETag・サイズ）指定時は、次回用のチェックポイントを結果に含める
+    """
     try:
-        response = s3.get_object(Bucket=bucket, Key=key)
-        content = response['Body'].read().decode('utf-8', errors='ignore')
-        
-        lines = content.split('\n')
-        total_lines = len([line for line in lines if line.strip()])
-        
-        # ログレベル分析
-        log_levels = {'ERROR': 0, 'WARN': 0, 'INFO': 0, 'DEBUG': 0, 'OTHER': 0}
+        reader = None
+        tail = b''
+        if checkpoint:
+            tail = tail_bytes(checkpoint)
+            reader = iter_s3_lines(s3, bucket, key, chunk_size=READ_CHUNK_BYTES, max_line_bytes=MAX_LINE_BYTES,
+                                   start=checkpoint['offset'] - len(tail), expected_prefix=tail)
+            if reader is None:
+                print(f"処理済み部分が変更されているため先頭から再処理: {key}")
+                checkpoint, tail = None, b''
+        if reader is None:
+            reader = iter_s3_lines(s3, bucket, key, chunk_size=READ_CHUNK_BYTES, max_line_bytes=MAX_LINE_BYTES)
+        classifier = classifier or LogLevelClassifier(LOG_FORMAT)
+        if checkpoint and classifier.log_format == 'auto':
+            # 続きの読み込みではファイル先頭で判別したフォーマットを使用
+            classifier = LogLevelClassifier(checkpoint['format'])
+        try:
+            # 改行で終わらない最終行（追記途中の行）は別に数え、処理済み位置には含めない
+            counted = classifier.count(reader.iter_blocks(decode=False, include_partial=False))
+            partial = None
+            if reader.partial:
+                partial_classifier = LogLevelClassifier(counted['format']) if counted['lines'] else classifier
+                partial = partial_classifier.count([reader.partial])
+        finally:
+            reader.close()
         
-        for line in lines:
-            if 'ERROR' in line.upper():
-                log_levels['ERROR'] += 1
-            elif 'WARN' in line.upper():
-                log_levels['WARN'] += 1
-            elif 'INFO' in line.upper():
-                log_levels['INFO'] += 1
-            elif 'DEBUG' in line.upper():
-                log_levels['DEBUG'] += 1
-            elif line.strip():
-                log_levels['OTHER'] += 1
-        
-        return {
-            'lines': total_lines,
+        log_format = counted['format'] if counted['lines'] or partial is None else partial['format']
+        counts = add_counts(checkpoint['counts'], counted['summary']) if checkpoint else counted['summary']
+        partial_counts = partial['summary'] if partial else dict.fromkeys(LEVELS, 0)
+        log_levels = add_counts(counts, partial_counts)
+        read_stats = reader.stats()
+        result = {
+            'lines': sum(log_levels.values()),
             'errors': log_levels['ERROR'] + log_levels['WARN'],
-            'summary': log_levels
+            'summary': log_levels,
+            'format': log_format,
+            'mode': 'resume' if checkpoint else 'full',
+            'read_stats': read_stats
         }
-        
+        if log_file is not None:
+            result['checkpoint'] = build_checkpoint(
+                log_file,
+                offset=(checkpoint['offset'] if checkpoint else 0) + reader.complete_bytes,
+                tail=(tail + reader.tail)[-TAIL_BYTES:],
+                counts=counts,
+                partial_counts=partial_counts,
+                log_format=log_format,
+                compression=read_stats['compression']
+            )
+        return result
+    
     except Exception as e:
         print(f"ログファイル処理エラー {key}: {e}")
         return {
@@ -173,7 +378,7 @@ def create_evidence(batch_id: str, step: str, success: bool, details: Dict[str,
         'step': step,
         'input': {'s3': details.get('input', ''), 'files': details.get('files_processed', 0)},
         'output': {'lines': details.get('total_lines', 0), 'errors': details.get('error_lines', 0)},
-        'load': {},
+        'load': details.get('load', {}),
         'ok': success,
         'ts': datetime.now().isoformat(),
         'note': note
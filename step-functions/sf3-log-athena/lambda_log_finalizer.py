@@ -2,14 +2,16 @@
 ログ処理完了Lambda - Step Functions 3用
 ログ集約→Athenaパイプラインの最終処理と統計情報生成
 """
-import json
 import boto3
 from datetime import datetime
 from typing import Dict, Any, List
+from structured_logger import get_logger
+
+logger = get_logger('lambda_log_finalizer')
 
 def lambda_handler(event, context):
     """ログ処理完了メイン関数"""
-    print(f"ログ処理完了開始: {json.dumps(event, default=str)}")
+    logger.log_event("ログ処理完了開始", event, context)
     
     try:
         batch_id = event.get('batch_id')
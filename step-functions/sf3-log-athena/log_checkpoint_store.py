@@ -0,0 +1,126 @@
+"""
+ログ収集チェックポイント - Step Functions 3用
+ログファイル（キー）ごとに ETag・サイズ・処理済みバイト位置・レベル別の累計件数を保存し、
+次回の収集では前回からの差分のみを読み込む
+
+- ETagが前回と同じファイル: 読み込まずに前回の件数を使用（skip）
+- 追記のみで大きくなった非圧縮ファイル: 処理済み位置からRange GETで続きを読み込み、件数を加算（resume）
+  （処理済み部分の末尾バイトを読み直して一致を確認し、一致しなければ先頭から読み直す）
+- それ以外（新規・縮小・圧縮ファイルの更新・書き換え）: 先頭から読み込み（full）
+
+チェックポイントはソースバケット・プレフィックスごとに1つのJSONとしてS3に保存（1回の呼び出しで読み込み・保存各1回）
+"""
+import base64
+import json
+import threading
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+# チェックポイントの形式バージョン（変更時は全ファイルを読み直す）
+CHECKPOINT_VERSION = 1
+
+def checkpoint_key(prefix: str, source_bucket: str, log_prefix: str) -> str:
+    """チェックポイントJSONのS3キー"""
+    return f"{prefix}{source_bucket}/{log_prefix.strip('/')}/checkpoints.json"
+
+def plan_read(log_file: Dict[str, Any], checkpoint: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    1ファイルの読み込み方法を判定
+    戻り値: {'mode': 'skip' / 'resume' / 'full', 'start': 読み込み開始位置, 'reason': 判定理由}
+    """
+    if not checkpoint:
+        return {'mode': 'full', 'start': 0, 'reason': 'new'}
+    if log_file.get('etag') and log_file['etag'] == checkpoint.get('etag') and log_file['size'] == checkpoint.get('size'):
+        return {'mode': 'skip', 'start': checkpoint['offset'], 'reason': 'unchanged'}
+    if checkpoint.get('compression') != 'none':
+        return {'mode': 'full', 'start': 0, 'reason': 'compressed'}
+    if log_file['size'] < checkpoint.get('size', 0) or log_file['size'] < checkpoint.get('offset', 0):
+        return {'mode': 'full', 'start': 0, 'reason': 'shrunk'}
+    return {'mode': 'resume', 'start': checkpoint['offset'], 'reason': 'appended'}
+
+def add_counts(*counts: Dict[str, int]) -> Dict[str, int]:
+    """レベル別件数の合計"""
+    total: Dict[str, int] = {}
+    for level_counts in counts:
+        for level, count in level_counts.items():
+            total[level] = total.get(level, 0) + count
+    return total
+
+def total_counts(checkpoint: Dict[str, Any]) -> Dict[str, int]:
+    """ファイル全体のレベル別件数（処理済み位置までの累計＋末尾の未完了行）"""
+    return add_counts(checkpoint.get('counts', {}), checkpoint.get('partial_counts', {}))
+
+def tail_bytes(checkpoint: Dict[str, Any]) -> bytes:
+    """処理済み部分の末尾バイト（Range GET時の一致確認用）"""
+    return base64.b64decode(checkpoint.get('tail', ''))
+
+def build_checkpoint(log_file: Dict[str, Any], offset: int, tail: bytes, counts: Dict[str, int],
+                     partial_counts: Dict[str, int], log_format: str, compression: str) -> Dict[str, Any]:
+    """
+    1ファイル分のチェックポイント
+    counts は処理済み位置（最後の改行）までの累計、partial_counts はそれ以降の改行で終わらない行の件数
+    （追記途中の行は次回の読み込みで改めて数える）
+    """
+    return {
+        'etag': log_file.get('etag', ''),
+        'size': log_file['size'],
+        'offset': offset,
+        'tail': base64.b64encode(tail).decode('ascii'),
+        'counts': counts,
+        'partial_counts': partial_counts,
+        'format': log_format,
+        'compression': compression,
+        'updated_at': datetime.now().isoformat()
+    }
+
+class LogCheckpointStore:
+    """S3上のチェックポイントJSON（キー → チェックポイント）の読み書き（並列処理中の更新はロックで保護）"""
+    
+    def __init__(self, s3_client, bucket: str, key: str):
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.checkpoints: Dict[str, Dict[str, Any]] = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+    
+    def load(self) -> 'LogCheckpointStore':
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.key)
+        except self.s3.exceptions.NoSuchKey:
+            return self
+        document = json.loads(response['Body'].read())
+        if document.get('version') == CHECKPOINT_VERSION:
+            self.checkpoints = document.get('checkpoints', {})
+        return self
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            return self.checkpoints.get(key)
+    
+    def put(self, key: str, checkpoint: Dict[str, Any]) -> None:
+        with self.lock:
+            self.checkpoints[key] = checkpoint
+            self.dirty = True
+    
+    def save(self) -> bool:
+        """更新があった場合のみ保存"""
+        with self.lock:
+            if not self.dirty:
+                return False
+            body = json.dumps({
+                'version': CHECKPOINT_VERSION,
+                'updated_at': datetime.now().isoformat(),
+                'checkpoints': self.checkpoints
+            }, ensure_ascii=False)
+            self.dirty = False
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=body.encode('utf-8'),
+            ContentType='application/json'
+        )
+        return True
+    
+    def __len__(self) -> int:
+        return len(self.checkpoints)
@@ -0,0 +1,291 @@
+"""
+ログレベル分類 - Step Functions 3用
+ファイル先頭のサンプル行からフォーマットとレイアウト（plainのレベル位置、JSONのレベルキー名）を判別し、
+そのファイル専用の正規表現を1回コンパイルして、各行のレベルフィールドのみを1回の照合で判定
+（メッセージ本文中の "error" 等では分類しない）
+
+照合はブロック（複数行）単位の re.findall で行い、値ごとの件数を Counter で集計するため、
+行ごとのPythonループは回さない（フォーマットに一致しない行を含むブロックのみ1行ずつ判定）
+ブロックはbytesのまま照合できる（デコードを省略、パターンもbytes用にコンパイル）
+
+フォーマットプラグイン:
+- plain:      先頭5トークン以内の大文字レベル（例: "2024-01-01 12:00:00 [ERROR] ..."）
+- json:       "level" / "severity" / "levelname" 等のキーの値（json.loadsは行わない）
+- syslog:     <PRI> の severity
+- alb:        ALBアクセスログの elb_status_code（5xx: ERROR / 4xx: WARN / その他: INFO）
+- cloudfront: CloudFrontアクセスログの sc-status（同上）
+- auto:       ファイル先頭の数行から判別
+各プラグインで一致しない行はplainとして判定し、それでも一致しない空行以外の行はOTHER
+"""
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple, Union
+
+# 集計するレベル（集計結果のキー）
+LEVELS = ['ERROR', 'WARN', 'INFO', 'DEBUG', 'OTHER']
+
+# レベル表記の揺れ → 集計レベル
+LEVEL_ALIASES = {
+    'FATAL': 'ERROR',
+    'CRITICAL': 'ERROR',
+    'CRIT': 'ERROR',
+    'SEVERE': 'ERROR',
+    'ERROR': 'ERROR',
+    'ERR': 'ERROR',
+    'ALERT': 'ERROR',
+    'EMERG': 'ERROR',
+    'WARNING': 'WARN',
+    'WARN': 'WARN',
+    'NOTICE': 'INFO',
+    'INFO': 'INFO',
+    'DEBUG': 'DEBUG',
+    'TRACE': 'DEBUG'
+}
+
+# 自動判別に使う先頭の行数
+DETECT_SAMPLE_LINES = 20
+
+_LEVEL_NAMES = '|'.join(sorted(LEVEL_ALIASES, key=len, reverse=True))
+
+# レベル表記（[ERROR] / <WARN> / INFO: 等の囲み・区切りを許容し、ERRORS のような語は除外）
+_LEVEL_TOKEN = rf'[\[<(]?({_LEVEL_NAMES})(?![^ \t\r\n\]>):])'
+
+# 改行直後が空白のみの行（空行数の集計用）
+_BLANK_LINE = r'\n(?=[^\S\n]*(?:\n|$))'
+
+def _status_level(status: str) -> str:
+    if status.startswith('5'):
+        return 'ERROR'
+    if status.startswith('4'):
+        return 'WARN'
+    return 'INFO'
+
+class LogFormat:
+    """
+    フォーマットプラグインの基底クラス
+    - pattern: 1行の行頭から照合する正規表現（グループは1つ、判別と1行ずつの判定に使用）
+    - block_pattern(sample): 先頭に改行を付けたブロックへfindallする正規表現（1行につき高々1回一致、
+      行頭から照合しないパターンは一致後に行末まで読み進めて同じ行での2回目の一致を防ぐ）
+    - level(value): グループの値 → 集計レベル
+    """
+    name = ''
+    pattern = ''
+    
+    def __init__(self):
+        self.compiled = re.compile(self.pattern)
+    
+    def detect(self, line: str) -> bool:
+        return self.compiled.match(line) is not None
+    
+    def block_pattern(self, sample: List[str]) -> str:
+        # 改行（リテラル）から始まるパターンは、reが次の改行まで高速に読み飛ばせる
+        return r'\n' + self.pattern
+    
+    def level(self, value: str) -> str:
+        raise NotImplementedError
+
+class PlainFormat(LogFormat):
+    """先頭5トークン以内の大文字レベル（サンプルでレベル位置が揃っていれば、その位置を先に照合）"""
+    name = 'plain'
+    pattern = rf'[ \t]*(?:\S+[ \t]+){{0,4}}?{_LEVEL_TOKEN}'
+    
+    def block_pattern(self, sample: List[str]) -> str:
+        positions = Counter()
+        for line in sample:
+            match = self.compiled.match(line)
+            if match:
+                positions[len(line[:match.start(1)].rstrip('[<(').split())] += 1
+        if positions:
+            position, count = positions.most_common(1)[0]
+            if count * 2 > len(sample):
+                # 位置の照合は繰り返しグループを展開（reのグループの繰り返しは1回ごとのコストが大きい）
+                return r'\n(?:' + r'\S+[ \t]+' * position + rf'|[ \t]*(?:\S+[ \t]+){{0,4}}?){_LEVEL_TOKEN}'
+        return r'\n' + self.pattern
+    
+    def level(self, value: str) -> str:
+        return LEVEL_ALIASES[value]
+
+class JsonFormat(LogFormat):
+    """JSONログのレベル項目（キー・値とも大文字小文字を区別しない）"""
+    name = 'json'
+    key_pattern = re.compile(r'"((?i:level|severity|log_level|loglevel|levelname))"[ \t]*:[ \t]*"')
+    pattern = r'[ \t]*\{[^\n]*?"(?i:level|severity|log_level|loglevel|levelname)"[ \t]*:[ \t]*"([A-Za-z]+)"'
+    
+    def block_pattern(self, sample: List[str]) -> str:
+        # サンプルで使われているキー名に固定（キー名のリテラル検索になり、行の先頭から走査しない）
+        # 入れ子のオブジェクトに同じキーがあっても、行内で最初の1つのみ数える
+        keys = Counter(match.group(1) for line in sample for match in self.key_pattern.finditer(line))
+        if not keys:
+            return r'\n' + self.pattern
+        key = keys.most_common(1)[0][0]
+        return rf'"{re.escape(key)}"[ \t]*:[ \t]*"([A-Za-z]+)"[^\n]*'
+    
+    def level(self, value: str) -> str:
+        return LEVEL_ALIASES.get(value.upper(), 'OTHER')
+
+class SyslogFormat(LogFormat):
+    """syslogのPRI（facility * 8 + severity）"""
+    name = 'syslog'
+    pattern = r'[ \t]*<(\d{1,3})>'
+    # severity 0〜7 → 集計レベル
+    severities = ['ERROR', 'ERROR', 'ERROR', 'ERROR', 'WARN', 'INFO', 'INFO', 'DEBUG']
+    
+    def level(self, value: str) -> str:
+        return self.severities[int(value) % 8]
+
+class AlbFormat(LogFormat):
+    """ALBアクセスログ（9番目の項目がelb_status_code）"""
+    name = 'alb'
+    pattern = r'(?:https?|h2|grpcs|wss?) \S+ \S+ \S+ \S+ \S+ \S+ \S+ (\d{3}|-) '
+    
+    def block_pattern(self, sample: List[str]) -> str:
+        # 行頭から8項目を読み飛ばさず、リクエスト（"で始まる最初の項目）直前の
+        # elb_status_code target_status_code received_bytes sent_bytes に一致させる
+        return r' (\d{3}|-) (?:\d{3}|-) \d+ \d+ "[^\n]*'
+    
+    def level(self, value: str) -> str:
+        # ターゲットに到達しなかったリクエスト（"-"）は接続エラーとして扱う
+        return 'ERROR' if value == '-' else _status_level(value)
+
+class CloudFrontFormat(LogFormat):
+    """CloudFrontアクセスログ（タブ区切り、9番目の項目がsc-status、#行はヘッダーとしてOTHER）"""
+    name = 'cloudfront'
+    pattern = r'\d{4}-\d{2}-\d{2}' + r'\t[^\t\n]*' * 7 + r'\t(\d{3})\t'
+    
+    def block_pattern(self, sample: List[str]) -> str:
+        # sc-statusの直前はcs-uri-stem（常に "/" で始まる唯一の項目）
+        return r'\t/[^\t\n]*\t(\d{3})\t[^\n]*'
+    
+    def level(self, value: str) -> str:
+        return _status_level(value)
+
+# フォーマット名 → プラグイン（自動判別は登録順に試行し、plainは最後）
+FORMATS: Dict[str, LogFormat] = {
+    plugin.name: plugin
+    for plugin in [AlbFormat(), CloudFrontFormat(), JsonFormat(), SyslogFormat(), PlainFormat()]
+}
+
+def register_format(plugin: LogFormat) -> None:
+    """フォーマットプラグインを追加"""
+    FORMATS[plugin.name] = plugin
+    # plainは常に最後に判定
+    FORMATS['plain'] = FORMATS.pop('plain')
+
+def detect_format(sample: List[str]) -> str:
+    """サンプル行の過半数に一致するフォーマットを判別（なければplain）"""
+    lines = [line for line in sample if line.strip() and not line.startswith('#')]
+    if not lines:
+        return 'plain'
+    for name, plugin in FORMATS.items():
+        if name == 'plain':
+            continue
+        if sum(1 for line in lines if plugin.detect(line)) * 2 > len(lines):
+            return name
+    return 'plain'
+
+# (パターン, bytes用か) → コンパイル済みパターン（ウォームスタート時は再利用）
+_compiled_patterns: Dict[Tuple[str, bool], 're.Pattern'] = {}
+
+def _compile(source: str, binary: bool = False) -> 're.Pattern':
+    pattern = _compiled_patterns.get((source, binary))
+    if pattern is None:
+        pattern = re.compile(source.encode('ascii') if binary else source)
+        _compiled_patterns[(source, binary)] = pattern
+    return pattern
+
+def _head_lines(block: Union[str, bytes], count: int) -> List[Union[str, bytes]]:
+    """ブロック先頭のcount行（split(maxsplit)と異なり残りの部分をコピーしない）"""
+    newline = b'\n' if isinstance(block, bytes) else '\n'
+    lines = []
+    start = 0
+    while len(lines) < count and start <= len(block):
+        end = block.find(newline, start)
+        if end < 0:
+            end = len(block)
+        lines.append(block[start:end])
+        start = end + 1
+    return lines
+
+def _text(value: Union[str, bytes]) -> str:
+    return value.decode('utf-8', errors='ignore') if isinstance(value, bytes) else value
+
+class LogLevelClassifier:
+    """
+    ブロック（1行以上、改行区切りのstrまたはbytes）のイテレータからレベル別件数を集計（空行は数えない）
+    1行ずつのイテレータも渡せるが、LogLineReader.iter_blocks(decode=False) のbytesブロック単位が最速
+    """
+    
+    def __init__(self, log_format: str = 'auto'):
+        if log_format != 'auto' and log_format not in FORMATS:
+            raise ValueError(f"Unknown log format: {log_format}")
+        self.log_format = log_format
+    
+    def count(self, blocks: Iterable[Union[str, bytes]]) -> Dict[str, object]:
+        iterator = iter(blocks)
+        buffered = []
+        sample: List[str] = []
+        for block in iterator:
+            buffered.append(block)
+            sample.extend(_text(line) for line in _head_lines(block, DETECT_SAMPLE_LINES) if line.strip())
+            if len(sample) >= DETECT_SAMPLE_LINES:
+                break
+        sample = sample[:DETECT_SAMPLE_LINES]
+        log_format = detect_format(sample) if self.log_format == 'auto' else self.log_format
+        plugin = FORMATS[log_format]
+        block_pattern = plugin.block_pattern(sample)
+        
+        format_values: Counter = Counter()
+        plain_values: Counter = Counter()
+        other = 0
+        binary = bool(buffered) and isinstance(buffered[0], bytes)
+        newline = b'\n' if binary else '\n'
+        findall = _compile(block_pattern, binary).findall
+        find_blank = _compile(_BLANK_LINE, binary).findall
+        # 改行から始まるパターンはブロック全体に改行を連結せず（大きなブロックのコピーを避ける）、先頭行のみ別に照合
+        line_start = block_pattern.startswith(r'\n')
+        for part in (buffered, iterator):
+            for block in part:
+                lines = block.count(newline) + 1
+                values = findall(block)
+                if line_start:
+                    end = block.find(newline)
+                    values += findall(newline + (block if end < 0 else block[:end]))
+                if len(values) == lines:
+                    # 全行が一致（空行なし）
+                    format_values.update(values)
+                    continue
+                total = lines - len(find_blank(newline + block))
+                if len(values) == total:
+                    format_values.update(values)
+                elif log_format == 'plain':
+                    # plainのパターンは汎用の照合を含むため、一致しない行はOTHER
+                    format_values.update(values)
+                    other += total - len(values)
+                else:
+                    other += self._count_lines(block, plugin, format_values, plain_values, binary)
+        
+        plain = FORMATS['plain']
+        counts = dict.fromkeys(LEVELS, 0)
+        for values, level in [(format_values, plugin.level), (plain_values, plain.level)]:
+            for value, count in values.items():
+                counts[level(_text(value))] += count
+        counts['OTHER'] += other
+        return {'format': log_format, 'lines': sum(counts.values()), 'summary': counts}
+    
+    def _count_lines(self, block: Union[str, bytes], plugin: LogFormat, format_values: Counter,
+                     plain_values: Counter, binary: bool) -> int:
+        """フォーマットに一致しない行を含むブロックを1行ずつ判定（OTHERの件数を返却）"""
+        format_match = _compile(plugin.pattern, binary).match
+        plain_match = _compile(FORMATS['plain'].pattern, binary).match
+        other = 0
+        for line in block.split(b'\n' if binary else '\n'):
+            match = format_match(line)
+            if match:
+                format_values[match.group(1)] += 1
+                continue
+            match = plain_match(line)
+            if match:
+                plain_values[match.group(1)] += 1
+            elif line.strip():
+                other += 1
+        return other
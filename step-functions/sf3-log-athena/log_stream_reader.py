@@ -0,0 +1,233 @@
+"""
+ログストリーム読み込み - Step Functions 3用
+S3のStreamingBodyを固定サイズのチャンクで読み進めて1行ずつ返却（ファイル全体をメモリに載せない）
+
+- チャンク境界で分断された行は次のチャンクと連結してから返却
+- gzip / zstd は拡張子またはマジックナンバーで判別し、読み込みながら展開
+- 改行を含まない極端に長い行は max_line_bytes で切り詰め（ピークメモリはファイルサイズに依存しない）
+- iter_blocks は最後の改行までのバイト数と末尾数バイトを記録（追記型ログを続きから読み込むチェックポイント用）
+"""
+import gzip
+from typing import Any, Dict, Iterator, Optional, Union
+
+try:
+    import zstandard
+except ImportError:  # Lambdaレイヤー未導入時はzstdファイルのみ読み込み不可
+    zstandard = None
+
+# 読み込みチャンクサイズ
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# 1行の最大バイト数（超過分は読み捨て）
+DEFAULT_MAX_LINE_BYTES = 1024 * 1024
+
+# 記録する処理済み部分の末尾バイト数
+TAIL_BYTES = 64
+# 圧縮形式を判別する場合のcompression引数
+AUTO_COMPRESSION = 'auto'
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# 拡張子 → 圧縮形式
+COMPRESSION_SUFFIXES = {
+    '.gz': 'gzip',
+    '.gzip': 'gzip',
+    '.zst': 'zstd',
+    '.zstd': 'zstd'
+}
+
+def detect_compression(key: str, head: bytes) -> Optional[str]:
+    """圧縮形式の判別（拡張子を優先し、なければ先頭バイト）"""
+    lowered = key.lower()
+    for suffix, compression in COMPRESSION_SUFFIXES.items():
+        if lowered.endswith(suffix):
+            return compression
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+class _CountingSource:
+    """StreamingBodyの読み込みバイト数を数えるラッパー（判別用に読んだ先頭バイトを先に返却）"""
+    
+    def __init__(self, body, head: bytes):
+        self.body = body
+        self.head = head
+        self.bytes_read = len(head)
+    
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            rest = self.body.read()
+            self.bytes_read += len(rest)
+            data, self.head = self.head + rest, b''
+            return data
+        if self.head:
+            data, self.head = self.head[:size], self.head[size:]
+            return data
+        data = self.body.read(size)
+        self.bytes_read += len(data)
+        return data
+    
+    def readable(self) -> bool:
+        return True
+
+class LogLineReader:
+    """ログファイルの行イテレータ（読み込み統計付き）"""
+    
+    def __init__(self, body, key: str = '', chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 max_line_bytes: int = DEFAULT_MAX_LINE_BYTES, encoding: str = 'utf-8',
+                 compression: Optional[str] = AUTO_COMPRESSION):
+        """compression: 'auto'（拡張子・先頭バイトで判別）/ None（非圧縮）/ 'gzip' / 'zstd'"""
+        self.chunk_size = chunk_size
+        self.max_line_bytes = max_line_bytes
+        self.encoding = encoding
+        # Range GETでファイルの途中から読む場合は先頭バイトで判別しない
+        head = body.read(len(ZSTD_MAGIC)) if compression == AUTO_COMPRESSION else b''
+        self.source = _CountingSource(body, head)
+        self.compression = detect_compression(key, head) if compression == AUTO_COMPRESSION else compression
+        self.stream = self._open(self.compression)
+        self.decompressed_bytes = 0
+        self.lines = 0
+        self.truncated_lines = 0
+        # 最後の改行までの展開後バイト数・その直前TAIL_BYTESバイト・最後の改行以降の未完了行
+        self.complete_bytes = 0
+        self.tail = b''
+        self.partial = b''
+    
+    def _open(self, compression: Optional[str]):
+        if compression == 'gzip':
+            # 連結された複数メンバーのgzipも順に展開
+            return gzip.GzipFile(fileobj=self.source, mode='rb')
+        if compression == 'zstd':
+            if zstandard is None:
+                raise RuntimeError('zstandard is required to read zstd compressed logs')
+            return zstandard.ZstdDecompressor().stream_reader(
+                self.source, read_size=self.chunk_size, read_across_frames=True
+            )
+        return self.source
+    
+    def iter_chunks(self) -> Iterator[bytes]:
+        """展開済みデータを最大chunk_sizeずつ返却"""
+        while True:
+            chunk = self.stream.read(self.chunk_size)
+            if not chunk:
+                return
+            self.decompressed_bytes += len(chunk)
+            yield chunk
+    
+    def _decode(self, line: bytes) -> str:
+        self.lines += 1
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        return line.decode(self.encoding, errors='ignore')
+    
+    def __iter__(self) -> Iterator[str]:
+        pending = b''
+        # 切り詰めた行の残り（次の改行まで）を読み捨て中かどうか
+        skipping = False
+        for chunk in self.iter_chunks():
+            if skipping:
+                newline = chunk.find(b'\n')
+                if newline < 0:
+                    continue
+                chunk = chunk[newline + 1:]
+                skipping = False
+            parts = (pending + chunk).split(b'\n') if pending else chunk.split(b'\n')
+            pending = parts.pop()
+            for line in parts:
+                if len(line) > self.max_line_bytes:
+                    self.truncated_lines += 1
+                    line = line[:self.max_line_bytes]
+                yield self._decode(line)
+            if len(pending) > self.max_line_bytes:
+                self.truncated_lines += 1
+                yield self._decode(pending[:self.max_line_bytes])
+                pending = b''
+                skipping = True
+        if pending:
+            yield self._decode(pending)
+    
+    def _complete(self, end: bytes, rest: int) -> None:
+        """最後の改行の位置を更新（end: 改行までの末尾、rest: 改行より後に読み込み済みのバイト数）"""
+        self.complete_bytes = self.decompressed_bytes - rest
+        self.tail = (self.tail + end)[-TAIL_BYTES:]
+    
+    def iter_blocks(self, decode: bool = True, include_partial: bool = True) -> Iterator[Union[str, bytes]]:
+        """
+        完全な行のみを含むブロック（改行区切り、末尾の改行なし）をチャンク単位で返却
+        行ごとの分割・デコードを行わないため、ブロック単位で処理できる集計は__iter__より高速
+        decode=Falseの場合はbytesのまま返却
+        include_partial=Falseの場合、改行で終わらない最終行は返却せず self.partial に残す（追記途中の行）
+        （ブロック内の行は切り詰めない。ブロックの大きさはchunk_size＋max_line_bytes以下）
+        """
+        pending = b''
+        # 切り詰めた行の先頭（改行が見つかるまで返却を保留し、残りは読み捨て）と読み捨て部分までの末尾
+        truncated = None
+        skipped_tail = b''
+        for chunk in self.iter_chunks():
+            if truncated is not None:
+                newline = chunk.find(b'\n')
+                if newline < 0:
+                    skipped_tail = (skipped_tail + chunk[-TAIL_BYTES:])[-TAIL_BYTES:]
+                    continue
+                self.tail = skipped_tail
+                self._complete(chunk[max(0, newline + 1 - TAIL_BYTES):newline + 1], len(chunk) - newline - 1)
+                self.truncated_lines += 1
+                self.lines += 1
+                yield truncated.decode(self.encoding, errors='ignore') if decode else truncated
+                chunk = chunk[newline + 1:]
+                truncated = None
+            data = pending + chunk if pending else chunk
+            cut = data.rfind(b'\n')
+            if cut < 0:
+                block, pending = None, data
+            else:
+                block, pending = data[:cut], data[cut + 1:]
+            if block is not None:
+                self._complete(block[-TAIL_BYTES:] + b'\n', len(pending))
+                self.lines += block.count(b'\n') + 1
+                yield block.decode(self.encoding, errors='ignore') if decode else block
+            if len(pending) > self.max_line_bytes:
+                truncated, skipped_tail = pending[:self.max_line_bytes], (self.tail + pending[-TAIL_BYTES:])[-TAIL_BYTES:]
+                pending = b''
+        if truncated is not None:
+            self.truncated_lines += 1
+            pending = truncated
+        if pending and not include_partial:
+            self.partial = pending
+        elif pending:
+            self.lines += 1
+            yield pending.decode(self.encoding, errors='ignore') if decode else pending
+    
+    def close(self) -> None:
+        self.source.body.close()
+    
+    def stats(self) -> Dict[str, Any]:
+        """証跡用の読み込み統計"""
+        return {
+            'compression': self.compression or 'none',
+            'bytes_read': self.source.bytes_read,
+            'decompressed_bytes': self.decompressed_bytes,
+            'lines': self.lines,
+            'truncated_lines': self.truncated_lines
+        }
+
+def iter_s3_lines(s3_client, bucket: str, key: str, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                  max_line_bytes: int = DEFAULT_MAX_LINE_BYTES, start: int = 0,
+                  expected_prefix: bytes = b'') -> Optional[LogLineReader]:
+    """
+    S3オブジェクトの行リーダーを作成
+    start / expected_prefix 指定時はRange GETで start から読み込み（非圧縮ファイルのみ）、
+    先頭が expected_prefix と一致しなければNoneを返却（前回読んだ部分が書き換えられている）
+    """
+    if not start and not expected_prefix:
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+        return LogLineReader(body, key, chunk_size=chunk_size, max_line_bytes=max_line_bytes)
+    body = s3_client.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-')['Body']
+    if expected_prefix and body.read(len(expected_prefix)) != expected_prefix:
+        body.close()
+        return None
+    reader = LogLineReader(body, key, chunk_size=chunk_size, max_line_bytes=max_line_bytes, compression=None)
+    reader.source.bytes_read += len(expected_prefix)
+    return reader